@@ -0,0 +1,66 @@
+"""Benchmark the artifact removal window expansion in nwb_datajoint.common.common_artifact.
+
+Generates a synthetic session of evenly sampled timestamps and a set of threshold crossing times clustered in
+bursts (as with chewing artifacts), then times _get_artifact_window_mask against the original per-crossing loop
+implementation. Its results are checked against the original implementation (in tests/reference_implementations.py)
+in tests/common/test_common_artifact.py.
+
+The original implementation scans every timestamp twice per crossing and then takes the union of all the
+per-crossing arrays, so with the default sizes (1e5 crossings) it is only run on the first
+--n-reference-crossings crossings and its run time for the full set is extrapolated from that.
+
+NOTE: importing nwb_datajoint.common requires the DataJoint MySQL server to be set up and running.
+
+Usage (from the repository root): python -m benchmarks.benchmark_artifact [--n-timestamps 3e7] [--n-crossings 1e5]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from nwb_datajoint.common.common_artifact import _get_artifact_window_mask
+from tests.reference_implementations import reference_window_mask
+
+
+def make_session(n_timestamps, n_crossings, n_bursts=100, sampling_rate=30000., seed=0):
+    """Returns evenly sampled timestamps and sorted crossing times drawn from bursts of consecutive samples"""
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(n_timestamps, dtype=np.float64) / sampling_rate
+    burst_length = max(n_crossings // n_bursts, 1)
+    # bursts start on a grid of burst_length samples so that they never overlap
+    burst_starts = burst_length * np.sort(rng.choice(n_timestamps // burst_length, size=n_bursts, replace=False))
+    crossing_indices = (burst_starts[:, None] + np.arange(burst_length)).ravel()
+    return timestamps, timestamps[crossing_indices]
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-timestamps', type=float, default=3e7)
+    parser.add_argument('--n-crossings', type=float, default=1e5)
+    parser.add_argument('--removal-window-ms', type=float, default=1.0)
+    parser.add_argument('--n-reference-crossings', type=int, default=100,
+                        help='number of crossings to run through the original implementation')
+    args = parser.parse_args()
+
+    n_timestamps, n_crossings = int(args.n_timestamps), int(args.n_crossings)
+    half_window = args.removal_window_ms / 1000 / 2
+    print(f'Generating {n_timestamps} timestamps and {n_crossings} threshold crossings...')
+    timestamps, crossing_times = make_session(n_timestamps, n_crossings)
+    n_crossings = len(crossing_times)
+    n_reference = min(args.n_reference_crossings, n_crossings)
+
+    _, new_time = _time(_get_artifact_window_mask, timestamps, crossing_times, half_window)
+    _, ref_time = _time(reference_window_mask, timestamps, crossing_times[:n_reference], half_window)
+    extrapolated = ref_time * n_crossings / n_reference
+    print(f'_get_artifact_window_mask: {new_time:.3f} s for {n_crossings} crossings; original implementation '
+          f'{ref_time:.3f} s for {n_reference} crossings (~{extrapolated:.1f} s extrapolated)')
+
+
+if __name__ == '__main__':
+    main()
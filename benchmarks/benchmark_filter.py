@@ -0,0 +1,80 @@
+"""Benchmark the FirFilter convolution backends in nwb_datajoint.common.common_filter.
+
+Generates synthetic raw data and designs the standard 'LFP 0-400 Hz' low pass filter for its sampling rate, then
+filters and decimates the data (to 1 kHz by default, as LFP.make does) with each of the FILTER_BACKENDS, and reports
+the throughput of each backend in samples per second per channel. The direct convolution that the outputs of the
+backends are checked against in tests/common/test_common_filter.py (reference_convolve in
+tests/reference_implementations.py) is timed as well, on the first --n-reference-channels channels.
+
+NOTE: importing nwb_datajoint.common requires the DataJoint MySQL server to be set up and running.
+
+Usage (from the repository root):
+    python -m benchmarks.benchmark_filter [--duration 60] [--n-channels 32] [--sampling-rate 30000]
+"""
+import argparse
+import os
+import time
+
+import ghostipy as gsp
+import numpy as np
+
+from nwb_datajoint.common.common_filter import FILTER_BACKENDS, FirFilter, plan_filter_blocks
+from tests.reference_implementations import reference_convolve
+
+
+def make_lfp_filter(sampling_rate):
+    """Returns the coefficients of the standard 0-400 Hz LFP low pass filter (see FirFilter.create_standard_filters)"""
+    band_edges = [400, 425]
+    numtaps = gsp.estimate_taps(sampling_rate, band_edges[1] - band_edges[0])
+    return np.array(gsp.firdesign(numtaps, band_edges, [1, 0], fs=sampling_rate, p=2), ndmin=1)
+
+
+def filter_with_backend(backend, data, filter_coeff, decimation, time_block_samples):
+    """Filters all channels of data with the given backend and returns the decimated output"""
+    fir_filter = FirFilter()
+    fir_filter.filter_backend = backend
+    return np.concatenate([filtered_block for _, filtered_block in fir_filter._filter_interval(
+        data, filter_coeff, 0, 0, data.shape[0], np.arange(data.shape[1]), decimation, time_block_samples,
+        os.cpu_count())])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=60., help='duration of the data in seconds')
+    parser.add_argument('--n-channels', type=int, default=32)
+    parser.add_argument('--sampling-rate', type=int, default=30000)
+    parser.add_argument('--decimation', type=int, default=None,
+                        help='decimation factor; defaults to the factor that gives 1 kHz output')
+    parser.add_argument('--memory-budget', type=str, default='1G')
+    parser.add_argument('--n-reference-channels', type=int, default=1,
+                        help='number of channels to filter with the direct convolution')
+    args = parser.parse_args()
+
+    decimation = args.decimation or args.sampling_rate // 1000
+    n_samples = int(args.duration * args.sampling_rate)
+    filter_coeff = make_lfp_filter(args.sampling_rate)
+    print(f'Generating {n_samples} samples x {args.n_channels} channels; filter has {len(filter_coeff)} taps, '
+          f'decimation {decimation}')
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 200, (n_samples, args.n_channels)).astype(np.int16)
+    time_block_samples, _, _ = plan_filter_blocks(n_samples, args.n_channels, data.itemsize, len(filter_coeff),
+                                                  decimation, channel_block_size=args.n_channels,
+                                                  memory_budget=args.memory_budget)
+
+    for backend in FILTER_BACKENDS:
+        start = time.perf_counter()
+        filter_with_backend(backend, data, filter_coeff, decimation, time_block_samples)
+        elapsed = time.perf_counter() - start
+        print(f'{backend}: {elapsed:.3f} s, {n_samples / elapsed:.3g} samples/s per channel')
+
+    n_reference = min(args.n_reference_channels, args.n_channels)
+    filter_delay = (len(filter_coeff) - 1) // 2
+    start = time.perf_counter()
+    reference_convolve(data[:, :n_reference], filter_coeff, filter_delay, filter_delay + n_samples - 1, decimation)
+    elapsed = (time.perf_counter() - start) / n_reference
+    print(f'direct convolution: {elapsed * args.n_channels:.3f} s (extrapolated from {n_reference} channels), '
+          f'{n_samples / elapsed:.3g} samples/s per channel')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark the interval containment functions in nwb_datajoint.common.common_interval.
+
+Generates a synthetic session of evenly sampled timestamps and a set of random, non-overlapping intervals,
+then times the searchsorted-based functions against the original per-interval loop implementation. Their results
+are checked against the original implementation (in tests/reference_implementations.py) in
+tests/common/test_common_interval.py.
+
+The original implementation scans every timestamp once per interval, so with the default sizes
+(1e8 timestamps, 1e4 intervals) it is only run on the first --n-reference-intervals intervals and its
+run time for the full set is extrapolated from that.
+
+NOTE: importing nwb_datajoint.common requires the DataJoint MySQL server to be set up and running.
+
+Usage (from the repository root): python -m benchmarks.benchmark_interval [--n-timestamps 1e8] [--n-intervals 1e4]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from nwb_datajoint.common.common_interval import (interval_list_contains_ind,
+                                                  interval_list_excludes_ind)
+from tests.reference_implementations import reference_contains_ind, reference_excludes_ind
+
+
+def make_session(n_timestamps, n_intervals, sampling_rate=30000., seed=0):
+    """Returns evenly sampled timestamps and sorted, non-overlapping (n_intervals, 2) valid times"""
+    rng = np.random.default_rng(seed)
+    timestamps = np.arange(n_timestamps, dtype=np.float64) / sampling_rate
+    edges = np.sort(rng.uniform(timestamps[0], timestamps[-1], 2 * n_intervals))
+    return timestamps, edges.reshape(-1, 2)
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-timestamps', type=float, default=1e8)
+    parser.add_argument('--n-intervals', type=float, default=1e4)
+    parser.add_argument('--n-reference-intervals', type=int, default=10,
+                        help='number of intervals to run through the original implementation')
+    args = parser.parse_args()
+
+    n_timestamps, n_intervals = int(args.n_timestamps), int(args.n_intervals)
+    print(f'Generating {n_timestamps} timestamps and {n_intervals} intervals...')
+    timestamps, valid_times = make_session(n_timestamps, n_intervals)
+    n_reference = min(args.n_reference_intervals, n_intervals)
+
+    for name, func, reference in [('interval_list_contains_ind', interval_list_contains_ind, reference_contains_ind),
+                                  ('interval_list_excludes_ind', interval_list_excludes_ind, reference_excludes_ind)]:
+        _, new_time = _time(func, valid_times, timestamps)
+        _, ref_time = _time(reference, valid_times[:n_reference], timestamps)
+        extrapolated = ref_time * (n_intervals + 1) / (n_reference + 1)
+        print(f'{name}: {new_time:.3f} s for {n_intervals} intervals; original implementation '
+              f'{ref_time:.3f} s for {n_reference} intervals (~{extrapolated:.1f} s extrapolated)')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,14 @@ import yaml
 def cli():
     pass
 
-@click.command(help="Insert a session from a .nwb file that lives in the $NWB_DATAJOINT_BASE_DIR directory")
-@click.argument('nwb_file_name')
-def insert_session(nwb_file_name: str):
+@click.command(help="Insert sessions from one or more .nwb files that live in the $NWB_DATAJOINT_BASE_DIR directory")
+@click.argument('nwb_file_names', nargs=-1, required=True)
+@click.option('--n-workers', default=1, show_default=True, help='Number of sessions to insert in parallel')
+def insert_session(nwb_file_names: List[str], n_workers: int):
     import nwb_datajoint as nd
-    nd.insert_sessions(nwb_file_name)
+    summary = nd.insert_sessions(list(nwb_file_names), n_workers=n_workers)
+    if any(result['status'] == 'failed' for result in summary):
+        raise click.ClickException('Some sessions failed to insert')
 
 @click.command(help="List all sessions")
 def list_sessions():
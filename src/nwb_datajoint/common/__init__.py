@@ -7,7 +7,7 @@ from .common_dio import DIOEvents
 from .common_ephys import (LFP, Electrode, ElectrodeGroup, LFPBand,
                            LFPBandSelection, LFPSelection, Raw, SampleCount)
 from .common_filter import FirFilter
-from .common_interval import (IntervalList, SortInterval,
+from .common_interval import (IntervalList, IntervalSet, SortInterval,
                               intervals_by_length,
                               interval_list_contains,
                               interval_list_contains_ind,
@@ -15,6 +15,8 @@ from .common_interval import (IntervalList, SortInterval,
                               interval_list_excludes_ind,
                               interval_list_intersect,
                               interval_list_censor,
+                              interval_list_complement,
+                              interval_list_difference,
                               interval_list_union)
 from .common_lab import Institution, Lab, LabMember, LabTeam
 from .common_nwbfile import (AnalysisNwbfile, AnalysisNwbfileKachery, Nwbfile,
@@ -36,9 +38,9 @@ from .common_curation import (AutomaticCurationParameters,AutomaticCurationSelec
 from .common_subject import Subject
 from .common_task import Task, TaskEpoch
 from .common_backup import SpikeSortingBackUp, CuratedSpikeSortingBackUp
-from .nwb_helper_fn import (close_nwb_files, estimate_sampling_rate,
-                            get_data_interface, get_electrode_indices,
-                            get_nwb_file, get_raw_eseries, get_valid_intervals)
+from .nwb_helper_fn import (LazyArray, close_nwb_file, close_nwb_files, estimate_sampling_rate,
+                            get_data_array, get_data_interface, get_electrode_indices,
+                            get_nwb_file, get_nwb_file_pool_stats, get_raw_eseries, get_valid_intervals)
 from .populate_all_common import populate_all_common
 
 import spikeinterface as si
@@ -1,12 +1,13 @@
-from functools import reduce
+import os
 
 import datajoint as dj
 import numpy as np
-import scipy.stats as stats
 import warnings
 import spikeinterface as si
+from spikeinterface.core.job_tools import ChunkRecordingExecutor, ensure_n_jobs
 from spikeinterface.core.segmentutils import AppendSegmentRecording
 
+from .common_filter import memory_to_bytes
 from .common_interval import IntervalList
 from .common_spikesorting import SpikeSortingRecording
 from .common_session import Session
@@ -30,6 +31,7 @@ class ArtifactDetectionParameters(dj.Manual):
         artifact_params['amplitude_thresh'] = 3000 # must be None or >= 0
         artifact_params['proportion_above_thresh'] = 1.0 # all electrodes of sort group
         artifact_params['removal_window_ms'] = 1.0 # in milliseconds
+        artifact_params['chunk_duration'] = 10.0 # in seconds; length of the recording chunk processed by each job
         self.insert1(['default', artifact_params], skip_duplicates=True)  
 
         artifact_params_none = {}
@@ -59,7 +61,7 @@ class ArtifactDetection(dj.Computed):
 
     def make(self, key):
         # get the dict of artifact params associated with this artifact_params_name
-        artifact_params = (ArtifactDetectionParameters & key).fetch1("artifact_params")
+        artifact_params = _get_artifact_params((ArtifactDetectionParameters & key).fetch1("artifact_params"))
         
         recording_path = (SpikeSortingRecording & key).fetch1('recording_path')
         recording = si.load_extractor(recording_path) 
@@ -119,8 +121,19 @@ class ArtifactRemovedIntervalList(dj.Manual):
     artifact_times: longblob # np array of artifact intervals
     """
     
+def _get_artifact_params(artifact_params):
+    """Returns a copy of the artifact params with n_jobs set from the NWB_DATAJOINT_ARTIFACT_N_JOBS environment
+    variable if it is set. The number of processes depends on the machine rather than on the analysis, so the
+    environment variable takes precedence over the n_jobs of the params."""
+    artifact_params = dict(artifact_params)
+    n_jobs = os.getenv('NWB_DATAJOINT_ARTIFACT_N_JOBS')
+    if n_jobs is not None:
+        artifact_params['n_jobs'] = int(n_jobs)
+    return artifact_params
+
 def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
-                        proportion_above_thresh=1.0, removal_window_ms=1.0):
+                        proportion_above_thresh=1.0, removal_window_ms=1.0, total_memory=None,
+                        n_jobs=1, chunk_duration=None):
     """Detects times during which artifacts do and do not occur.
     Artifacts are defined as periods where the absolute value of the recording signal exceeds one
     OR both specified amplitude or zscore thresholds on the proportion of channels specified,
@@ -138,6 +151,20 @@ def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
         Proportion of electrodes that need to have threshold crossings, defaults to 1 
     removal_window_ms : float, optional
         Width of the window in milliseconds to mask out per artifact (window/2 removed on each side of threshold crossing), defaults to 1 ms
+    total_memory : str, optional
+        Memory budget for detection, e.g. '500M' or '2G' (must end with 'k', 'M' or 'G'). If specified, the recording
+        is streamed in chunks sized to fit the budget, shared by all jobs; if None (default) and chunk_duration is
+        also None, the whole recording is loaded at once.
+    n_jobs : int, optional
+        Number of processes to run the detection in, -1 to use all cores, defaults to 1. ArtifactDetection.make
+        takes it from the NWB_DATAJOINT_ARTIFACT_N_JOBS environment variable if that is set. The recording is split
+        into time chunks only, which are fanned out over a process pool, each of which reloads the recording from its
+        saved location; each chunk holds all of the channels, since the proportion_above_thresh test needs every
+        channel of a frame. Sort groups are run in parallel by calling ArtifactDetection.populate(reserve_jobs=True)
+        in several processes.
+    chunk_duration : float, optional
+        Length in seconds of the recording chunks processed by each job; takes precedence over total_memory.
+        Defaults to None, in which case chunks are sized from total_memory, or are 10 s long if n_jobs > 1.
     
     Returns
     ------_
@@ -165,26 +192,37 @@ def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
     # turn ms to remove total into s to remove from either side of each detected artifact
     half_removal_window_s = removal_window_ms * (1/1000) * (1/2)
     
-    # TODO: load by chunk to avoid memory problems
-    data = recording.get_traces()
-
     # compute the number of electrodes that have to be above threshold
     nelect_above = np.ceil(proportion_above_thresh * len(recording.get_channel_ids()))
 
-    # find the artifact occurrences using one or both thresholds, across channels
-    if ((amplitude_thresh is not None) and (zscore_thresh is None)):
-        above_a = np.abs(data) > amplitude_thresh
-        above_thresh = np.ravel(np.argwhere(np.sum(above_a, axis=0) >= nelect_above))
-    elif ((amplitude_thresh is None) and (zscore_thresh is not None)):
-        dataz = np.abs(stats.zscore(data, axis=1))
-        above_z = dataz > zscore_thresh
-        above_thresh = np.ravel(np.argwhere(np.sum(above_z, axis=0) >= nelect_above))
+    n_jobs = ensure_n_jobs(recording, n_jobs=n_jobs)
+    if chunk_duration is None and total_memory is None and n_jobs > 1:
+        chunk_duration = 10.0
+    if chunk_duration is not None:
+        chunk_size = max(int(chunk_duration * recording.get_sampling_frequency()), 1)
     else:
-        above_a = np.abs(data) > amplitude_thresh
-        dataz = np.abs(stats.zscore(data, axis=1))
-        above_z = dataz > zscore_thresh
-        above_thresh = np.ravel(np.argwhere(
-            np.sum(np.logical_or(above_z, above_a), axis=0) >= nelect_above))
+        chunk_size = _get_artifact_chunk_size(recording, total_memory, n_jobs)
+    # worker processes rebuild the recording from its dict description, which points to the saved files
+    worker_recording = recording.to_dict() if n_jobs > 1 else recording
+
+    # first pass: per-channel mean and standard deviation, needed only for the z-score threshold
+    channel_mean, channel_std = None, None
+    if zscore_thresh is not None:
+        executor = ChunkRecordingExecutor(recording, _compute_channel_stats_chunk, _init_artifact_worker,
+                                          (worker_recording, amplitude_thresh, zscore_thresh, nelect_above,
+                                           None, None),
+                                          handle_returns=True, n_jobs=n_jobs, chunk_size=chunk_size,
+                                          job_name='artifact_channel_stats')
+        channel_mean, channel_std = _combine_channel_stats(executor.run())
+
+    # second pass: find the artifact occurrences using one or both thresholds, across channels;
+    # the chunks are returned in order, so the merged crossings are sorted
+    executor = ChunkRecordingExecutor(recording, _detect_artifact_chunk, _init_artifact_worker,
+                                      (worker_recording, amplitude_thresh, zscore_thresh, nelect_above,
+                                       channel_mean, channel_std),
+                                      handle_returns=True, n_jobs=n_jobs, chunk_size=chunk_size,
+                                      job_name='detect_artifact_frames')
+    above_thresh = np.concatenate(executor.run())
     
     if len(above_thresh) == 0:
         recording_interval = np.asarray([[valid_timestamps[0], valid_timestamps[-1]]])
@@ -194,16 +232,9 @@ def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
 
     above_thresh_times = valid_timestamps[above_thresh] # find timestamps of initial artifact threshold crossings
     
-    # keep track of all the artifact timestamps within each artifact removal window and the indices of those timestamps
-    artifact_times = []
-    artifact_indices = []
-    for a in above_thresh_times:
-        a_times = np.copy(valid_timestamps[(valid_timestamps > (a - half_removal_window_s)) & (valid_timestamps <= (a + half_removal_window_s))])
-        a_indices = np.argwhere((valid_timestamps > (a - half_removal_window_s)) & (valid_timestamps <= (a + half_removal_window_s)))
-        artifact_times.append(a_times)
-        artifact_indices.append(a_indices)
-    all_artifact_times = reduce(np.union1d, artifact_times)
-    all_artifact_indices = reduce(np.union1d, artifact_indices)
+    # mark all the timestamps within the artifact removal window of any threshold crossing
+    is_artifact = _get_artifact_window_mask(valid_timestamps, above_thresh_times, half_removal_window_s)
+    all_artifact_times = valid_timestamps[is_artifact]
     # turn artifact detected times into intervals
     if not np.all(all_artifact_times[:-1] <= all_artifact_times[1:]): #should be faster than diffing and comparing to zero
         warnings.warn("Warning: sorting artifact timestamps; all_artifact_times was not strictly increasing")
@@ -214,13 +245,116 @@ def _get_artifact_times(recording, zscore_thresh=None, amplitude_thresh=None,
     print(f"{len(artifact_intervals)} artifact intervals detected;\
           {artifact_percent_of_times} % of the recording's valid_timestamps removed as artifact")
     
-    # turn all artifact detected times into -1 to easily find non-artifact intervals
-    valid_timestamps[all_artifact_indices] = -1
-    artifact_removed_valid_times = get_valid_intervals(valid_timestamps[valid_timestamps != -1], 
-                                                       recording.get_sampling_frequency(), 1.5, 0.000001)           
+    # find the intervals of the timestamps that are not artifact
+    artifact_removed_valid_times = get_valid_intervals(valid_timestamps, recording.get_sampling_frequency(), 1.5,
+                                                       0.000001, mask=~is_artifact)
     
     return artifact_removed_valid_times, artifact_intervals
 
+def _get_artifact_window_mask(timestamps, artifact_times, half_window):
+    """Returns a boolean mask of the timestamps that fall within half_window of any artifact time,
+    i.e. artifact_time - half_window < timestamp <= artifact_time + half_window.
+
+    Each window is converted to a range of timestamp indices with a binary search, and the ranges are merged with
+    a cumulative sum over their start (+1) and end (-1) markers, so the cost is O(n + m log n) for n timestamps and
+    m artifact times rather than a full scan of the timestamps per artifact time.
+
+    Parameters
+    ----------
+    timestamps : np.ndarray
+        1D array of timestamps
+    artifact_times : np.ndarray
+        1D array of times of threshold crossings
+    half_window : float
+        half the width of the removal window, in seconds
+
+    Returns
+    -------
+    is_artifact : np.ndarray
+        boolean array the same length as timestamps
+    """
+    timestamps = np.asarray(timestamps)
+    sorted_order = None
+    if np.any(timestamps[1:] < timestamps[:-1]):
+        sorted_order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[sorted_order]
+
+    window_start = np.searchsorted(timestamps, artifact_times - half_window, side='right')
+    window_stop = np.searchsorted(timestamps, artifact_times + half_window, side='right')
+    n_timestamps = len(timestamps)
+    window_count = np.cumsum(np.bincount(window_start, minlength=n_timestamps + 1) -
+                             np.bincount(window_stop, minlength=n_timestamps + 1))
+    is_artifact = window_count[:n_timestamps] > 0
+
+    if sorted_order is not None:
+        is_artifact_sorted = is_artifact
+        is_artifact = np.empty_like(is_artifact_sorted)
+        is_artifact[sorted_order] = is_artifact_sorted
+    return is_artifact
+
+
+def _get_artifact_chunk_size(recording, total_memory, n_jobs=1):
+    """Returns the number of frames per chunk that keeps detection by n_jobs processes within total_memory,
+    or None for no chunking.
+
+    Each frame needs the raw traces plus a float64 copy for the z-score and boolean threshold masks."""
+    if total_memory is None:
+        return None
+    total_memory = memory_to_bytes(total_memory)
+    bytes_per_frame = recording.get_num_channels() * (np.dtype(recording.get_dtype()).itemsize + 8 + 2)
+    return max(int(total_memory // (bytes_per_frame * n_jobs)), 1)
+
+
+def _init_artifact_worker(recording, amplitude_thresh, zscore_thresh, nelect_above, channel_mean, channel_std):
+    # the recording is passed as a dict when the worker runs in a separate process
+    if isinstance(recording, dict):
+        recording = si.load_extractor(recording)
+    worker_ctx = {}
+    worker_ctx['recording'] = recording
+    worker_ctx['amplitude_thresh'] = amplitude_thresh
+    worker_ctx['zscore_thresh'] = zscore_thresh
+    worker_ctx['nelect_above'] = nelect_above
+    worker_ctx['channel_mean'] = channel_mean
+    worker_ctx['channel_std'] = channel_std
+    return worker_ctx
+
+
+def _compute_channel_stats_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    """Returns the number of frames and the per-channel mean and sum of squared deviations for one chunk"""
+    traces = worker_ctx['recording'].get_traces(segment_index=segment_index, start_frame=start_frame,
+                                                end_frame=end_frame).astype(np.float64)
+    chunk_mean = np.mean(traces, axis=0)
+    return len(traces), chunk_mean, np.sum((traces - chunk_mean) ** 2, axis=0)
+
+
+def _combine_channel_stats(chunk_stats):
+    """Combines per-chunk (count, mean, sum of squared deviations) into the per-channel mean and
+    standard deviation of the whole recording (Chan et al. parallel variance algorithm)"""
+    n_frames, channel_mean, channel_m2 = chunk_stats[0]
+    for chunk_n_frames, chunk_mean, chunk_m2 in chunk_stats[1:]:
+        total_frames = n_frames + chunk_n_frames
+        delta = chunk_mean - channel_mean
+        channel_mean = channel_mean + delta * chunk_n_frames / total_frames
+        channel_m2 = channel_m2 + chunk_m2 + delta ** 2 * n_frames * chunk_n_frames / total_frames
+        n_frames = total_frames
+    return channel_mean, np.sqrt(channel_m2 / n_frames)
+
+
+def _detect_artifact_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    """Returns the frame indices in one chunk where at least nelect_above channels cross a threshold"""
+    traces = worker_ctx['recording'].get_traces(segment_index=segment_index, start_frame=start_frame,
+                                                end_frame=end_frame)
+    above = np.zeros(traces.shape, dtype=bool)
+    if worker_ctx['amplitude_thresh'] is not None:
+        above |= np.abs(traces) > worker_ctx['amplitude_thresh']
+    if worker_ctx['zscore_thresh'] is not None:
+        # channels with zero variance give NaN z-scores, which are never above threshold
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dataz = np.abs((traces - worker_ctx['channel_mean']) / worker_ctx['channel_std'])
+        above |= dataz > worker_ctx['zscore_thresh']
+    return start_frame + np.flatnonzero(np.sum(above, axis=1) >= worker_ctx['nelect_above'])
+
+
 def _check_artifact_thresholds(amplitude_thresh, zscore_thresh, proportion_above_thresh):
     """Alerts user to likely unintended parameters. Not an exhaustive verification.
 
@@ -9,7 +9,7 @@ from .common_nwbfile import Nwbfile
 from .common_session import Session  # noqa: F401
 from .common_task import TaskEpoch
 from .dj_helper_fn import fetch_nwb
-from .nwb_helper_fn import get_all_spatial_series, get_data_interface, get_nwb_file
+from .nwb_helper_fn import get_all_spatial_series, get_data_array, get_data_interface, get_nwb_file
 
 schema = dj.schema('common_behav')
 
@@ -24,11 +24,24 @@ class PositionSource(dj.Manual):
     import_file_name: varchar(2000)  # path to import file if importing position data
     """
 
+    class SpatialSeries(dj.Part):
+        definition = """
+        # the spatial series of each position epoch, read once per NWB file by insert_from_nwbfile
+        -> PositionSource
+        ---
+        raw_position_object_id: varchar(40)  # the object id of the spatial series for this epoch in the NWB file
+        sampling_rate: float                 # (Hz) sampling rate estimated from the timestamps
+        """
+
     @classmethod
     def insert_from_nwbfile(cls, nwb_file_name):
         """Given an NWB file name, get the spatial series and interval lists from the file, add the interval
         lists to the IntervalList table, and populate the RawPosition table if possible.
 
+        The spatial series are read in one pass over the file; the valid times of each epoch are stored in
+        IntervalList and its object id and sampling rate in PositionSource.SpatialSeries, which RawPosition.make
+        reads instead of the file.
+
         Parameters
         ----------
         nwb_file_name : str
@@ -57,6 +70,10 @@ class PositionSource(dj.Manual):
                 key['source'] = 'trodes'
                 key['import_file_name'] = ''
                 cls.insert1(key)
+                cls.SpatialSeries.insert1({'nwb_file_name': nwb_file_name,
+                                           'interval_list_name': pos_interval_list_name,
+                                           'raw_position_object_id': pdict['raw_position_object_id'],
+                                           'sampling_rate': pdict['sampling_rate']})
 
     @staticmethod
     def get_pos_interval_name(pos_epoch_num):
@@ -72,11 +89,16 @@ class RawPosition(dj.Imported):
     """
 
     def make(self, key):
+        spatial_series = PositionSource.SpatialSeries & key
+        if len(spatial_series):
+            key['raw_position_object_id'] = spatial_series.fetch1('raw_position_object_id')
+            self.insert1(key)
+            return
+
+        # PositionSource entries inserted before PositionSource.SpatialSeries existed
         nwb_file_name = key['nwb_file_name']
         nwb_file_abspath = Nwbfile.get_abs_path(nwb_file_name)
         nwbf = get_nwb_file(nwb_file_abspath)
-
-        # TODO refactor this. this calculates sampling rate (unused here) and is expensive to do twice
         pos_dict = get_all_spatial_series(nwbf)
         for epoch in pos_dict:
             if key['interval_list_name'] == PositionSource.get_pos_interval_name(epoch):
@@ -88,12 +110,25 @@ class RawPosition(dj.Imported):
     def fetch_nwb(self, *attrs, **kwargs):
         return fetch_nwb(self, (Nwbfile, 'nwb_file_abs_path'), *attrs, **kwargs)
 
-    def fetch1_dataframe(self):
+    def fetch1_dataframe(self, zero_copy=False):
+        """Return the raw position as a dataframe indexed by time.
+
+        Parameters
+        ----------
+        zero_copy : bool, optional
+            If True, the dataframe is a read-only view of a memory map of the position data when the data is stored
+            contiguously and uncompressed, instead of a copy in memory. Default False.
+        """
         raw_position_nwb = self.fetch_nwb()[0]['raw_position']
+        if zero_copy:
+            data = get_data_array(raw_position_nwb.data)
+            timestamps = get_data_array(raw_position_nwb.timestamps)
+        else:
+            data, timestamps = raw_position_nwb.data, raw_position_nwb.timestamps
         return pd.DataFrame(
-            data=raw_position_nwb.data,
-            index=pd.Index(raw_position_nwb.timestamps, name='time'),
-            columns=raw_position_nwb.description.split(', '))
+            data=data,
+            index=pd.Index(timestamps, name='time'),
+            columns=raw_position_nwb.description.split(', '), copy=False)
 
 
 @schema
@@ -155,8 +190,7 @@ class VideoFile(dj.Imported):
 
         # get the interval for the current TaskEpoch
         interval_list_name = (TaskEpoch() & key).fetch1('interval_list_name')
-        valid_times = (IntervalList & {'nwb_file_name': key['nwb_file_name'],
-                                       'interval_list_name': interval_list_name}).fetch1('valid_times')
+        valid_times = IntervalList.fetch_interval_set(key['nwb_file_name'], interval_list_name)
 
         for video_obj in video.time_series.values():
             # check to see if the times for this video_object are largely overlapping with the task epoch times
@@ -1,3 +1,4 @@
+import os
 import warnings
 
 import datajoint as dj
@@ -37,20 +38,26 @@ class ElectrodeGroup(dj.Imported):
         nwb_file_name = key['nwb_file_name']
         nwb_file_abspath = Nwbfile.get_abs_path(nwb_file_name)
         nwbf = get_nwb_file(nwb_file_abspath)
+        # add the electrode group locations that do not exist, and fetch their rows
+        region_ids = BrainRegion.fetch_add_regions(
+            [electrode_group.location for electrode_group in nwbf.electrode_groups.values()])
+        rows = list()
         for electrode_group in nwbf.electrode_groups.values():
-            key['electrode_group_name'] = electrode_group.name
-            # add electrode group location if it does not exist, and fetch the row
-            key['region_id'] = BrainRegion.fetch_add(region_name=electrode_group.location)
+            # all rows must have the same fields to be inserted together
+            row = dict(key, probe_type=None, target_hemisphere='Unknown')
+            row['electrode_group_name'] = electrode_group.name
+            row['region_id'] = region_ids[electrode_group.location]
             if isinstance(electrode_group.device, ndx_franklab_novela.Probe):
-                key['probe_type'] = electrode_group.device.probe_type
-            key['description'] = electrode_group.description
+                row['probe_type'] = electrode_group.device.probe_type
+            row['description'] = electrode_group.description
             if isinstance(electrode_group, ndx_franklab_novela.NwbElectrodeGroup):
                 # Define target_hemisphere based on targeted x coordinate
                 if electrode_group.targeted_x >= 0:  # if positive or zero x coordinate
-                    key["target_hemisphere"] = "Right"  # define target location as right hemisphere
+                    row["target_hemisphere"] = "Right"  # define target location as right hemisphere
                 else:  # if negative x coordinate
-                    key["target_hemisphere"] = "Left"  # define target location as left hemisphere
-            self.insert1(key, skip_duplicates=True)
+                    row["target_hemisphere"] = "Left"  # define target location as left hemisphere
+            rows.append(row)
+        self.insert(rows, skip_duplicates=True)
 
 
 @schema
@@ -80,10 +87,16 @@ class Electrode(dj.Imported):
         nwb_file_abspath = Nwbfile.get_abs_path(nwb_file_name)
         nwbf = get_nwb_file(nwb_file_abspath)
         electrodes = nwbf.electrodes.to_dataframe()
+        # look up each brain region once
+        region_ids = BrainRegion.fetch_add_regions([group.location for group in electrodes['group']])
+        rows = list()
         for elect_id, elect_data in electrodes.iterrows():
-            key['electrode_id'] = elect_id
-            key['name'] = str(elect_id)
-            key['electrode_group_name'] = elect_data.group_name
+            # all rows must have the same fields to be inserted together
+            row = dict(key, probe_type=None, probe_shank=None, probe_electrode=None, bad_channel='False',
+                       original_reference_electrode=-1)
+            row['electrode_id'] = elect_id
+            row['name'] = str(elect_id)
+            row['electrode_group_name'] = elect_data.group_name
             # rough check of whether the electrodes table was created by rec_to_nwb and has
             # the appropriate custom columns used by rec_to_nwb
             # TODO this could be better resolved by making an extension for the electrodes table
@@ -92,22 +105,23 @@ class Electrode(dj.Imported):
                     'probe_electrode' in elect_data and
                     'bad_channel' in elect_data and
                     'ref_elect_id' in elect_data):
-                key['probe_type'] = elect_data.group.device.probe_type
-                key['probe_shank'] = elect_data.probe_shank
-                key['probe_electrode'] = elect_data.probe_electrode
-                key['bad_channel'] = 'True' if elect_data.bad_channel else 'False'
-                key['original_reference_electrode'] = elect_data.ref_elect_id
-            key['region_id'] = BrainRegion.fetch_add(region_name=elect_data.group.location)
-            key['x'] = elect_data.x
-            key['y'] = elect_data.y
-            key['z'] = elect_data.z
-            key['x_warped'] = 0
-            key['y_warped'] = 0
-            key['z_warped'] = 0
-            key['contacts'] = ''
-            key['filtering'] = elect_data.filtering
-            key['impedance'] = elect_data.imp
-            self.insert1(key, skip_duplicates=True)
+                row['probe_type'] = elect_data.group.device.probe_type
+                row['probe_shank'] = elect_data.probe_shank
+                row['probe_electrode'] = elect_data.probe_electrode
+                row['bad_channel'] = 'True' if elect_data.bad_channel else 'False'
+                row['original_reference_electrode'] = elect_data.ref_elect_id
+            row['region_id'] = region_ids[elect_data.group.location]
+            row['x'] = elect_data.x
+            row['y'] = elect_data.y
+            row['z'] = elect_data.z
+            row['x_warped'] = 0
+            row['y_warped'] = 0
+            row['z_warped'] = 0
+            row['contacts'] = ''
+            row['filtering'] = elect_data.filtering
+            row['impedance'] = elect_data.imp
+            rows.append(row)
+        self.insert(rows, skip_duplicates=True)
 
 
 @schema
@@ -152,8 +166,8 @@ class Raw(dj.Imported):
             interval_dict['valid_times'] = np.array([[0, len(rawdata.data)*rawdata.rate]])
         else:
             # get the list of valid times given the specified sampling rate.
-            interval_dict['valid_times'] = get_valid_intervals(np.asarray(rawdata.timestamps), key['sampling_rate'],
-                                                               1.75, 0)
+            # the timestamps are read chunk by chunk
+            interval_dict['valid_times'] = get_valid_intervals(rawdata.timestamps, key['sampling_rate'], 1.75, 0)
         IntervalList().insert1(interval_dict, skip_duplicates=True)
 
         # now insert each of the electrodes as an individual row, but with the same nwb_object_id
@@ -232,15 +246,9 @@ class LFPSelection(dj.Manual):
         if len((LFPSelection() & {'nwb_file_name': nwb_file_name}).fetch()) == 0:
             LFPSelection().insert1({'nwb_file_name': nwb_file_name})
 
-            # TODO: do this in a better way
-            all_electrodes = (Electrode() & {'nwb_file_name': nwb_file_name}).fetch(as_dict=True)
-            primary_key = Electrode.primary_key
-            for e in all_electrodes:
-                # create a dictionary so we can insert new elects
-                if e['electrode_id'] in electrode_list:
-                    lfpelectdict = {k: v for k,
-                                    v in e.items() if k in primary_key}
-                    LFPSelection().LFPElectrode.insert1(lfpelectdict, replace=True)
+            electrode_keys = (Electrode() & {'nwb_file_name': nwb_file_name}).fetch('KEY')
+            LFPSelection().LFPElectrode.insert(
+                [e for e in electrode_keys if e['electrode_id'] in electrode_list], replace=True)
 
 
 @schema
@@ -255,23 +263,173 @@ class LFP(dj.Imported):
     lfp_sampling_rate: float    # the sampling rate, in HZ
     """
 
+    # the minimum length, in seconds, of the raw valid intervals that are filtered
+    min_interval_length = 1.0
+
+    class LFPUpdate(dj.Part):
+        definition = """
+        # the updates of an LFP entry by LFP.append_new_intervals, in order
+        -> LFP
+        lfp_update_num: int                          # 1 for the first update of the entry, 2 for the next...
+        ---
+        -> AnalysisNwbfile                           # the analysis file written by this update
+        -> AnalysisNwbfile.proj(previous_analysis_file_name='analysis_file_name')  # the previous LFP file
+        previous_lfp_object_id: varchar(40)          # the NWB object ID of the LFP before this update
+        added_valid_times: longblob                  # the raw valid times added by this update
+        """
+
     def make(self, key):
+        parameters = self._get_filter_parameters(key)
+        if parameters is None:
+            return None
+        rawdata, sampling_rate, valid_times, filter_coeff, electrode_id_list, decimation = parameters
+        valid_times = valid_times.intervals
+
+        # if a previous run of this job crashed, resume filtering into the analysis file it created
+        checkpoint_file = AnalysisNwbfile.get_checkpoint_abs_path(
+            os.path.splitext(key['nwb_file_name'])[0] + '_lfp_checkpoint.json')
+        checkpoint = FirFilter.read_checkpoint(checkpoint_file)
+        if (checkpoint is not None and
+                checkpoint['signature'] == FirFilter.filter_signature(filter_coeff, valid_times,
+                                                                      electrode_id_list, decimation) and
+                os.path.exists(AnalysisNwbfile().get_abs_path(checkpoint['analysis_file_name']))):
+            lfp_file_name = checkpoint['analysis_file_name']
+            print(f'LFP: resuming filtering into {lfp_file_name}')
+        else:
+            lfp_file_name = AnalysisNwbfile().create(key['nwb_file_name'])
+
+        lfp_file_abspath = AnalysisNwbfile().get_abs_path(lfp_file_name)
+        # the number of filtering threads can be set with the NWB_DATAJOINT_FILTER_N_JOBS environment variable
+        n_jobs = int(os.getenv('NWB_DATAJOINT_FILTER_N_JOBS', 1))
+        lfp_object_id, timestamp_interval = FirFilter().filter_data_nwb(lfp_file_abspath, rawdata,
+                                                                        filter_coeff, valid_times,
+                                                                        electrode_id_list, decimation,
+                                                                        n_jobs=n_jobs,
+                                                                        checkpoint_file=checkpoint_file)
+
+        # now that the LFP is filtered and in the file, add the file to the AnalysisNwbfile table
+        AnalysisNwbfile().add(key['nwb_file_name'], lfp_file_name)
+
+        key['analysis_file_name'] = lfp_file_name
+        key['lfp_object_id'] = lfp_object_id
+        key['lfp_sampling_rate'] = sampling_rate // decimation
+
+        # finally, we need to censor the valid times to account for the downsampling
+        lfp_valid_times = interval_list_censor(valid_times, timestamp_interval)
+        # add an interval list for the LFP valid times, skipping duplicates
+        key['interval_list_name'] = 'lfp valid times'
+        IntervalList.insert1({'nwb_file_name': key['nwb_file_name'],
+                              'interval_list_name': key['interval_list_name'],
+                              'valid_times': lfp_valid_times}, replace=True)
+        self.insert1(key)
+
+    def append_new_intervals(self, key):
+        """Filter the raw valid times that the LFP does not cover yet and write them, together with the existing
+        LFP, to a new analysis file.
+
+        The raw valid times (intervals > 1 second long, as in make) are compared with the LFP valid times to find the
+        times that became valid since the LFP was made, e.g. because the raw data was extended or a bad interval was
+        repaired. The raw valid intervals that contain them are filtered again, so that the result is the same as
+        remaking the LFP; the previously filtered samples that are not affected are copied into the new analysis file
+        instead of being filtered again (see FirFilter.filter_data_nwb). The LFP entry and its valid times are
+        updated to point to the new file. The previous analysis file is kept, and the update is recorded in
+        LFP.LFPUpdate.
+
+        :param key: dict   restriction selecting one LFP entry (e.g. {'nwb_file_name': ...})
+        :return: numpy array with the raw valid times that were added, or None if the LFP was up to date
+        """
+        lfp_entry = (self & key).fetch1()
+        key = {'nwb_file_name': lfp_entry['nwb_file_name']}
+        filter_key = dict(key)
+        parameters = self._get_filter_parameters(filter_key)
+        if parameters is None:
+            return None
+        rawdata, sampling_rate, valid_times, filter_coeff, electrode_id_list, decimation = parameters
+        if (lfp_entry['filter_name'], lfp_entry['filter_sampling_rate']) != (filter_key['filter_name'],
+                                                                              filter_key['filter_sampling_rate']):
+            raise ValueError(f'LFP of {key["nwb_file_name"]} was made with filter {lfp_entry["filter_name"]} at '
+                             f'{lfp_entry["filter_sampling_rate"]} Hz; it must be remade instead of updated')
+
+        lfp_valid_times = IntervalList.fetch_interval_set(key['nwb_file_name'], lfp_entry['interval_list_name'],
+                                                          refresh=True)
+        new_valid_times, filter_times = self._get_intervals_to_update(valid_times, lfp_valid_times,
+                                                                      self.min_interval_length)
+        if len(new_valid_times) == 0:
+            print(f'LFP: the LFP of {key["nwb_file_name"]} covers all of the raw valid times')
+            return None
+        print(f'LFP: filtering {len(filter_times)} intervals with {len(new_valid_times)} new intervals '
+              f'({np.sum(np.diff(new_valid_times)):.1f} sec) of {key["nwb_file_name"]}')
+
+        previous_lfp = get_nwb_file(AnalysisNwbfile().get_abs_path(
+            lfp_entry['analysis_file_name'])).objects[lfp_entry['lfp_object_id']]
+        previous_electrode_ids = np.asarray(previous_lfp.electrodes.table.id[:])[previous_lfp.electrodes.data[:]]
+        if not np.array_equal(np.sort(previous_electrode_ids), electrode_id_list):
+            raise ValueError(f'The LFP electrodes of {key["nwb_file_name"]} have changed since the LFP was made; '
+                             'it must be remade instead of updated')
+
+        lfp_file_name = AnalysisNwbfile().create(key['nwb_file_name'])
+        lfp_file_abspath = AnalysisNwbfile().get_abs_path(lfp_file_name)
+        n_jobs = int(os.getenv('NWB_DATAJOINT_FILTER_N_JOBS', 1))
+        lfp_object_id, timestamp_interval = FirFilter().filter_data_nwb(lfp_file_abspath, rawdata,
+                                                                        filter_coeff, filter_times,
+                                                                        electrode_id_list, decimation,
+                                                                        n_jobs=n_jobs,
+                                                                        previous_eseries=previous_lfp)
+        AnalysisNwbfile().add(key['nwb_file_name'], lfp_file_name)
+
+        lfp_valid_times = interval_list_censor(lfp_valid_times | filter_times, timestamp_interval)
+        update_num = len(LFP.LFPUpdate & key) + 1
+        with self.connection.transaction:
+            IntervalList().update1({'nwb_file_name': key['nwb_file_name'],
+                                    'interval_list_name': lfp_entry['interval_list_name'],
+                                    'valid_times': lfp_valid_times})
+            LFP().update1({**key, 'analysis_file_name': lfp_file_name, 'lfp_object_id': lfp_object_id})
+            LFP.LFPUpdate().insert1({**key, 'lfp_update_num': update_num,
+                                     'analysis_file_name': lfp_file_name,
+                                     'previous_analysis_file_name': lfp_entry['analysis_file_name'],
+                                     'previous_lfp_object_id': lfp_entry['lfp_object_id'],
+                                     'added_valid_times': new_valid_times}, allow_direct_insert=True)
+        if len(LFPBand & key):
+            print(f'LFP: the LFPBand entries of {key["nwb_file_name"]} were computed from the previous LFP and must '
+                  'be remade to include the new intervals')
+        return new_valid_times
+
+    @staticmethod
+    def _get_intervals_to_update(valid_times, lfp_valid_times, min_interval_length):
+        """Return the raw valid times that the LFP does not cover yet (the parts longer than min_interval_length)
+        and the raw valid intervals that contain them, which are the ones to filter again.
+
+        :param valid_times: IntervalSet   the raw valid times
+        :param lfp_valid_times: IntervalSet   the valid times of the LFP
+        :param min_interval_length: float   the minimum length, in seconds, of the new times
+        :return: tuple of two numpy arrays of [start, stop] intervals
+        """
+        new_valid_times = (valid_times - lfp_valid_times).by_length(min_length=min_interval_length).intervals
+        intervals = valid_times.intervals
+        # each new interval is within one of the raw valid intervals
+        contains_new = np.zeros(len(intervals), dtype=bool)
+        contains_new[np.searchsorted(intervals[:, 0], new_valid_times[:, 0], side='right') - 1] = True
+        return new_valid_times, intervals[contains_new]
+
+    def _get_filter_parameters(self, key):
+        """Return the raw data, its sampling rate, its valid times longer than min_interval_length, the LFP filter
+        coefficients, the sorted LFP electrode IDs and the decimation for the LFP of the session in key. The name and
+        sampling rate of the filter are added to key.
+
+        :return: tuple, or None if there is no LFP filter for the sampling rate of the raw data
+        """
         # get the NWB object with the data; FIX: change to fetch with additional infrastructure
         rawdata = Raw().nwb_object(key)
         sampling_rate, interval_list_name = (Raw() & key).fetch1(
             'sampling_rate', 'interval_list_name')
         sampling_rate = int(np.round(sampling_rate))
 
-        valid_times = (IntervalList() & {'nwb_file_name': key['nwb_file_name'],
-                                         'interval_list_name': interval_list_name}).fetch1('valid_times')
+        # fetched again rather than cached, since the LFP is updated when the raw valid times change
+        raw_valid_times = IntervalList.fetch_interval_set(key['nwb_file_name'], interval_list_name, refresh=True)
         # keep only the intervals > 1 second long
-        min_interval_length = 1.0
-        valid = []
-        for count, interval in enumerate(valid_times):
-            if interval[1] - interval[0] > min_interval_length:
-                valid.append(count)
-        valid_times = valid_times[valid]
-        print(f'LFP: found {len(valid)} of {count+1} intervals > {min_interval_length} sec long.')
+        valid_times = raw_valid_times.by_length(min_length=self.min_interval_length)
+        print(f'LFP: found {len(valid_times)} of {len(raw_valid_times)} intervals > {self.min_interval_length} '
+              'sec long.')
 
         # target 1 KHz sampling rate
         decimation = sampling_rate // 1000
@@ -281,41 +439,19 @@ class LFP(dj.Imported):
                   {'filter_sampling_rate': sampling_rate}).fetch(as_dict=True)
 
         # there should only be one filter that matches, so we take the first of the dictionaries
-        key['filter_name'] = filter[0]['filter_name']
-        key['filter_sampling_rate'] = filter[0]['filter_sampling_rate']
-
-        filter_coeff = filter[0]['filter_coeff']
-        if len(filter_coeff) == 0:
+        if len(filter) == 0 or len(filter[0]['filter_coeff']) == 0:
             print(
                 f'Error in LFP: no filter found with data sampling rate of {sampling_rate}')
             return None
+        key['filter_name'] = filter[0]['filter_name']
+        key['filter_sampling_rate'] = filter[0]['filter_sampling_rate']
+        filter_coeff = filter[0]['filter_coeff']
+
         # get the list of selected LFP Channels from LFPElectrode
         electrode_keys = (LFPSelection.LFPElectrode & key).fetch('KEY')
         electrode_id_list = list(k['electrode_id'] for k in electrode_keys)
         electrode_id_list.sort()
-
-        lfp_file_name = AnalysisNwbfile().create(key['nwb_file_name'])
-
-        lfp_file_abspath = AnalysisNwbfile().get_abs_path(lfp_file_name)
-        lfp_object_id, timestamp_interval = FirFilter().filter_data_nwb(lfp_file_abspath, rawdata,
-                                                                        filter_coeff, valid_times,
-                                                                        electrode_id_list, decimation)
-
-        # now that the LFP is filtered and in the file, add the file to the AnalysisNwbfile table
-        AnalysisNwbfile().add(key['nwb_file_name'], lfp_file_name)
-
-        key['analysis_file_name'] = lfp_file_name
-        key['lfp_object_id'] = lfp_object_id
-        key['lfp_sampling_rate'] = sampling_rate // decimation
-
-        # finally, we need to censor the valid times to account for the downsampling
-        lfp_valid_times = interval_list_censor(valid_times, timestamp_interval)
-        # add an interval list for the LFP valid times, skipping duplicates
-        key['interval_list_name'] = 'lfp valid times'
-        IntervalList.insert1({'nwb_file_name': key['nwb_file_name'],
-                              'interval_list_name': key['interval_list_name'],
-                              'valid_times': lfp_valid_times}, replace=True)
-        self.insert1(key)
+        return rawdata, sampling_rate, valid_times, filter_coeff, electrode_id_list, decimation
 
     def nwb_object(self, key):
         # return the NWB object in the raw NWB file
@@ -443,43 +579,104 @@ class LFPBand(dj.Computed):
     """
 
     def make(self, key):
-        # get the NWB object with the lfp data; FIX: change to fetch with additional infrastructure
-        lfp_object = (LFP() & {'nwb_file_name': key['nwb_file_name']}).fetch_nwb()[
-            0]['lfp']
-
         # get the electrodes to be filtered and their references
-        lfp_band_elect_id, lfp_band_ref_id = (LFPBandSelection().LFPBandElectrode() & key).fetch('electrode_id', 'reference_elect_id')
+        lfp_band_elect_id, lfp_band_ref_id = self._get_band_electrodes(key)
+        lfp_band_valid_times = self._get_band_valid_times(key)
+
+        # get the NWB object with the lfp data; FIX: change to fetch with additional infrastructure
+        lfp_object = (LFP() & {'nwb_file_name': key['nwb_file_name']}).fetch_nwb()[0]['lfp']
+        timestamps, lfp_data, lfp_band_elect_index = self._read_referenced_lfp(
+            lfp_object, lfp_band_elect_id, lfp_band_ref_id, [lfp_band_valid_times])
+        self._filter_band(key, timestamps, lfp_data, lfp_band_elect_id, lfp_band_elect_index, lfp_band_valid_times)
 
-        # sort the electrodes to make sure they are in ascending order
+    def populate_multiband(self, *restrictions, reserve_jobs=False):
+        '''
+        Populates the pending LFPBand entries, sharing one read of the LFP between the bands (e.g. theta, gamma and
+        ripple) that filter the same electrodes with the same references over the same interval list.
+        The pending keys are grouped by session, target interval list, electrodes and references. The LFP is read and
+        referenced once for each group, over the span of all of the group's valid times, all of the group's filters
+        are run over it, and each band is written to its own analysis file and inserted in its own transaction, as
+        in make(). The LFP of a group is freed before the next group is read.
+        :param restrictions: optional restrictions on the LFPBandSelection entries to populate, as for populate()
+        :param reserve_jobs: if True, reserve each key in the jobs table of the schema, as populate() does, so that
+        several processes can populate the same entries; keys reserved by another process are skipped
+        :return: none
+        '''
+        keys = ((self.key_source & dj.AndList(restrictions)) - self).fetch('KEY')
+        # group the keys that can share a referenced copy of the LFP
+        groups = dict()
+        for key in keys:
+            lfp_band_elect_id, lfp_band_ref_id = self._get_band_electrodes(key)
+            group_key = (key['nwb_file_name'], key['target_interval_list_name'],
+                         tuple(lfp_band_elect_id), tuple(lfp_band_ref_id))
+            groups.setdefault(group_key, []).append(key)
+
+        for (nwb_file_name, interval_list_name, lfp_band_elect_id, lfp_band_ref_id), group in groups.items():
+            if reserve_jobs:
+                group = [key for key in group if schema.jobs.reserve(self.table_name, key)]
+            if not group:
+                continue
+            print(f'LFPBand: filtering {len(group)} bands of {nwb_file_name}, {interval_list_name}')
+            lfp_band_elect_id, lfp_band_ref_id = np.asarray(lfp_band_elect_id), np.asarray(lfp_band_ref_id)
+            done = 0
+            try:
+                lfp_band_valid_times = [self._get_band_valid_times(key) for key in group]
+                lfp_object = (LFP() & {'nwb_file_name': nwb_file_name}).fetch_nwb()[0]['lfp']
+                timestamps, lfp_data, lfp_band_elect_index = self._read_referenced_lfp(
+                    lfp_object, lfp_band_elect_id, lfp_band_ref_id,
+                    [valid_times for valid_times in lfp_band_valid_times if len(valid_times)])
+                for key, band_valid_times in zip(group, lfp_band_valid_times):
+                    with self.connection.transaction:
+                        self._filter_band(key, timestamps, lfp_data, lfp_band_elect_id, lfp_band_elect_index,
+                                          band_valid_times, allow_direct_insert=True)
+                    if reserve_jobs:
+                        schema.jobs.complete(self.table_name, key)
+                    done += 1
+            except Exception as error:
+                if reserve_jobs:
+                    # record the error for the failed key and release the keys of the group that were not filtered
+                    schema.jobs.error(self.table_name, group[done],
+                                      error_message=f'{error.__class__.__name__}: {error}')
+                    for key in group[done + 1:]:
+                        schema.jobs.complete(self.table_name, key)
+                raise
+            # free the LFP of this group before reading the next one
+            del timestamps, lfp_data
+
+    @staticmethod
+    def _get_band_electrodes(key):
+        # get the electrodes to be filtered and their references, sorted to make sure the electrodes are in
+        # ascending order
+        lfp_band_elect_id, lfp_band_ref_id = (LFPBandSelection().LFPBandElectrode() & key).fetch(
+            'electrode_id', 'reference_elect_id')
         lfp_band_elect_id = np.asarray(lfp_band_elect_id)
         lfp_band_ref_id = np.asarray(lfp_band_ref_id)
         lfp_sort_order = np.argsort(lfp_band_elect_id)
-        lfp_band_elect_id = lfp_band_elect_id[lfp_sort_order]
-        lfp_band_ref_id = lfp_band_ref_id[lfp_sort_order]
+        return lfp_band_elect_id[lfp_sort_order], lfp_band_ref_id[lfp_sort_order]
 
-        lfp_sampling_rate = (LFP() & {'nwb_file_name': key['nwb_file_name']}).fetch1(
-            'lfp_sampling_rate')
-        interval_list_name, lfp_band_sampling_rate = (LFPBandSelection() & key).fetch1('target_interval_list_name',
-                                                                                       'lfp_band_sampling_rate')
-        valid_times = (IntervalList() & {'nwb_file_name': key['nwb_file_name'],
-                       'interval_list_name': interval_list_name}).fetch1('valid_times')
+    @staticmethod
+    def _get_band_valid_times(key):
+        interval_list_name = (LFPBandSelection() & key).fetch1('target_interval_list_name')
+        valid_times = IntervalList.fetch_interval_set(key['nwb_file_name'], interval_list_name)
         # the valid_times for this interval may be slightly beyond the valid times for the lfp itself,
         # so we have to intersect the two
         lfp_interval_list = (LFP() & {'nwb_file_name': key['nwb_file_name']}).fetch1('interval_list_name')
-        lfp_valid_times = (IntervalList() & {'nwb_file_name': key['nwb_file_name'],
-                                             'interval_list_name': lfp_interval_list}).fetch1('valid_times')
+        lfp_valid_times = IntervalList.fetch_interval_set(key['nwb_file_name'], lfp_interval_list)
         min_length = (LFPBandSelection & key).fetch1('min_interval_len')
-        lfp_band_valid_times = interval_list_intersect(valid_times, lfp_valid_times, min_length=min_length)
-
-        filter_name, filter_sampling_rate, lfp_band_sampling_rate = (LFPBandSelection() & key).fetch1(
-            'filter_name', 'filter_sampling_rate', 'lfp_band_sampling_rate')
-
-        decimation = int(lfp_sampling_rate) // lfp_band_sampling_rate
+        return (valid_times & lfp_valid_times).by_length(min_length=min_length).intervals
 
+    @staticmethod
+    def _read_referenced_lfp(lfp_object, lfp_band_elect_id, lfp_band_ref_id, valid_times_list):
+        '''
+        Reads the LFP samples that span all of the valid times in valid_times_list for the electrodes to be filtered
+        and their references, and subtracts the references.
+        :return: timestamps, referenced lfp data, indices of the electrodes to be filtered in lfp data
+        '''
         # load in the timestamps
         timestamps = np.asarray(lfp_object.timestamps)
         # get the indices of the first timestamp and the last timestamp that are within the valid times
-        included_indices = interval_list_contains_ind(lfp_band_valid_times, timestamps)
+        included_indices = interval_list_contains_ind(np.concatenate(valid_times_list), timestamps)
+        included_indices = np.asarray([np.min(included_indices), np.max(included_indices)])
         # pad the indices by 1 on each side to avoid message in filter_data
         if included_indices[0] > 0:
             included_indices[0] -= 1
@@ -488,20 +685,36 @@ class LFPBand(dj.Computed):
 
         timestamps = timestamps[included_indices[0]:included_indices[-1]]
 
-        # load all the data to speed filtering
-        lfp_data = np.asarray(lfp_object.data[included_indices[0]:included_indices[-1],:],
-                              dtype=type(lfp_object.data[0][0]))
-
         # get the indices of the electrodes to be filtered and the references
-        lfp_band_elect_index = get_electrode_indices(
-            lfp_object, lfp_band_elect_id)
-        lfp_band_ref_index = get_electrode_indices(lfp_object, lfp_band_ref_id)
+        lfp_band_elect_index = np.asarray(get_electrode_indices(lfp_object, lfp_band_elect_id))
+        has_ref = np.asarray(lfp_band_ref_id) != -1
+        lfp_band_ref_index = np.asarray(get_electrode_indices(lfp_object, np.asarray(lfp_band_ref_id)[has_ref]),
+                                        dtype=int)
+
+        # load only the channels that are filtered or used as references (in increasing order, as h5py requires)
+        channel_index = np.unique(np.concatenate((lfp_band_elect_index, lfp_band_ref_index)))
+        lfp_channels = np.asarray(lfp_object.data[included_indices[0]:included_indices[-1], channel_index],
+                                  dtype=lfp_object.data.dtype)
+
+        # copy the channels to be filtered into the output and subtract off all the references at once
+        elect_column = np.searchsorted(channel_index, lfp_band_elect_index)
+        ref_column = np.searchsorted(channel_index, lfp_band_ref_index)
+        lfp_data = np.empty((len(timestamps), len(lfp_band_elect_index)), dtype=lfp_channels.dtype)
+        np.take(lfp_channels, elect_column, axis=1, out=lfp_data)
+        lfp_data[:, has_ref] -= lfp_channels[:, ref_column]
+        # the columns of lfp_data are the electrodes to be filtered, in order
+        lfp_band_elect_index = np.arange(len(lfp_band_elect_index))
+        return timestamps, lfp_data, lfp_band_elect_index
+
+    def _filter_band(self, key, timestamps, lfp_data, lfp_band_elect_id, lfp_band_elect_index,
+                     lfp_band_valid_times, **insert_kwargs):
+        lfp_sampling_rate = (LFP() & {'nwb_file_name': key['nwb_file_name']}).fetch1(
+            'lfp_sampling_rate')
+        interval_list_name, filter_name, filter_sampling_rate, lfp_band_sampling_rate = \
+            (LFPBandSelection() & key).fetch1('target_interval_list_name', 'filter_name', 'filter_sampling_rate',
+                                              'lfp_band_sampling_rate')
 
-        # subtract off the references for the selected channels
-        for index, elect_index in enumerate(lfp_band_elect_index):
-            if lfp_band_ref_id[index] != -1:
-                lfp_data[:, elect_index] = lfp_data[:, elect_index] - \
-                    lfp_data[:, lfp_band_ref_index[index]]
+        decimation = int(lfp_sampling_rate) // lfp_band_sampling_rate
 
         # get the LFP filter that matches the raw data
         filter = (FirFilter() & {'filter_name': filter_name} &
@@ -562,7 +775,7 @@ class LFPBand(dj.Computed):
             assert np.isclose(tmp_valid_times[0], lfp_band_valid_times).all(), \
                 'previously saved lfp band times do not match current times'
 
-        self.insert1(key)
+        self.insert1(key, **insert_kwargs)
 
     def fetch_nwb(self, *attrs, **kwargs):
         return fetch_nwb(self, (AnalysisNwbfile, 'analysis_file_abs_path'), *attrs, **kwargs)
@@ -1,17 +1,182 @@
 # code to define filters that can be applied to continuous time data
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import datajoint as dj
 import ghostipy as gsp
 import matplotlib.pyplot as plt
 import numpy as np
 import pynwb
+import scipy.fft
 import scipy.signal as signal
-import psutil
 import warnings
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import DataChunkIterator
 
-from .nwb_helper_fn import get_electrode_indices
+from .nwb_helper_fn import get_electrode_indices, invalid_electrode_index
 
 schema = dj.schema('common_filter')
 
+# the convolution engines for FirFilter.filter_backend: ghostipy's FFT convolution, a polyphase decimating FIR
+# filter that computes only the output samples that are kept, and an FFT overlap-save convolution for long filters
+FILTER_BACKENDS = ('ghostipy', 'polyphase', 'overlap_save')
+
+# memory budget for filtering used when neither NWB_DATAJOINT_FILTER_MEMORY nor dj.config['custom'] sets one
+DEFAULT_FILTER_MEMORY_BUDGET = '4G'
+
+_memory_units = {'k': 1e3, 'M': 1e6, 'G': 1e9}
+
+
+def memory_to_bytes(memory):
+    """Convert a memory size such as '500M' or '4G' (ending with 'k', 'M' or 'G') or a number of bytes to bytes"""
+    if not isinstance(memory, str):
+        return int(memory)
+    suffix = memory[-1]
+    if suffix not in _memory_units:
+        raise ValueError(f"memory must be a number of bytes or end with 'k', 'M' or 'G', got {memory}")
+    return int(float(memory[:-1]) * _memory_units[suffix])
+
+
+def get_filter_memory_budget():
+    """Return the memory budget in bytes of each filtering worker (e.g. each populate process).
+
+    The budget is read from the NWB_DATAJOINT_FILTER_MEMORY environment variable, then from
+    dj.config['custom']['filter_memory_budget'], and is DEFAULT_FILTER_MEMORY_BUDGET if neither is set.
+    Either can be a number of bytes or a string such as '4G'.
+    """
+    memory_budget = os.getenv('NWB_DATAJOINT_FILTER_MEMORY')
+    if memory_budget is None:
+        memory_budget = dj.config.get('custom', {}).get('filter_memory_budget', DEFAULT_FILTER_MEMORY_BUDGET)
+    return memory_to_bytes(memory_budget)
+
+
+def plan_filter_blocks(n_samples, n_channels, data_size, n_taps, decimation, n_jobs=1, channel_block_size=None,
+                       memory_budget=None, allocated_memory=0):
+    """Choose the block of time x channels filtered at once by each of n_jobs threads so that the peak memory
+    stays within the budget, and print the plan.
+
+    The memory of a block is the copy of the input, the float64 filter output and its cast to the data type,
+    plus the two complex FFT buffers that ghostipy allocates per channel.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of samples in the longest interval to be filtered.
+    n_channels : int
+        Number of channels to be filtered.
+    data_size : int
+        Size in bytes of one sample of the data.
+    n_taps : int
+        Number of filter coefficients.
+    decimation : int
+        Decimation factor.
+    n_jobs : int, optional
+        Number of blocks filtered at the same time, by default 1.
+    channel_block_size : int, optional
+        Number of channels per block. Defaults to splitting the channels evenly across the n_jobs threads, reduced
+        if the FFT buffers of that many channels would take more than half of the budget.
+    memory_budget : str or int, optional
+        Memory available to all the threads, e.g. '4G'. Defaults to get_filter_memory_budget().
+    allocated_memory : int, optional
+        Memory in bytes that is already allocated for the filtering (e.g. input and output arrays held in memory)
+        and counts against the budget, by default 0.
+
+    Returns
+    -------
+    time_block_samples : int
+        Number of input samples per block (a multiple of decimation).
+    channel_block_size : int
+        Number of channels per block.
+    peak_memory : int
+        Planned peak memory in bytes.
+    """
+    if memory_budget is None:
+        memory_budget = get_filter_memory_budget()
+    memory_budget = memory_to_bytes(memory_budget)
+    n_jobs = max(n_jobs, 1)
+    n_samples = max(int(n_samples), 1)
+
+    # ghostipy's default FFT length
+    nfft = 65536
+    while nfft < 10 * n_taps:
+        nfft *= 4
+    fft_bytes_per_channel = 2 * nfft * 16
+    # input copy, float64 output and output cast for each input sample of one channel
+    bytes_per_sample = data_size + (8 + data_size) / decimation
+
+    job_budget = max(memory_budget - allocated_memory, 0) / n_jobs
+    if channel_block_size is None:
+        channel_block_size = int(np.ceil(n_channels / n_jobs))
+        channel_block_size = min(channel_block_size, int(job_budget / 2 // fft_bytes_per_channel))
+    channel_block_size = max(min(channel_block_size, n_channels), 1)
+
+    time_block_samples = (job_budget - channel_block_size * fft_bytes_per_channel) / \
+        (channel_block_size * bytes_per_sample)
+    # there is no need for blocks shorter than one FFT or longer than the longest interval
+    time_block_samples = int(min(max(time_block_samples, nfft), n_samples))
+    time_block_samples = max(time_block_samples // decimation, 1) * decimation
+
+    peak_memory = int(allocated_memory + n_jobs * channel_block_size *
+                      (fft_bytes_per_channel + time_block_samples * bytes_per_sample))
+    print(f'Filtering in blocks of {time_block_samples} samples x {channel_block_size} channels with {n_jobs} '
+          f'thread(s); planned peak memory {peak_memory / 1e9:.2f} GB of a {memory_budget / 1e9:.2f} GB budget')
+    if peak_memory > memory_budget:
+        warnings.warn(f'The planned peak memory of filtering ({peak_memory / 1e9:.2f} GB) is larger than the '
+                      f'memory budget ({memory_budget / 1e9:.2f} GB)')
+    return time_block_samples, channel_block_size, peak_memory
+
+
+def _polyphase_convolve(data, filter_coeff, first_ind, last_ind, decimation, fft_threads=1):
+    """Samples first_ind, first_ind + decimation, ... <= last_ind of the full convolution of data (along axis 0)
+    with the filter, computing only those samples with a polyphase decimating FIR filter (scipy.signal.upfirdn).
+    fft_threads is unused."""
+    n_taps = len(filter_coeff)
+    n_output = (last_ind - first_ind) // decimation + 1
+    # output sample k needs data[k - n_taps + 1:k + 1], so drop the data before first_ind - n_taps + 1, then pad the
+    # front with zeros so that first_ind lands on a multiple of the decimation factor
+    data_start = first_ind - n_taps + 1
+    n_pad = max(-data_start, 0) + (-(n_taps - 1)) % decimation
+    data = data[max(data_start, 0):last_ind + 1]
+    if n_pad > 0:
+        data = np.concatenate((np.zeros((n_pad,) + data.shape[1:], dtype=data.dtype), data))
+    first_output = (n_taps - 1 + (-(n_taps - 1)) % decimation) // decimation
+    filtered = signal.upfirdn(filter_coeff, data, up=1, down=decimation, axis=0)
+    return filtered[first_output:first_output + n_output]
+
+
+def _overlap_save_convolve(data, filter_coeff, first_ind, last_ind, decimation, fft_threads=1):
+    """Samples first_ind, first_ind + decimation, ... <= last_ind of the full convolution of data (along axis 0)
+    with the filter, computed by FFT overlap-save convolution. This is fastest for long filters."""
+    n_taps = len(filter_coeff)
+    n_samples = data.shape[0]
+    nfft = scipy.fft.next_fast_len(8 * n_taps)
+    # number of valid output samples per FFT segment
+    segment_length = nfft - n_taps + 1
+    filter_fft = scipy.fft.rfft(filter_coeff, nfft)
+    filter_fft = filter_fft.reshape((-1,) + (1,) * (data.ndim - 1))
+    filtered = np.empty(((last_ind - first_ind) // decimation + 1,) + data.shape[1:])
+    segment = np.zeros((nfft,) + data.shape[1:])
+    output_ind = first_ind
+    n_written = 0
+    while output_ind <= last_ind:
+        segment_stop = min(output_ind + segment_length, last_ind + 1)
+        # output samples output_ind:segment_stop need data[output_ind - n_taps + 1:segment_stop]
+        data_start = output_ind - n_taps + 1
+        segment[:] = 0
+        segment_data = data[max(data_start, 0):min(data_start + nfft, n_samples)]
+        offset = max(-data_start, 0)
+        segment[offset:offset + len(segment_data)] = segment_data
+        convolved = scipy.fft.irfft(scipy.fft.rfft(segment, axis=0, workers=fft_threads) * filter_fft, nfft,
+                                    axis=0, workers=fft_threads)
+        segment_output = convolved[n_taps - 1:n_taps - 1 + segment_stop - output_ind:decimation]
+        filtered[n_written:n_written + len(segment_output)] = segment_output
+        n_written += len(segment_output)
+        # the next output sample is a whole number of decimation steps after the last one
+        output_ind += len(segment_output) * decimation
+    return filtered
+
 
 @schema
 class FirFilter(dj.Manual):
@@ -28,6 +193,8 @@ class FirFilter(dj.Manual):
     filter_band_edges: blob            # numpy array containing the filter bands (redundant with individual parameters)
     filter_coeff: blob                 # numpy array containing the filter coefficients
     """
+    # the convolution engine used by filter_data and filter_data_nwb; one of FILTER_BACKENDS
+    filter_backend = 'ghostipy'
 
     def add_filter(self, filter_name, fs, filter_type, band_edges, comments=''):
         # add an FIR bandpass filter of the specified type ('lowpass', 'highpass', or 'bandpass').
@@ -128,7 +295,8 @@ class FirFilter(dj.Manual):
         return self.calc_filter_delay(filter['filter_coeff'])
 
     def filter_data_nwb(self, analysis_file_abs_path, eseries, filter_coeff, valid_times, electrode_ids,
-                        decimation):
+                        decimation, n_jobs=1, channel_block_size=None, compression=None, compression_opts=None,
+                        checkpoint_file=None, memory_budget=None, previous_eseries=None):
         """
         :param analysis_nwb_file_name: str   full path to previously created analysis nwb file where filtered data
         should be stored. This also has the name of the original NWB file where the data will be taken from
@@ -137,11 +305,30 @@ class FirFilter(dj.Manual):
         :param valid_times: 2D numpy array with start and stop times of intervals to be filtered
         :param electrode_ids: list of electrode_ids to filter
         :param decimation: int decimation factor
+        :param n_jobs: int   number of threads that filter blocks of channels in parallel (default 1)
+        :param channel_block_size: int   number of channels filtered by each thread at a time; defaults to splitting
+        the channels evenly across the n_jobs threads, or fewer if that does not fit in the memory budget
+        :param compression: str   optional HDF5 compression filter for the filtered data (e.g. 'gzip' or 'lzf')
+        :param compression_opts: optional settings for the compression filter (e.g. the gzip level)
+        :param checkpoint_file: str   optional path to a JSON file that records the intervals that have been written.
+        If the file refers to this analysis file and the same filtering parameters, the intervals it lists are
+        skipped, so a crashed job resumes at the last finished interval. The file is removed when filtering is done.
+        :param memory_budget: str or int   memory available to this call, shared by the n_jobs threads (e.g. '4G');
+        defaults to the configured budget (see get_filter_memory_budget)
+        :param previous_eseries: optional electrical series with data filtered earlier from the same eseries with the
+        same filter, electrodes and decimation (e.g. by an earlier call of this function). Its samples are copied
+        into the output in time order with the intervals of valid_times. An interval that continues an interval of
+        the previous data (i.e. starts with its samples) keeps the previous samples that did not depend on the end
+        of that interval and is filtered, with its full history, from there on; the other previous samples within
+        the intervals of valid_times are replaced by the newly filtered ones.
         :return: The NWB object id of the filtered data (str), list containing first and last timestamp
 
         This function takes data and timestamps from an NWB electrical series and filters them using the ghostipy
         package, saving the result as a new electricalseries in the nwb_file_name, which should have previously been
         created and linked to the original NWB file using common_session.AnalysisNwbfile.create()
+
+        The filtered data are written into a chunked HDF5 dataset one hyperslab (time block x channel block) at a
+        time, with the block sizes chosen by plan_filter_blocks to fit the memory budget.
         """
 
         data_on_disk = eseries.data
@@ -151,25 +338,23 @@ class FirFilter(dj.Manual):
         # find the
         time_axis = 0 if data_on_disk.shape[0] == n_samples else 1
         electrode_axis = 1 - time_axis
-        n_electrodes = data_on_disk.shape[electrode_axis]
-        input_dim_restrictions = [None] * n_dim
 
         # to get the input dimension restrictions we need to look at the electrode table for the eseries and get
         # the indices from that
-        input_dim_restrictions[electrode_axis] = np.s_[
-            get_electrode_indices(eseries, electrode_ids)]
+        electrode_indices = np.asarray(get_electrode_indices(eseries, electrode_ids))
 
         indices = []
+        interval_lengths = []
         output_shape_list = [0] * n_dim
         output_shape_list[electrode_axis] = len(electrode_ids)
-        output_offsets = [0]
 
-        timestamp_size = timestamps_on_disk[0].itemsize
         timestamp_dtype = timestamps_on_disk[0].dtype
-        data_size = data_on_disk[0][0].itemsize
         data_dtype = data_on_disk[0][0].dtype
+        data_size = data_on_disk[0][0].itemsize
 
         filter_delay = self.calc_filter_delay(filter_coeff)
+        input_dim_restrictions = [None] * n_dim
+        input_dim_restrictions[electrode_axis] = np.s_[electrode_indices]
         for a_start, a_stop in valid_times:
             if a_start < timestamps_on_disk[0]:
                 warnings.warn(f'Interval start time {a_start} is smaller than first timestamp {timestamps_on_disk[0]}, '
@@ -193,91 +378,296 @@ class FirFilter(dj.Manual):
                 ds=decimation,
                 input_dim_restrictions=input_dim_restrictions
             )
-            output_offsets.append(output_offsets[-1] + shape[time_axis])
-            output_shape_list[time_axis] += shape[time_axis]
-
-        # open the nwb file to create the dynamic table region and electrode series, then write and close the file
-        with pynwb.NWBHDF5IO(path=analysis_file_abs_path, mode="a", load_namespaces=True) as io:
-            nwbf = io.read()
-            # get the indices of the electrodes in the electrode table
-            elect_ind = get_electrode_indices(nwbf, electrode_ids)
-
-            electrode_table_region = nwbf.create_electrode_table_region(
-                elect_ind, 'filtered electrode table')
-            eseries_name = 'filtered data'
-            es = pynwb.ecephys.ElectricalSeries(
-                name=eseries_name,
-                data=np.empty(tuple(output_shape_list), dtype=data_dtype),
-                electrodes=electrode_table_region,
-                timestamps=np.empty(output_shape_list[time_axis])
-            )
-            # Add the electrical series to the scratch area
-            nwbf.add_scratch(es)
-            io.write(nwbf)
+            interval_lengths.append(shape[time_axis])
+        indices = np.array(indices, ndmin=2)
 
-            # reload the NWB file to get the h5py objects for the data and the timestamps
+        # the output is made of segments of samples, each either filtered from an interval of the eseries or copied
+        # from previous_eseries: (source, start index, stop index, index of the first output sample of the interval,
+        # number of output samples)
+        segments = [('eseries', start, stop, 0, n_output) for (start, stop), n_output in zip(indices, interval_lengths)]
+        if previous_eseries is not None:
+            previous_data = previous_eseries.data
+            previous_timestamps = np.asarray(previous_eseries.timestamps[:])
+            previous_electrode_indices = np.asarray(get_electrode_indices(previous_eseries, electrode_ids))
+            if np.any(previous_electrode_indices == invalid_electrode_index):
+                raise ValueError('previous_eseries does not contain all of the electrodes to filter')
+            segments = self._merge_previous_segments(segments, timestamps_on_disk, previous_timestamps, decimation,
+                                                     filter_delay)
+        output_offsets = np.cumsum([0] + [n_output for _, _, _, _, n_output in segments])
+        output_shape_list[time_axis] = int(output_offsets[-1])
+
+        # split the data into the blocks of time and channels that are filtered and written by each thread
+        time_block_samples, channel_block_size, _ = plan_filter_blocks(
+            np.max(indices[:, 1] - indices[:, 0]), len(electrode_ids), data_size, len(filter_coeff), decimation,
+            n_jobs=n_jobs, channel_block_size=channel_block_size, memory_budget=memory_budget)
+        channel_blocks = [(block_start, min(block_start + channel_block_size, len(electrode_ids)))
+                          for block_start in range(0, len(electrode_ids), channel_block_size)]
+        # share the FFT threads of ghostipy between the blocks filtered at the same time
+        fft_threads = max(os.cpu_count() // max(n_jobs, 1), 1)
+
+        signature = self.filter_signature(filter_coeff, valid_times, electrode_ids, decimation,
+                                          previous_object_id=getattr(previous_eseries, 'object_id', None))
+        checkpoint = self.read_checkpoint(checkpoint_file)
+        if (checkpoint is not None and checkpoint['signature'] == signature and
+                checkpoint['analysis_file_name'] == os.path.basename(analysis_file_abs_path)):
+            object_id = checkpoint['object_id']
+            completed_intervals = set(checkpoint['completed_intervals'])
+            print(f'Resuming filtering: {len(completed_intervals)} of {len(segments)} intervals already written')
+        else:
+            completed_intervals = set()
+            # chunk along the channels by block so that each thread writes whole chunks
+            data_chunks = [0] * n_dim
+            data_chunks[time_axis] = max(min(output_shape_list[time_axis], 16384), 1)
+            data_chunks[electrode_axis] = channel_block_size
+            # open the nwb file to create the dynamic table region and electrode series, then write and close the
+            # file. The datasets are allocated empty (by iterators with no data) and filled in below.
             with pynwb.NWBHDF5IO(path=analysis_file_abs_path, mode="a", load_namespaces=True) as io:
                 nwbf = io.read()
-                es = nwbf.objects[es.object_id]
-                filtered_data = es.data
-                new_timestamps = es.timestamps
-                indices = np.array(indices, ndmin=2)
-                # Filter and write the output dataset
-                ts_offset = 0
-
-                print('Filtering data')
-                for ii, (start, stop) in enumerate(indices):
-                    # calculate the size of the timestamps and the data and determine whether they
-                    # can be loaded into < 90% of available RAM
-                    mem = psutil.virtual_memory()
-                    interval_samples = stop-start
-                    if interval_samples * (timestamp_size + n_electrodes*data_size) < 0.9 * mem.available:
-                        print(f'Interval {ii}: loading data into memory')
-                        timestamps = np.asarray(timestamps_on_disk[start:stop], dtype=timestamp_dtype)
-                        if time_axis == 0:
-                            data = np.asarray(data_on_disk[start:stop, :], dtype=data_dtype)
-                        else:
-                            data = np.asarray(data_on_disk[:, start:stop], dtype=data_dtype)
-                        extracted_ts = timestamps[0::decimation]
-                        new_timestamps[ts_offset:ts_offset + len(extracted_ts)] = extracted_ts
-                        ts_offset += len(extracted_ts)
-                        # filter the data
-                        gsp.filter_data_fir(data,
-                                            filter_coeff,
-                                            axis=time_axis,
-                                            input_index_bounds=[0, interval_samples-1],
-                                            output_index_bounds=[
-                                                filter_delay, filter_delay + stop - start],
-                                            ds=decimation,
-                                            input_dim_restrictions=input_dim_restrictions,
-                                            outarray=filtered_data,
-                                            output_offset=output_offsets[ii])
-                    else:
-                        print(f'Interval {ii}: leaving data on disk')
-                        data = data_on_disk
-                        timestamps = timestamps_on_disk
-                        extracted_ts = timestamps[start:stop:decimation]
-                        new_timestamps[ts_offset:ts_offset + len(extracted_ts)] = extracted_ts
-                        ts_offset += len(extracted_ts)
-                        # filter the data
-                        gsp.filter_data_fir(data,
-                                            filter_coeff,
-                                            axis=time_axis,
-                                            input_index_bounds=[start, stop],
-                                            output_index_bounds=[
-                                                filter_delay, filter_delay + stop - start],
-                                            ds=decimation,
-                                            input_dim_restrictions=input_dim_restrictions,
-                                            outarray=filtered_data,
-                                            output_offset=output_offsets[ii])
-
-                start_end = [new_timestamps[0], new_timestamps[-1]]
-
+                # get the indices of the electrodes in the electrode table
+                elect_ind = get_electrode_indices(nwbf, electrode_ids)
+
+                electrode_table_region = nwbf.create_electrode_table_region(
+                    elect_ind, 'filtered electrode table')
+                eseries_name = 'filtered data'
+                es = pynwb.ecephys.ElectricalSeries(
+                    name=eseries_name,
+                    data=H5DataIO(DataChunkIterator(data=None, maxshape=tuple(output_shape_list), dtype=data_dtype),
+                                  chunks=tuple(data_chunks), compression=compression,
+                                  compression_opts=compression_opts),
+                    electrodes=electrode_table_region,
+                    timestamps=H5DataIO(DataChunkIterator(data=None, maxshape=(output_shape_list[time_axis],),
+                                                          dtype=timestamp_dtype),
+                                        chunks=(data_chunks[time_axis],))
+                )
+                # Add the electrical series to the scratch area
+                nwbf.add_scratch(es)
                 io.write(nwbf)
+            object_id = es.object_id
+            self.write_checkpoint(checkpoint_file, analysis_file_abs_path, object_id, signature, completed_intervals)
 
-        return es.object_id, start_end
-
-    def filter_data(self, timestamps, data, filter_coeff, valid_times, electrodes, decimation):
+        # reload the NWB file to get the h5py objects for the data and the timestamps
+        with pynwb.NWBHDF5IO(path=analysis_file_abs_path, mode="a", load_namespaces=True) as io:
+            nwbf = io.read()
+            es = nwbf.objects[object_id]
+            filtered_data = es.data
+            new_timestamps = es.timestamps
+
+            print('Filtering data')
+            with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+                for ii, (source, start, stop, first_output, n_output) in enumerate(segments):
+                    if ii in completed_intervals:
+                        continue
+                    if source == 'previous':
+                        print(f'Interval {ii}: copying {n_output} previously filtered samples')
+                        new_timestamps[output_offsets[ii]:output_offsets[ii] + n_output] = \
+                            previous_timestamps[start:stop]
+                        futures = [executor.submit(self._copy_block_nwb, previous_data, filtered_data, time_axis,
+                                                   start, stop, previous_electrode_indices[block_start:block_stop],
+                                                   block_start, output_offsets[ii], time_block_samples)
+                                   for block_start, block_stop in channel_blocks]
+                    else:
+                        print(f'Interval {ii}: filtering {len(channel_blocks)} blocks of channels')
+                        extracted_ts = timestamps_on_disk[start + first_output * decimation:stop:decimation]
+                        new_timestamps[output_offsets[ii]:output_offsets[ii] + len(extracted_ts)] = extracted_ts
+                        # each block reads, filters and writes its own hyperslab of the output
+                        futures = [executor.submit(self._filter_block_nwb, data_on_disk, filtered_data,
+                                                   filter_coeff, time_axis, start, stop,
+                                                   electrode_indices[block_start:block_stop], block_start,
+                                                   output_offsets[ii], decimation, time_block_samples, fft_threads,
+                                                   first_output)
+                                   for block_start, block_stop in channel_blocks]
+                    for future in futures:
+                        future.result()
+                    # make sure the interval is on disk before it is marked as done
+                    filtered_data.file.flush()
+                    completed_intervals.add(ii)
+                    self.write_checkpoint(checkpoint_file, analysis_file_abs_path, object_id, signature,
+                                          completed_intervals)
+
+            start_end = [new_timestamps[0], new_timestamps[-1]]
+
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        return object_id, start_end
+
+    def _filter_block_nwb(self, data_on_disk, filtered_data, filter_coeff, time_axis, start, stop,
+                          block_electrode_indices, block_offset, output_offset, decimation, time_block_samples,
+                          fft_threads, first_output=0):
+        """Filter samples start:stop of one block of channels and write them, from output sample first_output of the
+        interval on, to their hyperslab of filtered_data
+        """
+        electrode_axis = 1 - time_axis
+        output_selection = [None, None]
+        output_selection[electrode_axis] = np.s_[block_offset:block_offset + len(block_electrode_indices)]
+        for block_output_offset, filtered_block in self._filter_interval(
+                data_on_disk, filter_coeff, time_axis, start, stop, block_electrode_indices, decimation,
+                time_block_samples, fft_threads, first_output=first_output):
+            block_output_offset += output_offset
+            output_selection[time_axis] = np.s_[block_output_offset:
+                                                block_output_offset + filtered_block.shape[time_axis]]
+            filtered_data[tuple(output_selection)] = filtered_block.astype(filtered_data.dtype, copy=False)
+
+    @staticmethod
+    def _copy_block_nwb(previous_data, filtered_data, time_axis, start, stop, block_electrode_indices, block_offset,
+                        output_offset, time_block_samples):
+        """Copy samples start:stop of one block of channels of previously filtered data to their hyperslab of
+        filtered_data, about time_block_samples samples at a time
+        """
+        electrode_axis = 1 - time_axis
+        input_selection = [None, None]
+        input_selection[electrode_axis] = np.s_[block_electrode_indices]
+        output_selection = [None, None]
+        output_selection[electrode_axis] = np.s_[block_offset:block_offset + len(block_electrode_indices)]
+        for block_start in range(start, stop, time_block_samples):
+            block_stop = min(block_start + time_block_samples, stop)
+            input_selection[time_axis] = np.s_[block_start:block_stop]
+            output_selection[time_axis] = np.s_[output_offset + block_start - start:output_offset + block_stop - start]
+            filtered_data[tuple(output_selection)] = np.asarray(previous_data[tuple(input_selection)])
+
+    @staticmethod
+    def _merge_previous_segments(segments, timestamps, previous_timestamps, decimation, filter_delay):
+        """Combine the segments filtered from the intervals of timestamps with the previously filtered samples, in
+        time order
+
+        The previous samples at the start of an interval that have the timestamps the interval would give them
+        continue that interval. Of those, the ones that did not depend on samples after the end of the previous
+        interval (which the filter took as zero) are kept, and the interval is filtered from the first one that did.
+        The other previous samples within an interval are replaced.
+
+        :return: list of segments, with ('previous', start, stop, 0, number of samples) for each run of previous
+        samples that is kept
+        """
+        merged = []
+        previous_start = 0
+        for source, start, stop, _, n_output in segments:
+            split_start, split_stop = (np.searchsorted(previous_timestamps, timestamps[start], side='left'),
+                                       np.searchsorted(previous_timestamps, timestamps[stop - 1], side='right'))
+            if split_start < previous_start:
+                raise ValueError(f'Interval {timestamps[start]} - {timestamps[stop - 1]} overlaps the previous '
+                                 'interval or is out of order')
+            if split_start > previous_start:
+                merged.append(('previous', previous_start, split_start, 0, split_start - previous_start))
+            # find the previous samples that continue this interval
+            n_continued = min(split_stop - split_start, n_output)
+            if n_continued > 0:
+                is_continued = (previous_timestamps[split_start:split_start + n_continued] ==
+                                timestamps[start:start + n_continued * decimation:decimation])
+                n_continued = n_continued if np.all(is_continued) else int(np.argmin(is_continued))
+            # output sample k of an interval depends on the input samples up to k * decimation + filter_delay, so the
+            # ones after the last continued sample (at (n_continued - 1) * decimation) can have been affected
+            first_output = max(n_continued - 1 - (filter_delay - 1) // decimation, 0) if n_continued else 0
+            if first_output > 0:
+                merged.append(('previous', split_start, split_start + first_output, 0, first_output))
+            if n_output > first_output:
+                merged.append((source, start, stop, first_output, n_output - first_output))
+            previous_start = split_stop
+        if len(previous_timestamps) > previous_start:
+            merged.append(('previous', previous_start, len(previous_timestamps), 0,
+                           len(previous_timestamps) - previous_start))
+        return merged
+
+    def _filter_interval(self, data, filter_coeff, time_axis, start, stop, electrode_indices, decimation,
+                         time_block_samples, fft_threads, pad_with_data=False, first_output=0):
+        """Filter samples start:stop of the given channels, reading and filtering about time_block_samples samples
+        at a time.
+
+        Each block is read together with the len(filter_coeff) - 1 samples of history it needs, so the blocks are
+        the same as filtering the whole interval at once. Samples outside the interval are taken as zero, or read
+        from data if pad_with_data is True. Only the output samples from first_output on are computed.
+
+        :yield: the offset of the block in the decimated output of the interval from first_output, and the filtered
+        block
+        """
+        electrode_axis = 1 - time_axis
+        n_taps = len(filter_coeff)
+        filter_delay = self.calc_filter_delay(filter_coeff)
+        interval_samples = stop - start
+        if pad_with_data:
+            first_readable, last_readable = -start, data.shape[time_axis] - start
+        else:
+            first_readable, last_readable = 0, interval_samples
+        n_output = int(np.ceil(interval_samples / decimation))
+        outputs_per_block = max(time_block_samples // decimation, 1)
+        input_selection = [None, None]
+        input_selection[electrode_axis] = np.s_[electrode_indices]
+        for block_first_output in range(first_output, n_output, outputs_per_block):
+            last_output = min(block_first_output + outputs_per_block, n_output)
+            # the indices of the first and last output samples in the full convolution of the interval
+            first_ind = filter_delay + block_first_output * decimation
+            last_ind = filter_delay + (last_output - 1) * decimation
+            read_start = max(first_ind - n_taps + 1, first_readable)
+            read_stop = min(last_ind + 1, last_readable)
+            input_selection[time_axis] = np.s_[start + read_start:start + read_stop]
+            block = np.asarray(data[tuple(input_selection)])
+            filtered_block = self._convolve_block(block, filter_coeff, time_axis, first_ind - read_start,
+                                                  last_ind - read_start, decimation, fft_threads)
+            yield block_first_output - first_output, filtered_block
+
+    def _convolve_block(self, block, filter_coeff, time_axis, first_ind, last_ind, decimation, fft_threads):
+        """Return samples first_ind, first_ind + decimation, ... <= last_ind of the full convolution of the block
+        with the filter, computed with the filter_backend of this FirFilter
+        """
+        if self.filter_backend == 'ghostipy':
+            return gsp.filter_data_fir(block,
+                                       filter_coeff,
+                                       axis=time_axis,
+                                       input_index_bounds=[0, block.shape[time_axis] - 1],
+                                       output_index_bounds=[first_ind, last_ind + 1],
+                                       ds=decimation,
+                                       threads=fft_threads)
+        elif self.filter_backend == 'polyphase':
+            convolve = _polyphase_convolve
+        elif self.filter_backend == 'overlap_save':
+            convolve = _overlap_save_convolve
+        else:
+            raise ValueError(f'Unknown filter_backend {self.filter_backend}; must be one of {FILTER_BACKENDS}')
+        # both backends filter along the first axis
+        block = np.moveaxis(block, time_axis, 0)
+        filtered_block = convolve(block, np.asarray(filter_coeff, dtype=np.float64), first_ind, last_ind, decimation,
+                                  fft_threads)
+        return np.moveaxis(filtered_block, 0, time_axis)
+
+    @staticmethod
+    def filter_signature(filter_coeff, valid_times, electrode_ids, decimation, previous_object_id=None):
+        """
+        :param previous_object_id: str   optional object id of the previously filtered data merged into the output
+        :return: str   hash of the filtering parameters, used to check that a checkpoint belongs to the same job
+        """
+        hasher = hashlib.sha1()
+        for value in (filter_coeff, valid_times, electrode_ids):
+            hasher.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+        hasher.update(str(int(decimation)).encode())
+        if previous_object_id is not None:
+            hasher.update(previous_object_id.encode())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def read_checkpoint(checkpoint_file):
+        """
+        :param checkpoint_file: str   path to the checkpoint file written by filter_data_nwb
+        :return: dict with the analysis_file_name, object_id, signature and completed_intervals of the interrupted
+        job, or None if there is no checkpoint
+        """
+        if checkpoint_file is None or not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_checkpoint(checkpoint_file, analysis_file_abs_path, object_id, signature, completed_intervals):
+        if checkpoint_file is None:
+            return
+        checkpoint = {'analysis_file_name': os.path.basename(analysis_file_abs_path),
+                      'object_id': object_id,
+                      'signature': signature,
+                      'completed_intervals': sorted(int(ii) for ii in completed_intervals)}
+        # write to a temporary file and rename it so that a crash never leaves a partial checkpoint
+        tmp_file = checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_file, checkpoint_file)
+
+    def filter_data(self, timestamps, data, filter_coeff, valid_times, electrodes, decimation, memory_budget=None):
         """
         :param timestamps: numpy array with list of timestamps for data
         :param data: original data array
@@ -285,6 +675,8 @@ class FirFilter(dj.Manual):
         :param valid_times: 2D numpy array with start and stop times of intervals to be filtered
         :param electrodes: list of electrodes to filter
         :param decimation: decimation factor
+        :param memory_budget: str or int   memory available to this call (e.g. '4G'), including the input and output
+        arrays; defaults to the configured budget (see get_filter_memory_budget)
         :return: filtered_data, timestamps
         """
 
@@ -294,6 +686,7 @@ class FirFilter(dj.Manual):
         electrode_axis = 1 - time_axis
         input_dim_restrictions = [None] * n_dim
         input_dim_restrictions[electrode_axis] = np.s_[electrodes]
+        electrodes = np.asarray(electrodes)
 
         indices = []
         output_shape_list = [0] * n_dim
@@ -335,8 +728,14 @@ class FirFilter(dj.Manual):
 
         indices = np.array(indices, ndmin=2)
 
+        # the input and output arrays are already in memory, so they count against the budget
+        time_block_samples, channel_block_size, _ = plan_filter_blocks(
+            np.max(indices[:, 1] - indices[:, 0]), len(electrodes), data.dtype.itemsize, len(filter_coeff),
+            decimation, memory_budget=memory_budget, allocated_memory=data.nbytes + filtered_data.nbytes)
+
         # Filter  the output dataset
         ts_offset = 0
+        output_selection = [None, None]
 
         for ii, (start, stop) in enumerate(indices):
             extracted_ts = timestamps[start:stop:decimation]
@@ -347,16 +746,16 @@ class FirFilter(dj.Manual):
             ts_offset += len(extracted_ts)
 
             # finally ready to filter data!
-            gsp.filter_data_fir(data,
-                                filter_coeff,
-                                axis=time_axis,
-                                input_index_bounds=[start, stop],
-                                output_index_bounds=[
-                                    filter_delay, filter_delay + stop - start],
-                                ds=decimation,
-                                input_dim_restrictions=input_dim_restrictions,
-                                outarray=filtered_data,
-                                output_offset=output_offsets[ii])
+            for block_start in range(0, len(electrodes), channel_block_size):
+                block_stop = min(block_start + channel_block_size, len(electrodes))
+                output_selection[electrode_axis] = np.s_[block_start:block_stop]
+                for block_output_offset, filtered_block in self._filter_interval(
+                        data, filter_coeff, time_axis, start, stop, electrodes[block_start:block_stop], decimation,
+                        time_block_samples, os.cpu_count(), pad_with_data=True):
+                    block_output_offset += output_offsets[ii]
+                    output_selection[time_axis] = np.s_[block_output_offset:
+                                                        block_output_offset + filtered_block.shape[time_axis]]
+                    filtered_data[tuple(output_selection)] = filtered_block
 
         return filtered_data, new_timestamps
 
@@ -1,12 +1,20 @@
+import time
+from collections import OrderedDict
+
 import datajoint as dj
 import numpy as np
 from numpy.lib import emath
-from functools import reduce
 
 from .common_session import Session  # noqa: F401
 
 schema = dj.schema('common_interval')
 
+# process-local LRU cache of (fetch time, IntervalSet) keyed by (nwb_file_name, interval_list_name)
+_interval_set_cache = OrderedDict()
+INTERVAL_SET_CACHE_SIZE = 256
+# seconds after which fetch_interval_set fetches a cached entry again, to see changes made by other processes
+INTERVAL_SET_CACHE_TTL = 60.
+
 # TODO: ADD export to NWB function to save relevant intervals in an NWB file
 
 @schema
@@ -51,6 +59,94 @@ class IntervalList(dj.Manual):
                 [[epoch_data.start_time, epoch_data.stop_time]])
             cls.insert1(epoch_dict, skip_duplicates=True)
 
+    @classmethod
+    def fetch_interval_set(cls, nwb_file_name, interval_list_name, refresh=False):
+        """Return the valid times of an IntervalList entry as an IntervalSet.
+
+        Results are kept in a process-local LRU cache keyed by (nwb_file_name, interval_list_name), so repeated calls
+        neither query the database nor re-normalize the intervals. Inserts, updates and deletes made through
+        IntervalList in this process drop the entries they change from the cache. Changes made by other processes
+        (or by deletes cascading from other tables) are seen once the cached entry is older than
+        INTERVAL_SET_CACHE_TTL seconds, or at once with refresh=True.
+
+        Parameters
+        ----------
+        nwb_file_name : str
+            The name of the NWB file.
+        interval_list_name : str
+            The name of the interval list.
+        refresh : bool, optional
+            If True, fetch the entry from the database even if it is cached. Default False.
+
+        Returns
+        -------
+        interval_set : IntervalSet
+        """
+        cache_key = (nwb_file_name, interval_list_name)
+        cached = _interval_set_cache.get(cache_key)
+        if cached is not None and not refresh and time.monotonic() - cached[0] < INTERVAL_SET_CACHE_TTL:
+            _interval_set_cache.move_to_end(cache_key)
+            return cached[1]
+        fetch_time = time.monotonic()
+        interval_set = IntervalSet(cls._fetch_valid_times(nwb_file_name, interval_list_name))
+        _interval_set_cache[cache_key] = (fetch_time, interval_set)
+        _interval_set_cache.move_to_end(cache_key)
+        if len(_interval_set_cache) > INTERVAL_SET_CACHE_SIZE:
+            _interval_set_cache.popitem(last=False)
+        return interval_set
+
+    @classmethod
+    def _fetch_valid_times(cls, nwb_file_name, interval_list_name):
+        return (cls & {'nwb_file_name': nwb_file_name, 'interval_list_name': interval_list_name}).fetch1(
+            'valid_times')
+
+    @staticmethod
+    def clear_interval_set_cache():
+        """Clear the process-local cache used by fetch_interval_set, e.g. to free its memory."""
+        _interval_set_cache.clear()
+
+    def insert(self, rows, **kwargs):
+        """Insert rows as dj.Manual.insert does and drop them from the cache of fetch_interval_set."""
+        if isinstance(rows, (list, tuple)) and all(isinstance(row, dict) for row in rows):
+            cache_keys = [(row['nwb_file_name'], row['interval_list_name']) for row in rows]
+        else:
+            # rows given as a query, dataframe, array or iterator
+            cache_keys = None
+        try:
+            super().insert(rows, **kwargs)
+        finally:
+            _drop_interval_sets(cache_keys)
+
+    def update1(self, row):
+        """Update an entry as dj.Manual.update1 does and drop it from the cache of fetch_interval_set."""
+        try:
+            super().update1(row)
+        finally:
+            _drop_interval_sets([(row['nwb_file_name'], row['interval_list_name'])])
+
+    def delete(self, *args, **kwargs):
+        """Delete entries as dj.Manual.delete does and clear the cache of fetch_interval_set."""
+        try:
+            return super().delete(*args, **kwargs)
+        finally:
+            _drop_interval_sets()
+
+    def delete_quick(self, *args, **kwargs):
+        """Delete entries as dj.Manual.delete_quick does and clear the cache of fetch_interval_set."""
+        try:
+            return super().delete_quick(*args, **kwargs)
+        finally:
+            _drop_interval_sets()
+
+
+def _drop_interval_sets(cache_keys=None):
+    # drop the given (nwb_file_name, interval_list_name) entries from the cache of fetch_interval_set, or all entries
+    if cache_keys is None:
+        _interval_set_cache.clear()
+    else:
+        for cache_key in cache_keys:
+            _interval_set_cache.pop(cache_key, None)
+
 @schema
 class SortInterval(dj.Manual):
     definition = """
@@ -61,7 +157,110 @@ class SortInterval(dj.Manual):
     """
 
 
-# TODO: make all of the functions below faster if possible
+class IntervalSet:
+    """An immutable set of time intervals.
+
+    The intervals are stored as a read-only, C-contiguous (N,2) float64 array of [start, stop] times that is sorted
+    by start time, with overlapping intervals merged (intervals that only touch are kept separate). Because the
+    normalization is done once on construction, set operations run as a single sweep over the sorted boundaries.
+
+    Set operations are available as operators: `a & b` (intersection), `a | b` (union) and `a - b` (difference).
+    An IntervalSet can be passed anywhere an (N,2) numpy array of intervals is expected.
+
+    Parameters
+    ----------
+    interval_list : np.array, (N,2) or a single (2,) interval, optional
+        start and stop times of the intervals; default empty
+    """
+    __slots__ = ('_intervals',)
+
+    def __init__(self, interval_list=()):
+        intervals = np.ascontiguousarray(_merge_intervals(interval_list))
+        intervals.flags.writeable = False
+        self._intervals = intervals
+
+    @classmethod
+    def _from_merged(cls, intervals):
+        # skip normalization for arrays that are already the output of _merge_intervals or _sweep_intervals
+        interval_set = cls.__new__(cls)
+        intervals = np.ascontiguousarray(intervals, dtype=np.float64)
+        intervals.flags.writeable = False
+        interval_set._intervals = intervals
+        return interval_set
+
+    @property
+    def intervals(self):
+        "(N,2) read-only array of [start, stop] times"
+        return self._intervals
+
+    @property
+    def duration(self):
+        "Total length of all intervals"
+        return float(np.sum(self._intervals[:, 1] - self._intervals[:, 0]))
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        return iter(self._intervals)
+
+    def __array__(self, dtype=None, copy=None):
+        return self._intervals if dtype is None else self._intervals.astype(dtype)
+
+    def __repr__(self):
+        return f'IntervalSet({self._intervals.tolist()})'
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return np.array_equal(self._intervals, other._intervals)
+
+    def __hash__(self):
+        return hash(self._intervals.tobytes())
+
+    def __and__(self, other):
+        return IntervalSet._from_merged(_sweep_intervals(self._intervals, _as_interval_set(other)._intervals,
+                                                         np.logical_and))
+
+    def __or__(self, other):
+        return IntervalSet._from_merged(_sweep_intervals(self._intervals, _as_interval_set(other)._intervals,
+                                                         np.logical_or))
+
+    def __sub__(self, other):
+        return IntervalSet._from_merged(_sweep_intervals(self._intervals, _as_interval_set(other)._intervals,
+                                                         lambda in1, in2: np.logical_and(in1, np.logical_not(in2))))
+
+    def complement(self, start_time, stop_time):
+        """Return the times between start_time and stop_time that are not in this set."""
+        return IntervalSet([start_time, stop_time]) - self
+
+    def by_length(self, min_length=0.0, max_length=1e10):
+        """Return only the intervals whose length is > min_length and < max_length."""
+        return IntervalSet._from_merged(intervals_by_length(self._intervals, min_length, max_length))
+
+    def contains_all(self, timestamps):
+        """Return True if every timestamp falls within one of the intervals (bounds included).
+
+        Only the gaps between intervals are searched, so this costs O(N log n) for n timestamps instead of
+        building the index list of every contained timestamp.
+
+        Parameters
+        ----------
+        timestamps : np.array or list
+        """
+        timestamps = np.ravel(np.asarray(timestamps))
+        if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            timestamps = np.sort(timestamps)
+        gaps = _invalid_times(self._intervals, -np.inf, np.inf)
+        n_excluded = np.maximum(np.searchsorted(timestamps, gaps[:, 1], side='left') -
+                                np.searchsorted(timestamps, gaps[:, 0], side='right'), 0)
+        return not np.any(n_excluded)
+
+
+def _as_interval_set(interval_list):
+    return interval_list if isinstance(interval_list, IntervalSet) else IntervalSet(interval_list)
+
+
 def intervals_by_length(interval_list, min_length=0.0, max_length=1e10):
     """Returns an interval list with only the intervals whose length is > min_length and < max_length
 
@@ -84,11 +283,8 @@ def interval_list_contains_ind(valid_times, timestamps):
     :type timestamps: numpy array or list
     :return: indices of timestamps that are in one of the valid_times intervals
     """
-    ind = []
-    for valid_time in valid_times:
-        ind += np.ravel(np.argwhere(np.logical_and(timestamps >= valid_time[0],
-                                                   timestamps <= valid_time[1]))).tolist()
-    return np.asarray(ind)
+    valid_times = _as_interval_array(valid_times)
+    return _interval_indices(valid_times[:, 0], valid_times[:, 1], np.asarray(timestamps), closed=True)
 
 
 def interval_list_contains(valid_times, timestamps):
@@ -100,11 +296,8 @@ def interval_list_contains(valid_times, timestamps):
     :type timestamps: numpy array or list
     :return: numpy array of timestamps that are in one of the valid_times intervals
     """
-    ind = []
-    for valid_time in valid_times:
-        ind += np.ravel(np.argwhere(np.logical_and(timestamps >= valid_time[0],
-                                                   timestamps <= valid_time[1]))).tolist()
-    return timestamps[ind]
+    timestamps = np.asarray(timestamps)
+    return timestamps[interval_list_contains_ind(valid_times, timestamps)]
 
 
 def interval_list_excludes_ind(valid_times, timestamps):
@@ -116,17 +309,10 @@ def interval_list_excludes_ind(valid_times, timestamps):
     :type timestamps: numpy array or list
     :return: numpy array of timestamps that are in one of the valid_times intervals
     """
+    timestamps = np.asarray(timestamps)
     # add the first and last times to the list and creat a list of invalid intervals
-    valid_times_list = np.ndarray.ravel(valid_times).tolist()
-    valid_times_list.insert(0, timestamps[0] - 0.00001)
-    valid_times_list.append(timestamps[-1] + 0.001)
-    invalid_times = np.array(valid_times_list).reshape(-1, 2)
-    # add the first and last timestamp indices
-    ind = []
-    for invalid_time in invalid_times:
-        ind += np.ravel(np.argwhere(np.logical_and(timestamps > invalid_time[0],
-                                                   timestamps < invalid_time[1]))).tolist()
-    return np.asarray(ind)
+    invalid_times = _invalid_times(valid_times, timestamps[0] - 0.00001, timestamps[-1] + 0.001)
+    return _interval_indices(invalid_times[:, 0], invalid_times[:, 1], timestamps, closed=False)
 
 
 def interval_list_excludes(valid_times, timestamps):
@@ -138,17 +324,72 @@ def interval_list_excludes(valid_times, timestamps):
     :type timestamps: numpy array or list
     :return: numpy array of timestamps that are in one of the valid_times intervals
     """
+    timestamps = np.asarray(timestamps)
     # add the first and last times to the list and creat a list of invalid intervals
+    invalid_times = _invalid_times(valid_times, timestamps[0] - 0.00001, timestamps[-1] + 0.00001)
+    return timestamps[_interval_indices(invalid_times[:, 0], invalid_times[:, 1], timestamps, closed=False)]
+
+
+def _as_interval_array(interval_list):
+    "Returns the interval list as an (N,2) array; a single [start, stop] interval becomes a (1,2) array"
+    return np.reshape(np.asarray(interval_list, dtype=np.float64), (-1, 2))
+
+
+def _invalid_times(valid_times, first_time, last_time):
+    """Returns the gaps around and between valid_times as an (N+1,2) array of [start, stop] times,
+    bounded by first_time and last_time"""
     valid_times_list = np.ravel(valid_times).tolist()
-    valid_times_list.insert(0, timestamps[0] - 0.00001)
-    valid_times_list.append(timestamps[-1] + 0.00001)
-    invalid_times = np.array(valid_times_list).reshape(-1, 2)
-    # add the first and last timestamp indices
-    ind = []
-    for invalid_time in invalid_times:
-        ind += np.ravel(np.argwhere(np.logical_and(timestamps > invalid_time[0],
-                                                   timestamps < invalid_time[1]))).tolist()
-    return timestamps[ind]
+    return np.array([first_time] + valid_times_list + [last_time], dtype=np.float64).reshape(-1, 2)
+
+
+def _interval_indices(starts, stops, timestamps, closed=True):
+    """Returns the indices of the timestamps that fall within each of the [start, stop] intervals.
+
+    The indices are concatenated in the order of the intervals and are in ascending order within each interval,
+    so timestamps within overlapping intervals are returned once per interval. Each interval boundary is located
+    with a binary search, so the cost is O((n + m) log n) for n timestamps and m intervals rather than one full scan
+    of the timestamps per interval.
+
+    Parameters
+    ----------
+    starts : np.array
+        start time of each interval
+    stops : np.array
+        stop time of each interval
+    timestamps : np.array
+        1D array of timestamps; does not need to be sorted
+    closed : bool, optional
+        if True, include timestamps equal to the interval bounds (start <= t <= stop);
+        if False, exclude them (start < t < stop). Default True.
+
+    Returns
+    -------
+    indices : np.array of int
+    """
+    timestamps = np.ravel(timestamps)
+    sorted_order = None
+    if len(timestamps) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+        sorted_order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[sorted_order]
+
+    first = np.searchsorted(timestamps, starts, side='left' if closed else 'right')
+    last = np.searchsorted(timestamps, stops, side='right' if closed else 'left')
+    lengths = np.maximum(last - first, 0)
+    n_indices = int(np.sum(lengths))
+    if n_indices == 0:
+        return np.array([], dtype=np.int64)
+
+    # expand each [first, last) pair into a run of consecutive indices without a Python loop
+    offsets = np.cumsum(lengths) - lengths
+    indices = np.arange(n_indices, dtype=np.int64) + np.repeat(first - offsets, lengths)
+
+    if sorted_order is not None:
+        # map back to the original positions and restore ascending order within each interval
+        indices = sorted_order[indices]
+        interval_id = np.repeat(np.arange(len(lengths)), lengths)
+        indices = indices[np.lexsort((indices, interval_id))]
+    return indices
+
 
 def interval_list_intersect(interval_list1, interval_list2, min_length=0):
     """Finds the intersections between two interval lists
@@ -165,69 +406,103 @@ def interval_list_intersect(interval_list1, interval_list2, min_length=0):
     -------
     interval_list: np.array, (N,2)
     """
-    
-    if interval_list1.ndim==1:
-        interval_list1 = np.expand_dims(interval_list1,0)
-    else:
-        interval_list1 = interval_list1[np.argsort(interval_list1[:,0])]
-        interval_list1 = reduce(_union_concat, interval_list1)
-        # the following check is needed in the case where the interval list is a single element (behavior of reduce)
-        if interval_list1.ndim==1:
-            interval_list1 = np.expand_dims(interval_list1,0)
-        
-    if interval_list2.ndim==1:
-        interval_list2 = np.expand_dims(interval_list2,0)
-    else:
-        interval_list2 = interval_list2[np.argsort(interval_list2[:,0])]
-        interval_list2 = reduce(_union_concat, interval_list2)
-        # the following check is needed in the case where the interval list is a single element (behavior of reduce)
-        if interval_list2.ndim==1:
-            interval_list2 = np.expand_dims(interval_list2,0)
-
-    intersecting_intervals = []
-    for interval2 in interval_list2:
-        for interval1 in interval_list1:
-            if _intersection(interval2, interval1) is not None:
-                intersecting_intervals.append(_intersection(interval1, interval2))   
-                
-    intersecting_intervals = np.asarray(intersecting_intervals)
-    intersecting_intervals = intersecting_intervals[np.argsort(intersecting_intervals[:,0])]
-    
-    return intervals_by_length(intersecting_intervals, min_length=min_length)
-
-def _intersection(interval1, interval2):
-    "Takes the (set-theoretic) intersection of two intervals"
-    intersection = np.array([max([interval1[0],interval2[0]]),
-                             min([interval1[1],interval2[1]])])
-    if intersection[1]>intersection[0]:
-        return intersection
-    else:
-        return None
-    
-def _union(interval1, interval2):
-    "Takes the (set-theoretic) union of two intervals"
-    if _intersection(interval1, interval2) is None:
-        return np.array([interval1, interval2])
-    else:
-        return np.array([min([interval1[0],interval2[0]]),
-                         max([interval1[1],interval2[1]])])
+    intersection = _sweep_intervals(_merge_intervals(interval_list1), _merge_intervals(interval_list2),
+                                    np.logical_and)
+    return intervals_by_length(intersection, min_length=min_length)
 
-def _union_concat(interval_list, interval):
-    """Compares the last interval of the interval list to the given interval and
-    * takes their union if overlapping
-    * concatenates the interval to the interval list if not
-    
-    Recursively called with `reduce`.
+
+def interval_list_difference(interval_list1, interval_list2, min_length=0.0):
+    """Finds the times that are in the first interval list but not in the second
+
+    Parameters
+    ----------
+    interval_list1 : np.array, (N,2) where N = number of intervals
+    interval_list2 : np.array, (N,2) where N = number of intervals
+    min_length: float, optional. Minimum length of intervals to include, default 0
+
+    Returns
+    -------
+    interval_list: np.array, (N,2)
+    """
+    difference = _sweep_intervals(_merge_intervals(interval_list1), _merge_intervals(interval_list2),
+                                  lambda in1, in2: np.logical_and(in1, np.logical_not(in2)))
+    return intervals_by_length(difference, min_length=min_length)
+
+
+def interval_list_complement(interval_list, start_time, stop_time, min_length=0.0):
+    """Finds the times between start_time and stop_time that are not in the interval list
+
+    Parameters
+    ----------
+    interval_list : np.array, (N,2) where N = number of intervals
+    start_time : float
+    stop_time : float
+    min_length: float, optional. Minimum length of intervals to include, default 0
+
+    Returns
+    -------
+    interval_list: np.array, (N,2)
+    """
+    return interval_list_difference(np.array([[start_time, stop_time]]), interval_list, min_length=min_length)
+
+
+def _merge_intervals(interval_list):
+    """Returns the interval list sorted by start time with overlapping intervals merged.
+
+    Intervals that only touch (the stop time of one equals the start time of the next) are kept separate.
+    Runs in O(N) for an interval list that is already sorted by start time.
+
+    Parameters
+    ----------
+    interval_list : np.array, (N,2) or a single (2,) interval
+
+    Returns
+    -------
+    interval_list: np.array of float64, (N,2)
+    """
+    intervals = _as_interval_array(interval_list)
+    if len(intervals) < 2:
+        return intervals
+    if np.any(intervals[1:, 0] < intervals[:-1, 0]):
+        intervals = intervals[np.argsort(intervals[:, 0], kind='stable')]
+    # an interval starts a new group unless it starts before the latest stop time seen so far
+    latest_stop = np.maximum.accumulate(intervals[:, 1])
+    group_starts = np.flatnonzero(np.concatenate(([True], intervals[1:, 0] >= latest_stop[:-1])))
+    group_stops = np.append(group_starts[1:], len(intervals)) - 1
+    return np.column_stack((intervals[group_starts, 0], latest_stop[group_stops]))
+
+
+def _sweep_intervals(interval_list1, interval_list2, combine):
+    """Combines two merged interval lists with a single sweep over their boundaries.
+
+    Each list's start and stop times are already sorted, so the four boundary runs are merged by a stable
+    (timsort) argsort in O(N+M). Stops are ordered before starts at equal times so that touching intervals do
+    not count as overlapping.
+
+    Parameters
+    ----------
+    interval_list1 : np.array, (N,2), output of _merge_intervals
+    interval_list2 : np.array, (M,2), output of _merge_intervals
+    combine : callable
+        Takes two boolean arrays (inside interval_list1, inside interval_list2) and returns a boolean array that
+        is True where the output should be inside an interval, e.g. np.logical_and for the intersection.
+
+    Returns
+    -------
+    interval_list: np.array of float64, (K,2), containing only intervals of positive length
     """
-    if interval_list.ndim==1:
-        interval_list = np.expand_dims(interval_list, 0)
-    if interval.ndim==1:
-        interval = np.expand_dims(interval, 0)
+    n1, n2 = len(interval_list1), len(interval_list2)
+    times = np.concatenate((interval_list1[:, 1], interval_list2[:, 1], interval_list1[:, 0], interval_list2[:, 0]))
+    in1_change = np.concatenate((-np.ones(n1), np.zeros(n2), np.ones(n1), np.zeros(n2)))
+    in2_change = np.concatenate((np.zeros(n1), -np.ones(n2), np.zeros(n1), np.ones(n2)))
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+
+    inside = combine(np.cumsum(in1_change[order]) > 0, np.cumsum(in2_change[order]) > 0)
+    was_inside = np.concatenate(([False], inside[:-1]))
+    result = np.column_stack((times[inside & ~was_inside], times[~inside & was_inside]))
+    return result[result[:, 1] > result[:, 0]]
 
-    x = _union(interval_list[-1], interval[0])
-    if x.ndim==1:
-        x = np.expand_dims(x, 0)
-    return np.concatenate((interval_list[:-1], x), axis=0)
 
 def union_adjacent_index(interval1, interval2):
     """unions two intervals that are adjacent in index
@@ -253,7 +528,6 @@ def union_adjacent_index(interval1, interval2):
     else:
         return np.concatenate((interval1, interval2),axis=0)
 
-# TODO: test interval_list_union code
 def interval_list_union(interval_list1, interval_list2, min_length=0.0, max_length=1e10):
     """Finds the union (all times in one or both) for two interval lists
 
@@ -268,30 +542,8 @@ def interval_list_union(interval_list1, interval_list2, min_length=0.0, max_leng
     :return: interval_list
     :rtype:  numpy array of intervals [start, stop]
     """
-    # return np.array([min(interval_list1[0],interval_list2[0]),
-    #                  max(interval_list1[1],interval_list2[1])])
-    interval_list1 = np.ravel(interval_list1)
-    # create a parallel list where 1 indicates the start and -1 the end of an interval
-    interval_list1_start_end = np.ones(interval_list1.shape)
-    interval_list1_start_end[1::2] = -1
-
-    interval_list2 = np.ravel(interval_list2)
-    # create a parallel list for the second interval where 1 indicates the start and -1 the end of an interval
-    interval_list2_start_end = np.ones(interval_list2.shape)
-    interval_list2_start_end[1::2] = -1
-
-    # concatenate the two lists so we can resort the intervals and apply the same sorting to the start-end arrays
-    combined_intervals = np.concatenate((interval_list1, interval_list2))
-    ss = np.concatenate((interval_list1_start_end, interval_list2_start_end))
-    sort_ind = np.argsort(combined_intervals)
-    combined_intervals = combined_intervals[sort_ind]
-    # a cumulative sum of 1 indicates the beginning of a joint interval; a cumulative sum of 0 indicates the end
-    union_starts = np.ravel(np.array(np.where(np.cumsum(ss[sort_ind]) == 1)))
-    union_stops = np.ravel(np.array(np.where(np.cumsum(ss[sort_ind]) == 0)))
-    union = []
-    for start, stop in zip(union_starts, union_stops):
-        union.append([combined_intervals[start], combined_intervals[stop]])
-    return np.asarray(union)
+    union = _sweep_intervals(_merge_intervals(interval_list1), _merge_intervals(interval_list2), np.logical_or)
+    return intervals_by_length(union, min_length=min_length, max_length=max_length)
 
 def interval_list_censor(interval_list, timestamps):
     """returns a new interval list that starts and ends at the first and last timestamp
@@ -303,8 +555,9 @@ def interval_list_censor(interval_list, timestamps):
     Returns:
         interval_list (numpy array of intervals [start, stop])
     """
+    interval_set = _as_interval_set(interval_list)
     # check that all timestamps are in the interval list
-    assert len(interval_list_contains_ind(interval_list, timestamps)) == len(timestamps), 'interval_list must contain all timestamps' 
-    
+    assert interval_set.contains_all(timestamps), 'interval_list must contain all timestamps'
+
     timestamps_interval = np.asarray([[timestamps[0], timestamps[-1]]])
-    return interval_list_intersect(interval_list, timestamps_interval)    
+    return interval_list_intersect(interval_set, timestamps_interval)    
@@ -1,8 +1,11 @@
+import json
 import os
 import stat
 import pathlib
 import random
+import shutil
 import string
+import time
 
 import datajoint as dj
 import pandas as pd
@@ -10,10 +13,11 @@ import numpy as np
 import pynwb
 import spikeinterface as si
 
-from hdmf.common import DynamicTable
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.common import DynamicTable, DynamicTableRegion, VectorData, VectorIndex
 
 from .dj_helper_fn import get_child_tables
-from .nwb_helper_fn import get_electrode_indices, get_nwb_file
+from .nwb_helper_fn import close_nwb_file, get_electrode_indices, get_nwb_file
 
 schema = dj.schema('common_nwbfile')
 
@@ -23,6 +27,67 @@ NWB_KEEP_FIELDS = ('devices', 'electrode_groups', 'electrodes', 'experiment_desc
                    'institution', 'lab', 'session_description', 'session_id',
                    'session_start_time', 'subject', 'timestamps_reference_time')
 
+# ioctl request that makes a file share the data blocks of another file (a reflink) on Linux file systems that
+# support it, such as btrfs and XFS
+_FICLONE = 0x40049409
+
+
+def _copy_file(src, dst):
+    """Copy the file src to dst, as a reflink when the file system supports it."""
+    try:
+        import fcntl
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def _ragged_offsets(lengths):
+    """Return the VectorIndex data (the end offset of each row) for rows with the given lengths."""
+    return np.cumsum(np.asarray(lengths, dtype=np.int64)).astype(np.uint64)
+
+
+def _wrap_data(data, compression=None, compression_opts=None):
+    """Wrap data in H5DataIO to compress it if compression is specified."""
+    if compression is None:
+        return data
+    return H5DataIO(data, compression=compression, compression_opts=compression_opts)
+
+
+def _ragged_columns(name, description, rows, compression=None, compression_opts=None, dtype=None):
+    """Build a ragged DynamicTable column from one array per row.
+
+    The rows are concatenated into the VectorData and the end offset of each row is stored in the VectorIndex,
+    which is the layout that DynamicTable.add_row writes row by row.
+
+    Parameters
+    ----------
+    name : str
+        The name of the column.
+    description : str
+        The description of the column.
+    rows : list of array-like
+        The value of each row; the arrays are concatenated along the first axis.
+    compression : str, optional
+        HDF5 compression filter for the column data, e.g. 'gzip'. Default None.
+    compression_opts : optional
+        Options for the compression filter, e.g. the gzip level.
+    dtype : numpy dtype, optional
+        The dtype of the column data. Default: the dtype of the concatenated rows.
+
+    Returns
+    -------
+    data, index : hdmf.common.VectorData, hdmf.common.VectorIndex
+    """
+    rows = [np.asarray(row, dtype=dtype) for row in rows]
+    data = np.concatenate(rows) if len(rows) else np.array([], dtype=dtype or np.float64)
+    column = VectorData(name=name, description=description,
+                        data=_wrap_data(data, compression, compression_opts))
+    index = VectorIndex(name=f'{name}_index', data=_ragged_offsets([len(row) for row in rows]), target=column)
+    return column, index
+
 
 @schema
 class Nwbfile(dj.Manual):
@@ -125,7 +190,10 @@ class AnalysisNwbfile(dj.Manual):
     # so that alter() can work
 
     def create(self, nwb_file_name):
-        """Open the NWB file, create a copy, write the copy to disk and return the name of the new file.
+        """Create a new analysis NWB file for the given NWB file and return the name of the new file.
+
+        The new file is a copy of the analysis template of the NWB file (see get_template), which holds the metadata,
+        devices, electrodes, intervals and subject of the NWB file.
 
         Note that this does NOT add the file to the schema; that needs to be done after data are written to it.
 
@@ -139,7 +207,77 @@ class AnalysisNwbfile(dj.Manual):
         analysis_file_name : str
             The name of the new NWB file.
         """
+        template_abs_path = AnalysisNwbfile.get_template(nwb_file_name)
+
+        analysis_file_name = self.__get_new_file_name(nwb_file_name)
+        # write the new file
+        print(f'Writing new NWB file {analysis_file_name}')
+        analysis_file_abs_path = AnalysisNwbfile.get_abs_path(
+            analysis_file_name)
+        _copy_file(template_abs_path, analysis_file_abs_path)
+
+        # change the permissions to only allow owner to write
+        permissions = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+        os.chmod(analysis_file_abs_path, permissions)
+
+        return analysis_file_name
+
+    @staticmethod
+    def get_template_abs_path(nwb_file_name):
+        """Return the absolute path of the analysis template of an NWB file.
+
+        Templates are stored in the analysis_templates directory of NWB_DATAJOINT_BASE_DIR.
+
+        Parameters
+        ----------
+        nwb_file_name : str
+            The name of an NWB file that has been inserted into the Nwbfile() schema.
+
+        Returns
+        -------
+        template_abs_path : str
+            The absolute path of the template file.
+        """
+        base_dir = os.getenv('NWB_DATAJOINT_BASE_DIR', None)
+        assert base_dir is not None, 'You must set NWB_DATAJOINT_BASE_DIR environment variable.'
+
+        return str(pathlib.Path(base_dir) / 'analysis_templates' / (os.path.splitext(nwb_file_name)[0] + '_template.nwb'))
+
+    @staticmethod
+    def get_template(nwb_file_name):
+        """Return the absolute path of the analysis template of an NWB file, building the template if needed.
+
+        The template is a copy of the NWB file that keeps only the NWB_KEEP_FIELDS. It is built once and rebuilt
+        when the NWB file is modified, as recorded by the size and modification time of the NWB file stored next
+        to the template.
+
+        Parameters
+        ----------
+        nwb_file_name : str
+            The name of an NWB file that has been inserted into the Nwbfile() schema.
+
+        Returns
+        -------
+        template_abs_path : str
+            The absolute path of the template file.
+        """
         nwb_file_abspath = Nwbfile.get_abs_path(nwb_file_name)
+        template_abs_path = AnalysisNwbfile.get_template_abs_path(nwb_file_name)
+        parent_stat = os.stat(nwb_file_abspath)
+        parent_info = {'nwb_file_size': parent_stat.st_size, 'nwb_file_mtime_ns': parent_stat.st_mtime_ns}
+        info_abs_path = template_abs_path + '.json'
+        try:
+            with open(info_abs_path) as f:
+                if json.load(f) == parent_info and os.path.exists(template_abs_path):
+                    return template_abs_path
+        except (OSError, ValueError):
+            pass
+
+        print(f'Writing analysis template for {nwb_file_name}')
+        os.makedirs(os.path.dirname(template_abs_path), exist_ok=True)
+        # write to temporary files so that concurrent callers never see a partially written template
+        tmp_template_abs_path = os.path.splitext(template_abs_path)[0] + f'.{os.getpid()}.tmp.nwb'
+        tmp_info_abs_path = info_abs_path + f'.{os.getpid()}.tmp'
         with pynwb.NWBHDF5IO(path=nwb_file_abspath, mode='r', load_namespaces=True) as io:
             nwbf = io.read()
             # pop off the unnecessary elements to save space
@@ -150,21 +288,14 @@ class AnalysisNwbfile(dj.Manual):
                     if isinstance(nwb_object, pynwb.core.LabelledDict):
                         for module in list(nwb_object.keys()):
                             nwb_object.pop(module)
-
-            analysis_file_name = self.__get_new_file_name(nwb_file_name)
-            # write the new file
-            print(f'Writing new NWB file {analysis_file_name}')
-            analysis_file_abs_path = AnalysisNwbfile.get_abs_path(
-                analysis_file_name)
-            # export the new NWB file
-            with pynwb.NWBHDF5IO(path=analysis_file_abs_path, mode='w', manager=io.manager) as export_io:
+            # export the template
+            with pynwb.NWBHDF5IO(path=tmp_template_abs_path, mode='w', manager=io.manager) as export_io:
                 export_io.export(io, nwbf)
-
-        # change the permissions to only allow owner to write
-        permissions = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-        os.chmod(analysis_file_abs_path, permissions)
-
-        return analysis_file_name
+        with open(tmp_info_abs_path, 'w') as f:
+            json.dump(parent_info, f)
+        os.replace(tmp_template_abs_path, template_abs_path)
+        os.replace(tmp_info_abs_path, info_abs_path)
+        return template_abs_path
 
     @classmethod
     def __get_new_file_name(cls, nwb_file_name):
@@ -262,6 +393,65 @@ class AnalysisNwbfile(dj.Manual):
             base_dir / 'analysis' / analysis_nwb_file_name)
         return analysis_nwb_file_abspath
 
+    @staticmethod
+    def get_checkpoint_abs_path(checkpoint_name):
+        """Return the absolute path for a checkpoint file, which records the progress of a job that writes an analysis
+        NWB file so that the job can resume after a crash.
+
+        Checkpoints are kept in the checkpoints directory of NWB_DATAJOINT_TEMP_DIR, or of NWB_DATAJOINT_BASE_DIR/tmp
+        if NWB_DATAJOINT_TEMP_DIR is not set, rather than with the analysis files. The directory is created if needed.
+        A checkpoint is removed by the job once it completes; checkpoints left by jobs that were not resumed are
+        removed by cleanup_checkpoints.
+
+        Parameters
+        ----------
+        checkpoint_name : str
+            The name of the checkpoint file.
+
+        Returns
+        -------
+        checkpoint_abspath : str
+            The absolute path for the given checkpoint name.
+        """
+        return str(AnalysisNwbfile._get_checkpoint_dir() / checkpoint_name)
+
+    @staticmethod
+    def _get_checkpoint_dir():
+        temp_dir = os.getenv('NWB_DATAJOINT_TEMP_DIR')
+        if temp_dir is None:
+            base_dir = os.getenv('NWB_DATAJOINT_BASE_DIR')
+            assert base_dir is not None, \
+                'You must set NWB_DATAJOINT_TEMP_DIR or NWB_DATAJOINT_BASE_DIR environment variable.'
+            temp_dir = pathlib.Path(base_dir) / 'tmp'
+        checkpoint_dir = pathlib.Path(temp_dir) / 'checkpoints'
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        return checkpoint_dir
+
+    @staticmethod
+    def cleanup_checkpoints(max_age_days=7):
+        """Delete the checkpoint files of jobs that were not resumed.
+
+        A checkpoint is stale if it has not been written for max_age_days, or if the analysis file it points to no
+        longer exists.
+
+        Parameters
+        ----------
+        max_age_days : float, optional
+            The number of days after which a checkpoint is deleted (default 7).
+        """
+        checkpoint_dir = AnalysisNwbfile._get_checkpoint_dir()
+        oldest_time = time.time() - max_age_days * 24 * 3600
+        for checkpoint_file in checkpoint_dir.glob('*.json'):
+            try:
+                with open(checkpoint_file, 'r') as f:
+                    analysis_file_name = json.load(f).get('analysis_file_name')
+            except (OSError, ValueError):
+                analysis_file_name = None
+            if (checkpoint_file.stat().st_mtime < oldest_time or analysis_file_name is None or
+                    not os.path.exists(AnalysisNwbfile.get_abs_path(analysis_file_name))):
+                print(f'Deleting stale checkpoint {checkpoint_file}')
+                checkpoint_file.unlink()
+
     @staticmethod
     def add_to_lock(analysis_file_name):
         """Add the specified analysis NWB file to the file with the list of nwb files to be locked.
@@ -281,6 +471,26 @@ class AnalysisNwbfile(dj.Manual):
         lock_file.write(f'{analysis_file_name}\n')
         lock_file.close()
 
+    def writer(self, analysis_file_name):
+        """Open an analysis NWB file to add several objects to it with a single write.
+
+        Use as a context manager; the objects are written when the with block exits without an exception:
+
+            with AnalysisNwbfile().writer(analysis_file_name) as writer:
+                key['a_object_id'] = writer.add_nwb_object(a)
+                key['b_object_id'] = writer.add_nwb_object(b)
+
+        Parameters
+        ----------
+        analysis_file_name : str
+            The name of the analysis NWB file.
+
+        Returns
+        -------
+        writer : AnalysisNwbfileWriter
+        """
+        return AnalysisNwbfileWriter(self.get_abs_path(analysis_file_name))
+
     def add_nwb_object(self, analysis_file_name, nwb_object):
         # TODO: change to add_object with checks for object type and a name parameter, which should be specified if
         # it is not an NWB container
@@ -298,191 +508,39 @@ class AnalysisNwbfile(dj.Manual):
         nwb_object_id : str
             The NWB object ID of the added object.
         """
-        with pynwb.NWBHDF5IO(path=self.get_abs_path(analysis_file_name), mode="a", load_namespaces=True) as io:
-            nwbf = io.read()
-            if isinstance(nwb_object, pd.DataFrame):
-                dt_object = DynamicTable.from_dataframe(name='pandas_table', df=nwb_object)
-                nwbf.add_scratch(dt_object)
-                io.write(nwbf)
-                return dt_object.object_id
-            else:
-                nwbf.add_scratch(nwb_object)
-                io.write(nwbf)
-                return nwb_object.object_id
+        with self.writer(analysis_file_name) as writer:
+            return writer.add_nwb_object(nwb_object)
 
     def add_units(self, analysis_file_name, units, units_valid_times,
-                  units_sort_interval, metrics=None, units_waveforms=None, labels=None):
+                  units_sort_interval, metrics=None, units_waveforms=None, labels=None, compression=None,
+                  compression_opts=None):
         """Add units to analysis NWB file
 
-        Parameters
-        ----------
-        analysis_file_name : str
-            The name of the analysis NWB file.
-        units : dict
-            keys are unit ids, values are spike times
-        units_valid_times : dict
-            Dictionary of units and valid times with unit ids as keys.
-        units_sort_interval : dict
-            Dictionary of units and sort_interval with unit ids as keys.
-        units_waveforms : dict, optional
-            Dictionary of unit waveforms with unit ids as keys.
-        metrics : dict, optional
-            Cluster metrics.
-        labels : dict, optional
-            Curation labels for clusters
-
-        Returns
-        -------
-        units_object_id, waveforms_object_id : str, str
-            The NWB object id of the Units object and the object id of the waveforms object ('' if None)
+        See AnalysisNwbfileWriter.add_units.
         """
-        with pynwb.NWBHDF5IO(path=self.get_abs_path(analysis_file_name), mode="a", load_namespaces=True) as io:
-            nwbf = io.read()
-            sort_intervals = list()
-            if len(units.keys()):
-                # Add spike times and valid time range for the sort
-                for id in units.keys():
-                    nwbf.add_unit(spike_times=units[id], id=id,
-                                  # waveform_mean = units_templates[id],
-                                  obs_intervals=units_valid_times[id])
-                    sort_intervals.append(units_sort_interval[id])
-                # Add a column for the sort interval (subset of valid time)
-                nwbf.add_unit_column(name='sort_interval',
-                                     description='the interval used for spike sorting',
-                                     data=sort_intervals)
-                # If metrics were specified, add one column per metric
-                if metrics is not None:
-                    for metric in list(metrics):
-                        metric_data = metrics[metric].to_list()
-                        print(f'Adding metric {metric} : {metric_data}')
-                        nwbf.add_unit_column(name=metric,
-                                             description=f'{metric} metric',
-                                             data=metric_data)
-                if labels is not None:
-                    nwbf.add_unit_column(
-                        name='label', description='label given during curation', data=labels)
-                # If the waveforms were specified, add them as a dataframe to scratch
-                waveforms_object_id = ''
-                if units_waveforms is not None:
-                    waveforms_df = pd.DataFrame.from_dict(units_waveforms,
-                                                          orient='index')
-                    waveforms_df.columns = ['waveforms']
-                    nwbf.add_scratch(
-                        waveforms_df, name='units_waveforms', notes='spike waveforms for each unit')
-                    waveforms_object_id = nwbf.scratch['units_waveforms'].object_id
-
-                io.write(nwbf)
-                return nwbf.units.object_id, waveforms_object_id
-            else:
-                return ''
-    
-    def add_units_waveforms(self, analysis_file_name, waveform_extractor: si.WaveformExtractor, 
-                            metrics=None, labels=None):
-        """Add units to analysis NWB file along with the waveforms
+        with self.writer(analysis_file_name) as writer:
+            return writer.add_units(units, units_valid_times, units_sort_interval, metrics=metrics,
+                                    units_waveforms=units_waveforms, labels=labels, compression=compression,
+                                    compression_opts=compression_opts)
 
-        Parameters
-        ----------
-        analysis_file_name : str
-            The name of the analysis NWB file.
-        waveform_extractor : si.WaveformExtractor object
-        metrics : dict, optional
-            Cluster metrics.
-        labels : dict, optional
-            Curation labels for clusters
+    def add_units_waveforms(self, analysis_file_name, waveform_extractor: si.WaveformExtractor,
+                            metrics=None, labels=None, compression=None, compression_opts=None):
+        """Add units to analysis NWB file along with the waveforms
 
-        Returns
-        -------
-        units_object_id : str
-            The NWB object id of the Units object
+        See AnalysisNwbfileWriter.add_units_waveforms.
         """
-        
-        with pynwb.NWBHDF5IO(path=self.get_abs_path(analysis_file_name), mode='a', load_namespaces=True) as io:
-            nwbf = io.read()
-            for id in waveform_extractor.sorting.get_unit_ids():
-                # (spikes, samples, channels)
-                waveforms = waveform_extractor.get_waveforms(unit_id=id)
-                # (channels, spikes, samples)
-                waveforms = np.moveaxis(waveforms, source=2, destination=0)
-                nwbf.add_unit(spike_times=waveform_extractor.sorting.get_unit_spike_train(unit_id=id),
-                                id=id, electrodes=waveform_extractor.recording.get_channel_ids(),
-                                waveforms=waveforms)
-                
-            # The following is a rough sketch of AnalysisNwbfile().add_waveforms
-            # analysis_file_name = AnalysisNwbfile().create(key['nwb_file_name'])
-            # or
-            # nwbfile = pynwb.NWBFile(...)
-            # (channels, spikes, samples)
-            # wfs = [
-            #         [     # elec 1
-            #             [1, 2, 3],  # spike 1, [sample 1, sample 2, sample 3]
-            #             [1, 2, 3],  # spike 2
-            #             [1, 2, 3],  # spike 3
-            #             [1, 2, 3]   # spike 4
-            #         ], [  # elec 2
-            #             [1, 2, 3],  # spike 1
-            #             [1, 2, 3],  # spike 2
-            #             [1, 2, 3],  # spike 3
-            #             [1, 2, 3]   # spike 4
-            #         ], [  # elec 3
-            #             [1, 2, 3],  # spike 1
-            #             [1, 2, 3],  # spike 2
-            #             [1, 2, 3],  # spike 3
-            #             [1, 2, 3]   # spike 4
-            #         ]
-            # ]
-            # elecs = ... # DynamicTableRegion referring to three electrodes (rows) of the electrodes table
-            # nwbfile.add_unit(spike_times=[1, 2, 3], electrodes=elecs, waveforms=wfs)   
-    
-            # If metrics were specified, add one column per metric
-            if metrics is not None:
-                for metric_name, metric_dict in metrics.items():
-                    print(f'Adding metric {metric_name} : {metric_dict}')
-                    metric_data = metric_dict.values().to_list()
-                    nwbf.add_unit_column(name=metric_name,
-                                        description=metric_name,
-                                        data=metric_data)
-            if labels is not None:
-                nwbf.add_unit_column(
-                    name='label', description='label given during curation', data=labels)
+        with self.writer(analysis_file_name) as writer:
+            return writer.add_units_waveforms(waveform_extractor, metrics=metrics, labels=labels,
+                                              compression=compression, compression_opts=compression_opts)
 
-            io.write(nwbf)
-            return nwbf.units.object_id
-        
     def add_units_metrics(self, analysis_file_name, metrics):
-        """Add units to analysis NWB file along with the waveforms
-
-        Parameters
-        ----------
-        analysis_file_name : str
-            The name of the analysis NWB file.
-        waveform_extractor : si.WaveformExtractor object
-        metrics : dict, optional
-            Cluster metrics.
-        labels : dict, optional
-            Curation labels for clusters
+        """Add units to analysis NWB file along with their metrics
 
-        Returns
-        -------
-        units_object_id : str
-            The NWB object id of the Units object
+        See AnalysisNwbfileWriter.add_units_metrics.
         """
-        metric_names = list(metrics.keys())
-        unit_ids = list(metrics[metric_names[0]].keys())
-        with pynwb.NWBHDF5IO(path=self.get_abs_path(analysis_file_name), mode='a', load_namespaces=True) as io:
-            nwbf = io.read()
-            for id in unit_ids:
-                nwbf.add_unit(id=id)   
-            
-            for metric_name, metric_dict in metrics.items():
-                print(f'Adding metric {metric_name} : {metric_dict}')
-                metric_data = list(metric_dict.values())
-                nwbf.add_unit_column(name=metric_name,
-                                     description=metric_name,
-                                     data=metric_data)
+        with self.writer(analysis_file_name) as writer:
+            return writer.add_units_metrics(metrics)
 
-            io.write(nwbf)
-            return nwbf.units.object_id
-        
     @classmethod
     def get_electrode_indices(cls, analysis_file_name, electrode_ids):
         """Given an analysis NWB file name, returns the indices of the specified electrode_ids.
@@ -524,6 +582,7 @@ class AnalysisNwbfile(dj.Manual):
         # a separate external files clean up required - this is to be done
         # during times when no other transactions are in progress.
         AnalysisNwbfile.cleanup(True)
+        AnalysisNwbfile.cleanup_checkpoints()
 
         # also check to see whether there are directories in the spikesorting folder with this
 
@@ -554,3 +613,252 @@ class AnalysisNwbfileKachery(dj.Computed):
         print(f'Linking {key["analysis_file_name"]} and storing in kachery...')
         key['analysis_file_uri'] = kc.link_file(AnalysisNwbfile().get_abs_path(key['analysis_file_name']))
         self.insert1(key)
+
+
+class AnalysisNwbfileWriter:
+    """Adds objects to an analysis NWB file that is opened once and written once.
+
+    Returned by AnalysisNwbfile().writer(). The file is opened in append mode when the with block is entered, and the
+    added objects are written with a single io.write when it exits without an exception. Nothing is written if the
+    block raises an exception.
+
+    Parameters
+    ----------
+    analysis_file_abs_path : str
+        The absolute path of the analysis NWB file.
+    """
+
+    def __init__(self, analysis_file_abs_path):
+        self.analysis_file_abs_path = analysis_file_abs_path
+        self.io = None
+        self.nwbf = None
+
+    def __enter__(self):
+        # the file may be open in read mode in the pool of get_nwb_file
+        close_nwb_file(self.analysis_file_abs_path)
+        self.io = pynwb.NWBHDF5IO(path=self.analysis_file_abs_path, mode='a', load_namespaces=True)
+        self.nwbf = self.io.read()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.io.write(self.nwbf)
+        finally:
+            self.io.close()
+            self.io = None
+            self.nwbf = None
+
+    def add_nwb_object(self, nwb_object):
+        """Add an NWB object, or a pandas DataFrame as a DynamicTable, to the scratch area and return its object ID
+
+        Parameters
+        ----------
+        nwb_object : pynwb.core.NWBDataInterface or pandas.DataFrame
+            The NWB object created by PyNWB.
+
+        Returns
+        -------
+        nwb_object_id : str
+            The NWB object ID of the added object.
+        """
+        if isinstance(nwb_object, pd.DataFrame):
+            nwb_object = DynamicTable.from_dataframe(name='pandas_table', df=nwb_object)
+        self.nwbf.add_scratch(nwb_object)
+        return nwb_object.object_id
+
+    def add_units(self, units, units_valid_times, units_sort_interval, metrics=None, units_waveforms=None,
+                  labels=None, compression=None, compression_opts=None):
+        """Add units
+
+        The spike times and valid times of all units are written as concatenated arrays with offset vectors rather
+        than unit by unit.
+
+        Parameters
+        ----------
+        units : dict
+            keys are unit ids, values are spike times
+        units_valid_times : dict
+            Dictionary of units and valid times with unit ids as keys.
+        units_sort_interval : dict
+            Dictionary of units and sort_interval with unit ids as keys.
+        units_waveforms : dict, optional
+            Dictionary of unit waveforms with unit ids as keys.
+        metrics : dict, optional
+            Cluster metrics.
+        labels : dict, optional
+            Curation labels for clusters
+        compression : str, optional
+            HDF5 compression filter for the spike times, e.g. 'gzip'. Default None.
+        compression_opts : optional
+            Options for the compression filter, e.g. the gzip level.
+
+        Returns
+        -------
+        units_object_id, waveforms_object_id : str, str
+            The NWB object id of the Units object and the object id of the waveforms object ('' if None)
+        """
+        nwbf = self.nwbf
+        if len(units.keys()):
+            unit_ids = list(units.keys())
+            # Add spike times and valid time range for the sort
+            columns = [
+                *_ragged_columns('spike_times', 'the spike times for each unit', [units[id] for id in unit_ids],
+                                 compression, compression_opts, dtype=np.float64),
+                *_ragged_columns('obs_intervals', 'the observation intervals for each unit',
+                                 [np.reshape(units_valid_times[id], (-1, 2)) for id in unit_ids], dtype=np.float64)]
+            self._add_units_table(unit_ids, columns)
+            # Add a column for the sort interval (subset of valid time)
+            nwbf.add_unit_column(name='sort_interval',
+                                 description='the interval used for spike sorting',
+                                 data=[units_sort_interval[id] for id in unit_ids])
+            # If metrics were specified, add one column per metric
+            if metrics is not None:
+                for metric in list(metrics):
+                    metric_data = metrics[metric].to_list()
+                    print(f'Adding metric {metric} : {metric_data}')
+                    nwbf.add_unit_column(name=metric,
+                                         description=f'{metric} metric',
+                                         data=metric_data)
+            if labels is not None:
+                nwbf.add_unit_column(
+                    name='label', description='label given during curation', data=labels)
+            # If the waveforms were specified, add them as a dataframe to scratch
+            waveforms_object_id = ''
+            if units_waveforms is not None:
+                waveforms_df = pd.DataFrame.from_dict(units_waveforms,
+                                                      orient='index')
+                waveforms_df.columns = ['waveforms']
+                nwbf.add_scratch(
+                    waveforms_df, name='units_waveforms', notes='spike waveforms for each unit')
+                waveforms_object_id = nwbf.scratch['units_waveforms'].object_id
+
+            return nwbf.units.object_id, waveforms_object_id
+        else:
+            return ''
+
+    def _add_units_table(self, unit_ids, columns):
+        """Add the units table of the file with the given unit ids and columns"""
+        if self.nwbf.units is not None:
+            raise ValueError(f'{self.analysis_file_abs_path} already has a units table')
+        self.nwbf.units = pynwb.misc.Units(name='units', id=list(unit_ids), columns=columns,
+                                           description='Autogenerated by NWBFile')
+
+    def add_units_waveforms(self, waveform_extractor: si.WaveformExtractor, metrics=None, labels=None,
+                            compression=None, compression_opts=None):
+        """Add units along with the waveforms
+
+        The spike times, electrodes and waveforms of all units are written as concatenated arrays with offset
+        vectors rather than unit by unit.
+
+        Parameters
+        ----------
+        waveform_extractor : si.WaveformExtractor object
+        metrics : dict, optional
+            Cluster metrics.
+        labels : dict, optional
+            Curation labels for clusters
+        compression : str, optional
+            HDF5 compression filter for the spike times and waveforms, e.g. 'gzip'. Default None.
+        compression_opts : optional
+            Options for the compression filter, e.g. the gzip level.
+
+        Returns
+        -------
+        units_object_id : str
+            The NWB object id of the Units object
+        """
+        nwbf = self.nwbf
+        unit_ids = waveform_extractor.sorting.get_unit_ids()
+        channel_ids = waveform_extractor.recording.get_channel_ids()
+        spike_times = [waveform_extractor.sorting.get_unit_spike_train(unit_id=id) for id in unit_ids]
+        # (spikes, samples, channels) for each unit
+        unit_waveforms = [waveform_extractor.get_waveforms(unit_id=id) for id in unit_ids]
+
+        spike_times, spike_times_index = _ragged_columns(
+            'spike_times', 'the spike times for each unit', spike_times, compression, compression_opts,
+            dtype=np.float64)
+        electrodes = DynamicTableRegion(name='electrodes', description='the electrodes that each spike unit came from',
+                                        data=np.tile(channel_ids, len(unit_ids)), table=nwbf.electrodes)
+        electrodes_index = VectorIndex(name='electrodes_index', target=electrodes,
+                                       data=_ragged_offsets([len(channel_ids)] * len(unit_ids)))
+        # the waveforms are stored as (channels * spikes, samples) rows for each unit; waveforms_index gives the end of
+        # each channel's spikes and waveforms_index_index the end of each unit's channels
+        waveforms = VectorData(
+            name='waveforms', description=pynwb.misc.Units.waveforms_desc,
+            data=_wrap_data(np.concatenate([np.moveaxis(wf, source=2, destination=0).reshape(-1, wf.shape[1])
+                                            for wf in unit_waveforms]), compression, compression_opts))
+        waveforms_index = VectorIndex(name='waveforms_index', target=waveforms, data=_ragged_offsets(
+            [wf.shape[0] for wf in unit_waveforms for _ in range(wf.shape[2])]))
+        waveforms_index_index = VectorIndex(name='waveforms_index_index', target=waveforms_index,
+                                            data=_ragged_offsets([wf.shape[2] for wf in unit_waveforms]))
+        self._add_units_table(unit_ids, [spike_times, spike_times_index, electrodes, electrodes_index, waveforms,
+                                         waveforms_index, waveforms_index_index])
+
+        # The following is a rough sketch of AnalysisNwbfile().add_waveforms
+        # analysis_file_name = AnalysisNwbfile().create(key['nwb_file_name'])
+        # or
+        # nwbfile = pynwb.NWBFile(...)
+        # (channels, spikes, samples)
+        # wfs = [
+        #         [     # elec 1
+        #             [1, 2, 3],  # spike 1, [sample 1, sample 2, sample 3]
+        #             [1, 2, 3],  # spike 2
+        #             [1, 2, 3],  # spike 3
+        #             [1, 2, 3]   # spike 4
+        #         ], [  # elec 2
+        #             [1, 2, 3],  # spike 1
+        #             [1, 2, 3],  # spike 2
+        #             [1, 2, 3],  # spike 3
+        #             [1, 2, 3]   # spike 4
+        #         ], [  # elec 3
+        #             [1, 2, 3],  # spike 1
+        #             [1, 2, 3],  # spike 2
+        #             [1, 2, 3],  # spike 3
+        #             [1, 2, 3]   # spike 4
+        #         ]
+        # ]
+        # elecs = ... # DynamicTableRegion referring to three electrodes (rows) of the electrodes table
+        # nwbfile.add_unit(spike_times=[1, 2, 3], electrodes=elecs, waveforms=wfs)   
+
+        # If metrics were specified, add one column per metric
+        if metrics is not None:
+            for metric_name, metric_dict in metrics.items():
+                print(f'Adding metric {metric_name} : {metric_dict}')
+                metric_data = metric_dict.values().to_list()
+                nwbf.add_unit_column(name=metric_name,
+                                     description=metric_name,
+                                     data=metric_data)
+        if labels is not None:
+            nwbf.add_unit_column(
+                name='label', description='label given during curation', data=labels)
+
+        return nwbf.units.object_id
+
+    def add_units_metrics(self, metrics):
+        """Add units along with their metrics
+
+        Parameters
+        ----------
+        metrics : dict
+            Cluster metrics; dictionary of metric name to a dictionary of unit id to metric value.
+
+        Returns
+        -------
+        units_object_id : str
+            The NWB object id of the Units object
+        """
+        nwbf = self.nwbf
+        metric_names = list(metrics.keys())
+        unit_ids = list(metrics[metric_names[0]].keys())
+        for id in unit_ids:
+            nwbf.add_unit(id=id)
+
+        for metric_name, metric_dict in metrics.items():
+            print(f'Adding metric {metric_name} : {metric_dict}')
+            metric_data = list(metric_dict.values())
+            nwbf.add_unit_column(name=metric_name,
+                                 description=metric_name,
+                                 data=metric_data)
+
+        return nwbf.units.object_id
@@ -24,6 +24,7 @@ from track_linearization import (get_linearized_position, make_track_graph,
 from .common_behav import RawPosition
 from .common_interval import IntervalList
 from .common_nwbfile import AnalysisNwbfile
+from .nwb_helper_fn import get_data_array
 
 schema = dj.schema('common_position')
 
@@ -136,14 +137,10 @@ class IntervalPositionInfo(dj.Computed):
             pass
 
         # Insert into analysis nwb file
-        nwb_analysis_file = AnalysisNwbfile()
-
-        key['head_position_object_id'] = nwb_analysis_file.add_nwb_object(
-            key['analysis_file_name'], head_position)
-        key['head_orientation_object_id'] = nwb_analysis_file.add_nwb_object(
-            key['analysis_file_name'], head_orientation)
-        key['head_velocity_object_id'] = nwb_analysis_file.add_nwb_object(
-            key['analysis_file_name'], head_velocity)
+        with AnalysisNwbfile().writer(key['analysis_file_name']) as writer:
+            key['head_position_object_id'] = writer.add_nwb_object(head_position)
+            key['head_orientation_object_id'] = writer.add_nwb_object(head_orientation)
+            key['head_velocity_object_id'] = writer.add_nwb_object(head_velocity)
 
         AnalysisNwbfile().add(
             key['nwb_file_name'], key['analysis_file_name'])
@@ -303,17 +300,18 @@ class IntervalPositionInfo(dj.Computed):
 
     def fetch1_dataframe(self):
         nwb_data = self.fetch_nwb()[0]
-        index = pd.Index(np.asarray(
+        # memory map the series where possible so that they are copied only once, into the dataframe
+        index = pd.Index(get_data_array(
             nwb_data['head_position'].get_spatial_series().timestamps), name='time')
         COLUMNS = ['head_position_x', 'head_position_y', 'head_orientation',
                    'head_velocity_x', 'head_velocity_y', 'head_speed']
         return pd.DataFrame(np.concatenate(
-            (np.asarray(nwb_data['head_position'].get_spatial_series().data),
-             np.asarray(nwb_data['head_orientation'].get_spatial_series().data)[
+            (get_data_array(nwb_data['head_position'].get_spatial_series().data),
+             get_data_array(nwb_data['head_orientation'].get_spatial_series().data)[
                 :, np.newaxis],
-             np.asarray(nwb_data['head_velocity'].time_series['head_velocity'].data)),
+             get_data_array(nwb_data['head_velocity'].time_series['head_velocity'].data)),
             axis=1), columns=COLUMNS,
-            index=index)
+            index=index, copy=False)
 
 
 @schema
@@ -582,7 +580,7 @@ class PositionVideo(dj.Computed):
         raw_position_df = (RawPosition() & {
                            'nwb_file_name': key['nwb_file_name'],
                            'interval_list_name': key['interval_list_name']}
-                           ).fetch1_dataframe()
+                           ).fetch1_dataframe(zero_copy=True)
         position_info_df = (IntervalPositionInfo() & {
             'nwb_file_name': key['nwb_file_name'],
             'interval_list_name': key['interval_list_name'],
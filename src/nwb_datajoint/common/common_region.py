@@ -45,3 +45,34 @@ class BrainRegion(dj.Lookup):
             cls.insert1(key)
             query = BrainRegion & key
         return query.fetch1('region_id')
+
+    @classmethod
+    def fetch_add_regions(cls, region_names):
+        """Return the region IDs for the given region names (without subregions), first adding the regions that do
+        not exist to the BrainRegion table.
+
+        Each distinct name is looked up once.
+
+        Parameters
+        ----------
+        region_names : list of str
+            The names of the brain regions; may contain duplicates.
+
+        Returns
+        -------
+        region_ids : dict
+            The region ID of each distinct region name.
+        """
+        region_names = list(dict.fromkeys(region_names))
+        if not region_names:
+            return dict()
+        keys = [{'region_name': region_name, 'subregion_name': None, 'subsubregion_name': None}
+                for region_name in region_names]
+        names, ids = (cls & keys).fetch('region_name', 'region_id')
+        region_ids = dict(zip(names, ids))
+        missing = [key for key in keys if key['region_name'] not in region_ids]
+        if missing:
+            cls.insert(missing)
+            names, ids = (cls & missing).fetch('region_name', 'region_id')
+            region_ids.update(zip(names, ids))
+        return {region_name: region_ids[region_name] for region_name in region_names}
@@ -1,4 +1,6 @@
 from csv import list_dialects
+import hashlib
+import json
 import os
 import pathlib
 import time
@@ -100,6 +102,9 @@ class SortGroup(dj.Manual):
         sg_key = dict()
         sge_key = dict()
         sg_key['nwb_file_name'] = sge_key['nwb_file_name'] = nwb_file_name
+        # collect the rows to insert them all at once
+        sort_groups = list()
+        sort_group_electrodes = list()
         for e_group in e_groups:
             # for each electrode group, get a list of the unique shank numbers
             shank_list = np.unique(
@@ -139,15 +144,15 @@ class SortGroup(dj.Manual):
                         f"Should have found exactly one electrode group for reference electrode,"
                         f"but found {len(reference_electrode_group)}.")
                 if not omit_ref_electrode_group or (str(e_group) != str(reference_electrode_group)):
-                    self.insert1(sg_key)
+                    sort_groups.append(dict(sg_key))
                     shank_elect = electrodes['electrode_id'][np.logical_and(electrodes['electrode_group_name'] == e_group,
                                                                             electrodes['probe_shank'] == shank)]
-                    for elect in shank_elect:
-                        sge_key['electrode_id'] = elect
-                        self.SortGroupElectrode().insert1(sge_key)
+                    sort_group_electrodes.extend(dict(sge_key, electrode_id=elect) for elect in shank_elect)
                     sort_group += 1
                 else:
                     print(f"Omitting electrode group {e_group} from sort groups because contains reference.")
+        self.insert(sort_groups)
+        self.SortGroupElectrode().insert(sort_group_electrodes)
 
     def set_group_by_electrode_group(self, nwb_file_name: str):
         """Assign groups to all non-bad channel electrodes based on their electrode group
@@ -168,6 +173,9 @@ class SortGroup(dj.Manual):
         sge_key = dict()
         sg_key['nwb_file_name'] = sge_key['nwb_file_name'] = nwb_file_name
         sort_group = 0
+        # collect the rows to insert them all at once
+        sort_groups = list()
+        sort_group_electrodes = list()
         for e_group in e_groups:
             sge_key['electrode_group_name'] = e_group
             #sg_key['sort_group_id'] = sge_key['sort_group_id'] = sort_group
@@ -180,13 +188,13 @@ class SortGroup(dj.Manual):
             else:
                 ValueError(
                     f'Error in electrode group {e_group}: reference electrodes are not all the same')
-            self.insert1(sg_key)
+            sort_groups.append(dict(sg_key))
 
             shank_elect = electrodes['electrode_id'][electrodes['electrode_group_name'] == e_group]
-            for elect in shank_elect:
-                sge_key['electrode_id'] = elect
-                self.SortGroupElectrode().insert1(sge_key)
+            sort_group_electrodes.extend(dict(sge_key, electrode_id=elect) for elect in shank_elect)
             sort_group += 1
+        self.insert(sort_groups)
+        self.SortGroupElectrode().insert(sort_group_electrodes)
 
     def set_reference_from_list(self, nwb_file_name, sort_group_ref_list):
         '''
@@ -305,7 +313,6 @@ class SpikeSortingRecording(dj.Computed):
     """
     def make(self, key):
         sort_interval_valid_times = self._get_sort_interval_valid_times(key)
-        recording = self._get_filtered_recording(key)
 
         recording_name = self._get_recording_name(key)
 
@@ -318,18 +325,137 @@ class SpikeSortingRecording(dj.Computed):
         # store the list of valid times for the sort
         key['sort_interval_list_name'] = tmp_key['interval_list_name']
 
-        # Path to files that will hold the recording extractors
-        recording_folder = Path(os.getenv('NWB_DATAJOINT_RECORDING_DIR'))
-        key['recording_path'] = str(recording_folder / Path(recording_name))
-        if os.path.exists(key['recording_path']):
-            shutil.rmtree(key['recording_path'])
-        recording = recording.save(folder=key['recording_path'], n_jobs=1,
-                                   total_memory='10G')
-        
         key['recording_id'] = 'R_'+str(uuid.uuid4())[:8]
-        
+
+        # Path to files that will hold the recording extractors. Selections that differ only in team share the
+        # recording name, so the recording id keeps their paths apart; the path links to the shared cached recording
+        recording_folder = Path(os.getenv('NWB_DATAJOINT_RECORDING_DIR'))
+        key['recording_path'] = str(recording_folder / Path(recording_name + '_' + key['recording_id']))
+        cache_path = self._get_cached_recording(key)
+        self._link_cached_recording(cache_path, key['recording_path'])
+
         self.insert1(key)
-    
+
+    @staticmethod
+    def _get_recording_cache_folder():
+        return Path(os.getenv('NWB_DATAJOINT_RECORDING_DIR')) / 'cache'
+
+    def _get_recording_hash(self, key):
+        """Returns a hash of everything the saved recording of an entry depends on: the NWB file, the valid sort
+        times, the channels and reference, the preprocessing parameters and the spikeinterface version
+
+        Parameters
+        ----------
+        key: dict
+            primary key of SpikeSortingRecording table
+
+        Returns
+        -------
+        recording_hash: str
+        """
+        sort_group_key = {'nwb_file_name': key['nwb_file_name'], 'sort_group_id': key['sort_group_id']}
+        recording_inputs = {
+            'nwb_file_name': key['nwb_file_name'],
+            'valid_sort_times': np.asarray(self._get_sort_interval_valid_times(key), dtype=np.float64).tolist(),
+            'channel_ids': (SortGroup.SortGroupElectrode & sort_group_key).fetch('electrode_id').tolist(),
+            'ref_channel_id': (SortGroup & sort_group_key).fetch('sort_reference_electrode_id').tolist(),
+            'preproc_params': (SpikeSortingPreprocessingParameters & key).fetch1('preproc_params'),
+            'spikeinterface_version': si.__version__}
+        return hashlib.sha1(json.dumps(recording_inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _get_cached_recording(self, key):
+        """Returns the folder of the cached recording for an entry, filtering the recording and saving it to the
+        cache first if no other entry has the same recording hash
+
+        Parameters
+        ----------
+        key: dict
+            primary key of SpikeSortingRecording table
+
+        Returns
+        -------
+        cache_path: Path
+        """
+        cache_path = self._get_recording_cache_folder() / self._get_recording_hash(key)
+        if cache_path.exists():
+            print(f'Using cached recording {cache_path}')
+            # mark the cached recording as used so that nightly_cleanup leaves it alone until the entry is inserted
+            os.utime(cache_path)
+            return cache_path
+        # save to a temporary folder and rename it so that the cache never has a partially saved recording
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.parent / f'{cache_path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
+        recording = self._get_filtered_recording(key)
+        recording.save(folder=str(tmp_path), n_jobs=1, total_memory='10G')
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            # another process saved the same recording in the meantime
+            if not cache_path.exists():
+                raise
+            shutil.rmtree(tmp_path)
+        return cache_path
+
+    def _link_cached_recording(self, cache_path, recording_path):
+        """Makes recording_path a symbolic link to the cached recording and adds it to the references of the
+        cached recording. Where symbolic links are not supported, recording_path is a folder with hard links to the
+        files of the cached recording instead.
+        """
+        if os.path.islink(recording_path):
+            os.remove(recording_path)
+        elif os.path.exists(recording_path):
+            shutil.rmtree(recording_path)
+        references_path = cache_path.parent / (cache_path.name + '.refs')
+        references_path.mkdir(parents=True, exist_ok=True)
+        (references_path / Path(recording_path).name).write_text(recording_path)
+        try:
+            os.symlink(cache_path, recording_path, target_is_directory=True)
+        except OSError:
+            shutil.copytree(cache_path, recording_path, copy_function=os.link)
+
+    def nightly_cleanup(self, grace_period=24 * 60 * 60):
+        """Clean up recording folders that are not in the SpikeSortingRecording table.
+
+        Each cached recording keeps one reference per recording_path that links to it. References of paths that are
+        no longer in the table are removed together with the paths, and cached recordings that have no references
+        left are deleted, as are the temporary folders left by interrupted saves.
+
+        A recording is saved and linked before its entry is inserted, so the references, cached recordings and
+        temporary folders modified within the last grace_period seconds are kept: they may belong to a make that is
+        still running.
+
+        Parameters
+        ----------
+        grace_period: float
+            minimum age, in seconds, of the files to remove
+        """
+        recording_paths = set(self.fetch('recording_path'))
+        cache_folder = self._get_recording_cache_folder()
+        if not cache_folder.exists():
+            return
+        min_mtime = time.time() - grace_period
+        for references_path in cache_folder.glob('*.refs'):
+            for reference in references_path.iterdir():
+                recording_path = reference.read_text()
+                if recording_path in recording_paths or reference.stat().st_mtime > min_mtime:
+                    continue
+                print(f'removing {recording_path}')
+                if os.path.islink(recording_path):
+                    os.remove(recording_path)
+                elif os.path.exists(recording_path):
+                    shutil.rmtree(recording_path)
+                reference.unlink()
+        for cache_path in cache_folder.iterdir():
+            if cache_path.name.endswith('.refs') or cache_path.stat().st_mtime > min_mtime:
+                continue
+            references_path = cache_folder / (cache_path.name + '.refs')
+            if not cache_path.name.endswith('.tmp') and references_path.exists():
+                if any(references_path.iterdir()):
+                    continue
+                references_path.rmdir()
+            print(f'removing {cache_path}')
+            shutil.rmtree(cache_path)
+
     def _get_recording_name(self, key):
         recording_name = key['nwb_file_name'] + '_' \
         + key['sort_interval_name'] + '_' \
@@ -370,8 +496,7 @@ class SpikeSortingRecording(dj.Computed):
         """
         sort_interval = (SortInterval & {'nwb_file_name': key['nwb_file_name'],
                                          'sort_interval_name': key['sort_interval_name']}).fetch1('sort_interval')
-        valid_interval_times = (IntervalList & {'nwb_file_name': key['nwb_file_name'],
-                                                'interval_list_name': 'raw data valid times'}).fetch1('valid_times')
+        valid_interval_times = IntervalList.fetch_interval_set(key['nwb_file_name'], 'raw data valid times')
         valid_sort_times = interval_list_intersect(sort_interval, valid_interval_times)
         return valid_sort_times
 
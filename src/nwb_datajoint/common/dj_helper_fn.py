@@ -44,9 +44,11 @@ def dj_replace(original_table, new_values, key_column, replace_column):
     return original_table
 
 
-def fetch_nwb(query_expression, nwb_master, *attrs, **kwargs):
+def fetch_nwb(query_expression, nwb_master, *attrs, lazy=False, columns=None, **kwargs):
     """Get an NWB object from the given DataJoint query.
 
+    The records are grouped by NWB file so that each file is opened once.
+
     Parameters
     ----------
     query_expression
@@ -58,6 +60,12 @@ def fetch_nwb(query_expression, nwb_master, *attrs, **kwargs):
         attr is usually 'nwb_file_abs_path' or 'analysis_file_abs_path'
     attrs : list
         Attributes from normal DataJoint fetch call.
+    lazy : bool, optional
+        If True, return LazyNwbObject proxies that open the NWB file, look up the NWB object and convert it to a
+        dataframe only when it is first used. Default False.
+    columns : list, optional
+        Names of the columns to include when converting a DynamicTable (e.g. units) to a dataframe. Default: all
+        columns.
     kwargs : dict
         Keyword arguments from normal DataJoint fetch call.
 
@@ -78,25 +86,91 @@ def fetch_nwb(query_expression, nwb_master, *attrs, **kwargs):
     if not rec_dicts or not np.any(['object_id' in key for key in rec_dicts[0]]):
         return rec_dicts
 
-    ret = []
-    for rec_dict in rec_dicts:
-        nwbf = get_nwb_file(rec_dict.pop('nwb2load_filepath'))
-        # for each attr that contains substring 'object_id', store key-value: attr name to NWB object
-        # remove '_object_id' from attr name
-        nwb_objs = {
-            id_attr.replace("_object_id", ""): _get_nwb_object(nwbf.objects, rec_dict[id_attr])
-            for id_attr in attrs
-            if 'object_id' in id_attr and rec_dict[id_attr] != ''}
-        ret.append({**rec_dict, **nwb_objs})
+    # group the records by file, keeping track of their order
+    file_rec_indices = dict()
+    for index, rec_dict in enumerate(rec_dicts):
+        file_rec_indices.setdefault(rec_dict.pop('nwb2load_filepath'), []).append(index)
+
+    ret = [None] * len(rec_dicts)
+    for nwb_file_path, rec_indices in file_rec_indices.items():
+        nwbf = None if lazy else get_nwb_file(nwb_file_path)
+        for index in rec_indices:
+            rec_dict = rec_dicts[index]
+            # for each attr that contains substring 'object_id', store key-value: attr name to NWB object
+            # remove '_object_id' from attr name
+            nwb_objs = {
+                id_attr.replace("_object_id", ""): (LazyNwbObject(nwb_file_path, rec_dict[id_attr], columns) if lazy
+                                                    else _get_nwb_object(nwbf.objects, rec_dict[id_attr], columns))
+                for id_attr in attrs
+                if 'object_id' in id_attr and rec_dict[id_attr] != ''}
+            ret[index] = {**rec_dict, **nwb_objs}
     return ret
 
 
-def _get_nwb_object(objects, object_id):
+def _get_nwb_object(objects, object_id, columns=None):
     """Retreive NWB object and try to convert to dataframe if possible"""
+    nwb_object = objects[object_id]
     try:
-        return objects[object_id].to_dataframe()
+        if columns is not None and hasattr(nwb_object, 'colnames'):
+            # DynamicTable: skip converting the columns that were not requested
+            return nwb_object.to_dataframe(exclude=set(nwb_object.colnames) - set(columns))
+        return nwb_object.to_dataframe()
     except AttributeError:
-        return objects[object_id]
+        return nwb_object
+
+
+class LazyNwbObject:
+    """Proxy for an NWB object returned by fetch_nwb(..., lazy=True).
+
+    The file is opened with get_nwb_file and the object is looked up in it, and converted to a dataframe if
+    possible, when it is first used (by attribute access, indexing, iteration, len, repr, np.asarray or an
+    isinstance check) or when materialize() is called. The proxy reports the class of the object it resolves to,
+    so that e.g. pd.DataFrame(proxy) and pd.concat accept it. Other operations (arithmetic, comparisons) are not
+    forwarded; call materialize() to use the object itself.
+    """
+    __slots__ = ('_nwb_file_path', '_object_id', '_columns', '_value')
+
+    def __init__(self, nwb_file_path, object_id, columns=None):
+        self._nwb_file_path = nwb_file_path
+        self._object_id = object_id
+        self._columns = columns
+        self._value = None
+
+    @property
+    def object_id(self):
+        return self._object_id
+
+    @property
+    def nwb_file_path(self):
+        return self._nwb_file_path
+
+    def materialize(self):
+        """Return the NWB object (or its dataframe), resolving it on the first call."""
+        if self._value is None:
+            self._value = _get_nwb_object(get_nwb_file(self._nwb_file_path).objects, self._object_id, self._columns)
+        return self._value
+
+    @property
+    def __class__(self):
+        return type(self.materialize())
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(), name)
+
+    def __getitem__(self, item):
+        return self.materialize()[item]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.materialize(), dtype=dtype)
+
+    def __repr__(self):
+        return repr(self.materialize())
 
 
 def get_child_tables(table):
@@ -1,21 +1,148 @@
 """NWB helper functions for finding processing modules and data interfaces."""
 
+import gc
 import os
+import threading
 import warnings
+import weakref
+from collections import OrderedDict
 
 import numpy as np
 import pynwb
 
-# dict mapping file path to an open NWBHDF5IO object in read mode and its NWBFile
-__open_nwb_files = dict()
+# maximum number of NWB files kept open by get_nwb_file, unless set with the NWB_DATAJOINT_MAX_OPEN_FILES
+# environment variable
+DEFAULT_MAX_OPEN_NWB_FILES = 64
+
+# number of timestamps read at a time when finding valid intervals
+TIMESTAMP_CHUNK_SIZE = 2 ** 22
 
 global invalid_electrode_index
 invalid_electrode_index = 99999999
 
 
+class NwbFilePool:
+    """A bounded, thread-safe pool of NWB files open in read mode.
+
+    Files are kept open for reuse and the least recently used file is released from the pool when more than
+    max_open files are pooled. A file that was modified on disk after it was opened is released and opened again.
+    A released file is not closed while the NWBFile or any object read from it is still referenced; it is closed
+    when they have all been garbage collected, so objects returned by the pool never lose access to their data.
+
+    max_open is therefore a soft bound on the number of open files: it bounds the pooled files, but released files
+    whose objects are still referenced stay open in addition to them (see the 'released_files' of stats()).
+
+    Parameters
+    ----------
+    max_open : int
+        Maximum number of files kept open in the pool.
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_NWB_FILES):
+        self.max_open = max_open
+        # maps file path to an open NWBHDF5IO object, its NWBFile and the modification time of the file when opened
+        self._files = OrderedDict()
+        # the NWBHDF5IO objects of the released files whose NWBFile has not been garbage collected yet
+        self._released = dict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, nwb_file_path):
+        """Return the NWBFile object with the given file path, opening the file if needed."""
+        mtime = os.stat(nwb_file_path).st_mtime_ns
+        with self._lock:
+            io, nwbfile, open_mtime = self._files.get(nwb_file_path, (None, None, None))
+            if nwbfile is not None and open_mtime != mtime:
+                # the file was rewritten after it was opened
+                self.invalidations += 1
+                self._release(*self._files.pop(nwb_file_path))
+                nwbfile = None
+            if nwbfile is not None:
+                self.hits += 1
+                self._files.move_to_end(nwb_file_path)
+                return nwbfile
+
+            self.misses += 1
+            io = pynwb.NWBHDF5IO(path=nwb_file_path, mode='r',
+                                 load_namespaces=True)  # keep file open
+            nwbfile = io.read()
+            self._files[nwb_file_path] = (io, nwbfile, mtime)
+            while len(self._files) > self.max_open:
+                _, evicted = self._files.popitem(last=False)
+                self._release(*evicted)
+                self.evictions += 1
+            collect = len(self._released) > self.max_open
+        if collect:
+            # collect the released files that are no longer referenced so that they are closed. this is done outside
+            # the lock so that other threads are not blocked by the collection.
+            gc.collect()
+        return nwbfile
+
+    def _release(self, io, nwbfile, mtime):
+        # the build manager of the io object refers to the NWBFile; clear it so that the NWBFile can be garbage
+        # collected once it and the objects read from the file (which refer to it through their parents) are no
+        # longer referenced, and close the file then
+        io.manager.clear_cache()
+        self._released[id(io)] = io
+        weakref.finalize(nwbfile, self._close_released, id(io))
+
+    def _close_released(self, io_id):
+        io = self._released.pop(io_id, None)
+        if io is not None:
+            io.close()
+
+    def close(self, nwb_file_path):
+        """Release the file with the given path from the pool and close it if none of its objects are referenced.
+
+        A file whose objects are still referenced stays open (with a warning) until they are garbage collected.
+        """
+        with self._lock:
+            entry = self._files.pop(nwb_file_path, None)
+            if entry is None:
+                return
+            self._release(*entry)
+        nwbfile_ref = weakref.ref(entry[1])
+        del entry
+        gc.collect()
+        if nwbfile_ref() is not None:
+            warnings.warn(f'NWB file {nwb_file_path} is still in use and will stay open until the objects read '
+                          'from it are deleted')
+
+    def close_all(self):
+        """Release all files from the pool and close the files whose objects are not referenced."""
+        with self._lock:
+            for entry in self._files.values():
+                self._release(*entry)
+            self._files.clear()
+            entry = None
+        gc.collect()
+
+    def stats(self):
+        """Return a dict with the number of pooled files, the number of released files that are still referenced
+        (and so still open), and the hit, miss, eviction and invalidation counts."""
+        with self._lock:
+            return {'open_files': len(self._files), 'max_open': self.max_open, 'released_files': len(self._released),
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+
+__nwb_file_pool = NwbFilePool(int(os.getenv('NWB_DATAJOINT_MAX_OPEN_FILES', DEFAULT_MAX_OPEN_NWB_FILES)))
+
+
+# sorted electrode IDs (and their indices) selected by each NWBFile or ElectricalSeries object, for
+# get_electrode_indices
+__electrode_ids_cache = weakref.WeakKeyDictionary()
+__electrode_ids_lock = threading.Lock()
+
+
 def get_nwb_file(nwb_file_path):
     """Return an NWBFile object with the given file path in read mode.
 
+    The file is kept open in a pool of files shared by all callers (see NwbFilePool).
+
     Parameters
     ----------
     nwb_file_path : str
@@ -26,19 +153,125 @@ def get_nwb_file(nwb_file_path):
     nwbfile : pynwb.NWBFile
         NWB file object for the given path opened in read mode.
     """
-    _, nwbfile = __open_nwb_files.get(nwb_file_path, (None, None))
-    if nwbfile is None:
-        io = pynwb.NWBHDF5IO(path=nwb_file_path, mode='r',
-                             load_namespaces=True)  # keep file open
-        nwbfile = io.read()
-        __open_nwb_files[nwb_file_path] = (io, nwbfile)
-    return nwbfile
+    return __nwb_file_pool.get(nwb_file_path)
+
+
+def close_nwb_file(nwb_file_path):
+    """Close the NWB file with the given path if it was opened by get_nwb_file and none of its objects are in use."""
+    __nwb_file_pool.close(nwb_file_path)
 
 
 def close_nwb_files():
-    for io, _ in __open_nwb_files.values():
-        io.close()
-    __open_nwb_files.clear()
+    __nwb_file_pool.close_all()
+
+
+def get_nwb_file_pool_stats():
+    """Return the number of files open and the hit, miss, eviction and invalidation counts of get_nwb_file."""
+    return __nwb_file_pool.stats()
+
+
+class LazyArray:
+    """Read-only array view of an HDF5 dataset that reads data only when it is sliced.
+
+    Slicing returns a numpy array with only the selected data, e.g. lazy_array[start:stop] reads rows start to
+    stop. np.asarray(lazy_array) reads the whole dataset.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+        Dataset to wrap; must support shape, dtype and slicing.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return np.asarray(self.dataset[item])
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self.dataset[()])
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __repr__(self):
+        return f'LazyArray(shape={self.shape}, dtype={self.dtype})'
+
+    def iter_blocks(self, block_size):
+        """Iterate over the array in blocks of block_size rows, yielding (start, block) for each block."""
+        for start in range(0, len(self), block_size):
+            yield start, self[start:start + block_size]
+
+
+def get_memmap(dataset):
+    """Return a read-only np.memmap of an HDF5 dataset's data, or None if the data cannot be memory mapped.
+
+    Only datasets stored contiguously and uncompressed in a single file with a numeric dtype can be memory mapped.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+
+    Returns
+    -------
+    data : np.memmap or None
+    """
+    try:
+        if (dataset.chunks is not None or dataset.compression is not None or dataset.external is not None
+                or dataset.is_virtual or dataset.file.driver != 'sec2' or dataset.dtype.kind not in 'biuf'):
+            return None
+        offset = dataset.id.get_offset()
+    except AttributeError:  # not an h5py dataset
+        return None
+    if offset is None:  # no data has been written
+        return None
+    return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+def get_data_array(dataset, lazy=False):
+    """Return the data of an HDF5 dataset (e.g. the data or timestamps of a TimeSeries) as an array without copying
+    it into memory when possible.
+
+    Contiguous, uncompressed datasets are returned as a read-only np.memmap. Other datasets are returned as a
+    LazyArray if lazy is True and are otherwise read into memory.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset or array-like
+    lazy : bool, optional
+        If True, return a LazyArray instead of reading datasets that cannot be memory mapped. Default False.
+
+    Returns
+    -------
+    data : np.memmap, LazyArray or np.ndarray
+    """
+    data = get_memmap(dataset)
+    if data is not None:
+        return data
+    if lazy and hasattr(dataset, 'shape'):
+        return LazyArray(dataset)
+    return np.asarray(dataset)
 
 
 def get_data_interface(nwbfile, data_interface_name, data_interface_class=None):
@@ -144,15 +377,18 @@ def estimate_sampling_rate(timestamps, multiplier):
     return np.round(1.0 / np.mean(sample_diff[adjacent]))
 
 
-def get_valid_intervals(timestamps, sampling_rate, gap_proportion, min_valid_len):
+def get_valid_intervals(timestamps, sampling_rate, gap_proportion, min_valid_len, mask=None, chunk_size=None):
     """Finds the set of all valid intervals in a list of timestamps.
     Valid interval: (start time, stop time) during which there are
     no gaps (i.e. missing samples).
 
+    The timestamps are processed in chunks (see iter_valid_intervals), so they can be an HDF5 dataset that is never
+    read into memory as a whole.
+
     Parameters
     ----------
-    timestamps : numpy.ndarray
-        1D numpy array of timestamp values.
+    timestamps : numpy.ndarray or h5py.Dataset
+        1D array of timestamp values.
     sampling_rate : float
         Sampling rate of the data.
     gap_proportion : float, greater than 1; unit: samples
@@ -162,38 +398,69 @@ def get_valid_intervals(timestamps, sampling_rate, gap_proportion, min_valid_len
         it is considered a gap
     min_valid_len : float
         Length of smallest valid interval.
+    mask : numpy.ndarray, optional
+        1D boolean array of the same length as timestamps; if given, only the timestamps where mask is True are used.
+    chunk_size : int, optional
+        Number of timestamps processed at a time. Default: TIMESTAMP_CHUNK_SIZE, rounded to the HDF5 chunk size.
 
     Returns
     -------
     valid_times : np.ndarray
         Array of start and stop times of shape (N, 2) for valid data.
     """
+    return np.concatenate([np.empty((0, 2))] + list(iter_valid_intervals(
+        timestamps, sampling_rate, gap_proportion, min_valid_len, mask=mask, chunk_size=chunk_size)))
 
-    eps = 0.0000001
-
-    # get rid of NaN elements
-    timestamps = timestamps[~np.isnan(timestamps)]
-    # find gaps
-    gap = np.diff(timestamps) > 1.0 / sampling_rate * gap_proportion
-
-    # all true entries of gap represent gaps. Get the times bounding these intervals.
-    gapind = np.asarray(np.where(gap))
-    # The end of each valid interval are the indices of the gaps and the final value
-    valid_end = np.append(gapind, np.asarray(len(timestamps) - 1))
-
-    # the beginning of the gaps are the first element and gapind+1
-    valid_start = np.insert(gapind + 1, 0, 0)
-
-    valid_indices = np.vstack([valid_start, valid_end]).transpose()
 
-    valid_times = timestamps[valid_indices]
-    # adjust the times to deal with single valid samples
-    valid_times[:, 0] = valid_times[:, 0] - eps
-    valid_times[:, 1] = valid_times[:, 1] + eps
+def iter_valid_intervals(timestamps, sampling_rate, gap_proportion, min_valid_len, mask=None, chunk_size=None):
+    """Finds the valid intervals in a list of timestamps chunk by chunk, yielding them as they are completed.
 
-    valid_intervals = (valid_times[:, 1] - valid_times[:, 0]) > min_valid_len
+    Only one chunk of timestamps is in memory at a time; between chunks, only the last valid timestamp and the start
+    of the current interval are kept. See get_valid_intervals for the parameters.
 
-    return valid_times[valid_intervals, :]
+    Yields
+    ------
+    valid_times : np.ndarray
+        Array of start and stop times of shape (N, 2) of the valid intervals that end in each chunk.
+    """
+    eps = 0.0000001
+    max_gap = 1.0 / sampling_rate * gap_proportion
+    if chunk_size is None:
+        chunk_size = TIMESTAMP_CHUNK_SIZE
+        hdf5_chunks = getattr(timestamps, 'chunks', None)
+        if hdf5_chunks:
+            # read whole HDF5 chunks
+            chunk_size = max(chunk_size // hdf5_chunks[0], 1) * hdf5_chunks[0]
+
+    def to_intervals(start_times, stop_times):
+        valid_times = np.column_stack([start_times - eps, stop_times + eps])
+        return valid_times[(valid_times[:, 1] - valid_times[:, 0]) > min_valid_len]
+
+    start_time = None  # start of the current interval
+    last_time = None  # last valid timestamp read so far
+    for chunk_start in range(0, len(timestamps), chunk_size):
+        chunk = np.asarray(timestamps[chunk_start:chunk_start + chunk_size])
+        # get rid of NaN elements
+        keep = ~np.isnan(chunk)
+        if mask is not None:
+            keep &= mask[chunk_start:chunk_start + chunk_size]
+        chunk = chunk[keep]
+        if not len(chunk):
+            continue
+        if last_time is None:
+            start_time = chunk[0]
+        elif chunk[0] - last_time > max_gap:
+            # gap between the chunks
+            yield to_intervals(np.array([start_time]), np.array([last_time]))
+            start_time = chunk[0]
+        # all true entries of gap represent gaps; the intervals end at the gaps and start after them
+        gapind = np.flatnonzero(np.diff(chunk) > max_gap)
+        if len(gapind):
+            yield to_intervals(np.insert(chunk[gapind[:-1] + 1], 0, start_time), chunk[gapind])
+            start_time = chunk[gapind[-1] + 1]
+        last_time = chunk[-1]
+    if last_time is not None:
+        yield to_intervals(np.array([start_time]), np.array([last_time]))
 
 
 def get_electrode_indices(nwb_object, electrode_ids):
@@ -215,6 +482,9 @@ def get_electrode_indices(nwb_object, electrode_ids):
     electrode_ids : np.ndarray or list
         Array or list of electrode IDs.
 
+    The electrode IDs of each object are read in bulk once and cached, so repeated calls for the same object only
+    look up the requested IDs.
+
     Returns
     -------
     electrode_indices : list
@@ -223,18 +493,43 @@ def get_electrode_indices(nwb_object, electrode_ids):
     if isinstance(nwb_object, pynwb.ecephys.ElectricalSeries):
         # electrodes is a DynamicTableRegion which may contain a subset of the rows in NWBFile.electrodes
         # match against only the subset of electrodes referenced by this ElectricalSeries
-        electrode_table_indices = nwb_object.electrodes.data[:]
-        selected_elect_ids = [nwb_object.electrodes.table.id[x]
-                              for x in electrode_table_indices]
+        n_electrodes = len(nwb_object.electrodes.data)
     elif isinstance(nwb_object, pynwb.NWBFile):
         # electrodes is a DynamicTable that contains all electrodes
-        selected_elect_ids = list(nwb_object.electrodes.id[:])
+        n_electrodes = len(nwb_object.electrodes) if nwb_object.electrodes is not None else 0
     else:
         raise ValueError(
             'nwb_object must be of type ElectricalSeries or NWBFile')
 
-    # for each electrode_id, find its index in selected_elect_ids and return that if it's there and invalid_electrode_index if not.
-    return [selected_elect_ids.index(elect_id) if elect_id in selected_elect_ids else invalid_electrode_index for elect_id in electrode_ids]
+    with __electrode_ids_lock:
+        sorted_ids = __electrode_ids_cache.get(nwb_object)
+        # an in-memory object may have had electrodes added since its IDs were cached
+        if sorted_ids is None or len(sorted_ids[0]) != n_electrodes:
+            sorted_ids = _get_sorted_electrode_ids(nwb_object)
+            __electrode_ids_cache[nwb_object] = sorted_ids
+    ids, order = sorted_ids
+
+    # for each electrode_id, find its index among the selected electrode IDs and return that if it's there and
+    # invalid_electrode_index if not. the sort is stable so the first matching index is returned for repeated IDs.
+    electrode_ids = np.asarray(electrode_ids).ravel()
+    positions = np.minimum(np.searchsorted(ids, electrode_ids), max(len(ids) - 1, 0))
+    found = ids[positions] == electrode_ids if len(ids) else np.zeros(len(electrode_ids), dtype=bool)
+    return [int(order[position]) if is_found else invalid_electrode_index
+            for position, is_found in zip(positions, found)]
+
+
+def _get_sorted_electrode_ids(nwb_object):
+    """Return the electrode IDs selected by an NWB file or electrical series object, sorted, and their indices."""
+    if isinstance(nwb_object, pynwb.ecephys.ElectricalSeries):
+        electrode_table_indices = np.asarray(nwb_object.electrodes.data[:], dtype=int)
+        # read the whole ID column at once rather than one element at a time
+        selected_elect_ids = np.asarray(nwb_object.electrodes.table.id[:])[electrode_table_indices]
+    elif nwb_object.electrodes is not None:
+        selected_elect_ids = np.asarray(nwb_object.electrodes.id[:])
+    else:
+        selected_elect_ids = np.array([], dtype=int)
+    order = np.argsort(selected_elect_ids, kind='stable')
+    return selected_elect_ids[order], order
 
 
 def get_all_spatial_series(nwbf, verbose=False):
@@ -250,8 +545,9 @@ def get_all_spatial_series(nwbf, verbose=False):
     Returns
     -------
     pos_data_dict : dict
-        Dict mapping indices to a dict with keys 'valid_times' and 'raw_position_object_id'. Returns None if there
-        is no position data in the file. The 'raw_position_object_id' is the object ID of the SpatialSeries object.
+        Dict mapping indices to a dict with keys 'valid_times', 'sampling_rate' and 'raw_position_object_id'. Returns
+        None if there is no position data in the file. The 'raw_position_object_id' is the object ID of the
+        SpatialSeries object.
     """
     position = get_data_interface(nwbf, 'position', pynwb.behavior.Position)
     if position is None:
@@ -269,9 +565,6 @@ def get_all_spatial_series(nwbf, verbose=False):
         
         spatial_series = list(position.spatial_series.values())[orig_epoch]
         pos_data_dict[index] = dict()
-        # get the valid intervals for the position data
-        timestamps = np.asarray(spatial_series.timestamps)
-
         # estimate the sampling rate
         timestamps = np.asarray(spatial_series.timestamps)
         sampling_rate = estimate_sampling_rate(timestamps, 1.75)
@@ -284,6 +577,7 @@ def get_all_spatial_series(nwbf, verbose=False):
         # add the valid intervals to the Interval list
         pos_data_dict[index]['valid_times'] = get_valid_intervals(
             timestamps, sampling_rate, 2.5, 0)
+        pos_data_dict[index]['sampling_rate'] = sampling_rate
         pos_data_dict[index]['raw_position_object_id'] = spatial_series.object_id
 
     return pos_data_dict
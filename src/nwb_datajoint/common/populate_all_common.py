@@ -1,3 +1,10 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import datajoint as dj
+
 # HeadDir, Speed, LinPos,
 from .common_behav import (PositionSource, RawPosition, StateScriptFile,
                            VideoFile)
@@ -8,46 +15,158 @@ from .common_nwbfile import Nwbfile
 # from .common_sensors import SensorData
 from .common_session import ExperimenterList, Session
 from .common_task import TaskEpoch
+from .nwb_helper_fn import get_nwb_file
+
+# dependencies between the populated tables that come from the make functions rather than from foreign keys
+EXTRA_DEPENDENCIES = {DIOEvents: (Raw,)}
+
+
+def populate_all_common(nwb_file_name, n_workers=None):
+    """Populate the common tables with the data of an NWB file.
+
+    The tables are populated in an order derived from the DataJoint dependency graph (plus EXTRA_DEPENDENCIES).
+    With n_workers > 1, tables whose dependencies have been populated are populated concurrently, each in a separate
+    process with its own DataJoint connection. The time taken by each table is printed at the end.
+
+    Threads sharing the open NWB file would avoid opening the file in each worker, but the DataJoint tables are bound
+    to the one connection of their schema and a MySQL session cannot be used by several threads at once, so the
+    tables are populated in processes instead. Each worker process opens the NWB file itself, and nothing that a
+    table caches in memory is shared with the tables populated in other workers.
+
+    Parameters
+    ----------
+    nwb_file_name : str
+        The name of the NWB file (in the Nwbfile table).
+    n_workers : int, optional
+        Number of tables to populate at the same time. Defaults to the NWB_DATAJOINT_POPULATE_N_WORKERS environment
+        variable, or 1 if it is not set. Defaults to 1 in a worker process (e.g. of insert_sessions with
+        n_workers > 1), so that the worker processes do not multiply.
+
+    Returns
+    -------
+    timings : dict
+        The wall time, in seconds, spent on each table.
+    """
+    if n_workers is None:
+        if multiprocessing.parent_process() is not None:
+            n_workers = 1
+        else:
+            n_workers = int(os.getenv('NWB_DATAJOINT_POPULATE_N_WORKERS', 1))
+
+    steps = _get_populate_steps(nwb_file_name)
+    prerequisites = get_populate_prerequisites(steps)
+
+    timings = dict()
+    if n_workers > 1:
+        # use fresh processes rather than forked ones so that each worker opens its own database connection
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_populate_worker,
+                                 initargs=(dict(dj.config.items()),)) as executor:
+            pending = list(steps)
+            running = dict()
+            while pending or running:
+                # start the tables whose prerequisites have all been populated
+                unpopulated = set(pending) | set(running.values())
+                for table in [table for table in pending if not prerequisites[table] & unpopulated]:
+                    pending.remove(table)
+                    running[executor.submit(_populate_step, nwb_file_name, table.__name__)] = table
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    table = running.pop(future)
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    timings[table.__name__] = future.result()
+    else:
+        # open the NWB file once for all the tables
+        get_nwb_file(Nwbfile.get_abs_path(nwb_file_name))
+        for table, step in steps.items():
+            timings[table.__name__] = _run_step(table, step)
+
+    print('Populate times: ' + ', '.join(f'{name} {duration:.1f} s' for name, duration in
+                                         sorted(timings.items(), key=lambda item: -item[1])))
+    return timings
 
 
-def populate_all_common(nwb_file_name):
+def _get_populate_steps(nwb_file_name):
+    """Return a dict that maps each table populated by populate_all_common to a function that populates it."""
     # Insert session one by one
     fp = [(Nwbfile & {'nwb_file_name': nwb_file_name}).proj()]
-    print('Populate Session...')
-    # Session().populate()
-    Session.populate(fp)
     # If we use Kachery for data sharing we can uncomment the following two lines. TBD
     # print('Populate NwbfileKachery...')
     # NwbfileKachery.populate()
-    print('Populate ExperimenterList...')
-    ExperimenterList.populate(fp)
-    print('Populate ElectrodeGroup...')
-    ElectrodeGroup.populate(fp)
-    print('Populate Electrode...')
-    Electrode.populate(fp)
-    print('Populate Raw...')
-    Raw.populate(fp)
-    print('Populate SampleCount...')
-    SampleCount.populate(fp)
-    print('Populate DIOEvents...')
-    DIOEvents.populate(fp)
     # sensor data (from analog ProcessingModule) is temporarily removed from NWBFile
     # to reduce file size while it is not being used. add it back in by commenting out
     # the removal code in nwb_datajoint/data_import/insert_sessions.py when ready
     # print('Populate SensorData')
     # SensorData.populate(fp)
-    print('Populate TaskEpochs')
-    TaskEpoch.populate(fp)
-    print('Populate StateScriptFile')
-    StateScriptFile.populate(fp)
-    print('Populate VideoFile')
-    VideoFile.populate(fp)
-    print('RawPosition...')
-    PositionSource.insert_from_nwbfile(nwb_file_name)
-    RawPosition.populate(fp)
     # print('HeadDir...')
     # HeadDir().populate()
     # print('Speed...')
     # Speed().populate()
     # print('LinPos...')
     # LinPos().populate()
+    steps = {table: (lambda table=table: table.populate(fp))
+             for table in (Session, ExperimenterList, ElectrodeGroup, Electrode, Raw, SampleCount, DIOEvents,
+                           TaskEpoch, StateScriptFile, VideoFile)}
+    steps[PositionSource] = lambda: PositionSource.insert_from_nwbfile(nwb_file_name)
+    steps[RawPosition] = lambda: RawPosition.populate(fp)
+    return steps
+
+
+def _run_step(table, step):
+    """Populate one table and return the time it took."""
+    print(f'Populate {table.__name__}...')
+    start = time.time()
+    step()
+    return time.time() - start
+
+
+def _init_populate_worker(config):
+    """Initialize a populate_all_common worker process with the DataJoint configuration of the parent process."""
+    dj.config.update(config)
+
+
+def _populate_step(nwb_file_name, table_name):
+    """Populate one table in a populate_all_common worker process and return the time it took."""
+    steps = _get_populate_steps(nwb_file_name)
+    table = next(table for table in steps if table.__name__ == table_name)
+    return _run_step(table, steps[table])
+
+
+def get_populate_prerequisites(tables):
+    """Return the tables that must be populated before each of the given tables.
+
+    A table must be populated after the tables among the given tables that it depends on, directly or indirectly,
+    through foreign keys or EXTRA_DEPENDENCIES.
+
+    Parameters
+    ----------
+    tables : list
+        DataJoint table classes.
+
+    Returns
+    -------
+    prerequisites : dict
+        Maps each table to the set of tables that must be populated before it.
+    """
+    tables = list(tables)
+    dependencies = tables[0].connection.dependencies
+    dependencies.load(force=False)
+    full_names = {table.full_table_name: table for table in tables}
+    prerequisites = {table: {full_names[name] for name in dependencies.ancestors(table.full_table_name)
+                             if name in full_names and name != table.full_table_name}
+                     for table in tables}
+    for table, extra_tables in EXTRA_DEPENDENCIES.items():
+        if table in prerequisites:
+            prerequisites[table].update(extra for extra in extra_tables if extra in prerequisites)
+    # add the indirect dependencies through EXTRA_DEPENDENCIES
+    changed = True
+    while changed:
+        changed = False
+        for table in tables:
+            indirect = set().union(*(prerequisites[prerequisite] for prerequisite in prerequisites[table]))
+            if not indirect <= prerequisites[table]:
+                prerequisites[table] |= indirect
+                changed = True
+    return prerequisites
@@ -1,22 +1,42 @@
+import multiprocessing
 import os
 import stat
+import time
+import traceback
 import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import datajoint as dj
 import pynwb
 
 from ..common import Nwbfile, get_raw_eseries, populate_all_common
 from .storage_dirs import check_env
 
 
-def insert_sessions(nwb_file_names):
+def insert_sessions(nwb_file_names, n_workers=1):
     """
     Populate the dj database with new sessions.
 
+    Each session is inserted independently: if a session fails, the error is reported and the remaining sessions are
+    still inserted. What was inserted for a failed session (its Nwbfile entry, the entries populated from it and the
+    copied NWB file) is deleted, so that the session is inserted again on the next run. A summary of the sessions that
+    were inserted, skipped and failed is printed at the end.
+
     Parameters
     ----------
     nwb_file_names : string or List of strings
         nwb_file_names is a list of relative file paths, relative to $NWB_DATAJOINT_BASE_DIR, pointing to
         existing .nwb files. Each file represents a session.
+    n_workers : int, optional
+        Number of sessions to insert at the same time, each in a separate process with its own DataJoint connection.
+        Default 1 (insert the sessions one after another in this process).
+
+    Returns
+    -------
+    summary : list of dict
+        For each session, the nwb_file_name, the status ('inserted', 'skipped' or 'failed'), the duration in seconds
+        and the error message (None unless the session failed).
     """
     check_env()
 
@@ -27,20 +47,123 @@ def insert_sessions(nwb_file_names):
         assert not nwb_file_name.startswith(
             '/'), f'You must use relative paths. nwb_file_name: {nwb_file_name}'
 
-        # file name for the copied raw data
-        out_nwb_file_name = os.path.splitext(nwb_file_name)[0] + '_.nwb'
-
+    summary = list()
+    if n_workers > 1 and len(nwb_file_names) > 1:
+        # the sessions that were inserted before; a worker process skips them
+        inserted_before = {nwb_file_name for nwb_file_name in nwb_file_names
+                           if len(Nwbfile() & {'nwb_file_name': _get_out_nwb_file_name(nwb_file_name)})}
+        # use fresh processes rather than forked ones so that each worker opens its own database connection
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(nwb_file_names)),
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_insert_worker, initargs=(dict(dj.config.items()),)) as executor:
+            futures = {executor.submit(_insert_session, nwb_file_name): nwb_file_name
+                       for nwb_file_name in nwb_file_names}
+            for future in as_completed(futures):
+                try:
+                    summary.append(future.result())
+                except BrokenProcessPool as e:
+                    # a worker process died (e.g. it ran out of memory), which stops all of the workers, so the
+                    # sessions that were not done are failed and cleaned up here
+                    nwb_file_name = futures[future]
+                    result = {'nwb_file_name': nwb_file_name, 'status': 'failed', 'duration': 0.,
+                              'error': f'{type(e).__name__}: {e}'}
+                    if nwb_file_name not in inserted_before:
+                        # the session was not in the Nwbfile table before this run, so its worker created the entry
+                        _delete_failed_session(nwb_file_name, result, created=True)
+                    summary.append(result)
+                _print_progress(summary[-1], len(summary), len(nwb_file_names))
+        # report the sessions in the order they were given
+        order = {nwb_file_name: index for index, nwb_file_name in enumerate(nwb_file_names)}
+        summary.sort(key=lambda result: order[result['nwb_file_name']])
+    else:
+        for nwb_file_name in nwb_file_names:
+            summary.append(_insert_session(nwb_file_name))
+            _print_progress(summary[-1], len(summary), len(nwb_file_names))
+
+    _print_summary(summary)
+    return summary
+
+
+def _init_insert_worker(config):
+    """Initialize an insert_sessions worker process with the DataJoint configuration of the parent process."""
+    dj.config.update(config)
+
+
+def _insert_session(nwb_file_name):
+    """Insert one session, catching any error so that it does not affect the other sessions."""
+    start = time.time()
+    result = {'nwb_file_name': nwb_file_name, 'status': 'inserted', 'duration': 0., 'error': None}
+    # file name for the copied raw data
+    out_nwb_file_name = _get_out_nwb_file_name(nwb_file_name)
+    inserting = False
+    # whether this run inserted the Nwbfile entry of the session
+    created = False
+    try:
         # Check whether the file already exists in the Nwbfile table
         if len(Nwbfile() & {'nwb_file_name': out_nwb_file_name}):
             warnings.warn(
                 f'Cannot insert data from {nwb_file_name}: {out_nwb_file_name} is already in Nwbfile table.')
-            continue
-
-        # Make a copy of the NWB file that ends with '_'.
-        # This has everything except the raw data but has a link to the raw data in the original file
-        copy_nwb_link_raw_ephys(nwb_file_name, out_nwb_file_name)
-        Nwbfile().insert_from_relative_file_name(out_nwb_file_name)
-        populate_all_common(out_nwb_file_name)
+            result['status'] = 'skipped'
+        else:
+            # Make a copy of the NWB file that ends with '_'.
+            # This has everything except the raw data but has a link to the raw data in the original file
+            inserting = True
+            copy_nwb_link_raw_ephys(nwb_file_name, out_nwb_file_name)
+            Nwbfile().insert_from_relative_file_name(out_nwb_file_name)
+            created = True
+            populate_all_common(out_nwb_file_name)
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+        if inserting:
+            _delete_failed_session(nwb_file_name, result, created)
+    result['duration'] = time.time() - start
+    return result
+
+
+def _get_out_nwb_file_name(nwb_file_name):
+    """Return the name of the copy of an NWB file that is inserted into the Nwbfile table."""
+    return os.path.splitext(nwb_file_name)[0] + '_.nwb'
+
+
+def _delete_failed_session(nwb_file_name, result, created=True):
+    """Delete what this run inserted for a session that failed to insert. Errors are added to the error message in
+    result.
+
+    Only an Nwbfile entry that this run created is deleted (created=True), together with the entries populated from
+    it, its filepath entry and the copied NWB file; the callers check that the entry did not exist before inserting
+    it. If the insert of this run failed (created=False), e.g. because another run inserted the same session after
+    the check, only the copied NWB file and its filepath entry are deleted, and only if no Nwbfile entry refers to
+    them.
+    """
+    out_nwb_file_name = _get_out_nwb_file_name(nwb_file_name)
+    try:
+        if created:
+            (Nwbfile() & {'nwb_file_name': out_nwb_file_name}).delete(safemode=False)
+        elif len(Nwbfile() & {'nwb_file_name': out_nwb_file_name}):
+            return
+        # the filepath entry keeps the checksum of the copied file, which a new copy would not match
+        (Nwbfile().external['raw'] & {'filepath': out_nwb_file_name}).delete_quick()
+        out_nwb_file_abs_path = Nwbfile.get_abs_path(out_nwb_file_name)
+        if os.path.exists(out_nwb_file_abs_path):
+            os.remove(out_nwb_file_abs_path)
+    except Exception as e:
+        traceback.print_exc()
+        result['error'] += f' (cleanup failed with {type(e).__name__}: {e})'
+
+
+def _print_progress(result, n_done, n_total):
+    print(f'[{n_done}/{n_total}] {result["nwb_file_name"]}: {result["status"]} ({result["duration"]:.1f} s)')
+
+
+def _print_summary(summary):
+    statuses = [result['status'] for result in summary]
+    print(f'Inserted {statuses.count("inserted")}, skipped {statuses.count("skipped")} and failed '
+          f'{statuses.count("failed")} of {len(summary)} sessions')
+    for result in summary:
+        if result['status'] == 'failed':
+            print(f'  {result["nwb_file_name"]}: {result["error"]}')
 
 
 def copy_nwb_link_raw_ephys(nwb_file_name, out_nwb_file_name):
@@ -8,6 +8,7 @@ from ..common.common_nwbfile import AnalysisNwbfile
 from ..common.common_spikesorting import (CuratedSpikeSorting, SpikeSortingWorkspace,
                                           UnitInclusionParameters)
 from ..common.dj_helper_fn import fetch_nwb  # dj_replace
+from ..common.nwb_helper_fn import get_data_array
 from .get_unit_waveforms import get_unit_waveforms
 
 schema = dj.schema('decoding_clusterless')
@@ -75,7 +76,7 @@ class UnitMarks(dj.Computed):
         units = UnitInclusionParameters().get_included_units(key, key)
 
         # retrieve the units from the NWB file
-        nwb_units = (CuratedSpikeSorting() & key).fetch_nwb()[0]['units']
+        nwb_units = (CuratedSpikeSorting() & key).fetch_nwb(columns=['spike_times'])[0]['units']
     
         # get the  workspace so we can get the waveforms from the recording
         workspace_uri = (SpikeSortingWorkspace & key).fetch1('workspace_uri')
@@ -142,17 +143,25 @@ class UnitMarks(dj.Computed):
     def fetch_nwb(self, *attrs, **kwargs):
         return fetch_nwb(self, (AnalysisNwbfile, 'analysis_file_abs_path'), *attrs, **kwargs)
 
-    def fetch1_dataframe(self):
-        return self.fetch_dataframe()[0]
+    def fetch1_dataframe(self, zero_copy=False):
+        return self.fetch_dataframe(zero_copy)[0]
 
-    def fetch_dataframe(self):
-        return [self._convert_to_dataframe(data) for data in self.fetch_nwb()]
+    def fetch_dataframe(self, zero_copy=False):
+        """Return the marks of each entry as a dataframe indexed by time.
+
+        If zero_copy is True, each dataframe is a read-only view of a memory map of the marks when they are stored
+        contiguously and uncompressed, instead of a copy in memory.
+        """
+        return [self._convert_to_dataframe(data, zero_copy) for data in self.fetch_nwb()]
 
     @staticmethod
-    def _convert_to_dataframe(nwb_data):
-        n_marks = nwb_data['marks'].data.shape[1]
+    def _convert_to_dataframe(nwb_data, zero_copy=False):
+        marks, timestamps = nwb_data['marks'].data, nwb_data['marks'].timestamps
+        if zero_copy:
+            marks, timestamps = get_data_array(marks), get_data_array(timestamps)
+        n_marks = marks.shape[1]
         columns = [f'amplitude_{ind}' for ind in range(n_marks)]
-        return pd.DataFrame(nwb_data['marks'].data,
-                            index=pd.Index(nwb_data['marks'].timestamps,
+        return pd.DataFrame(marks,
+                            index=pd.Index(timestamps,
                                            name='time'),
-                            columns=columns)
+                            columns=columns, copy=False)
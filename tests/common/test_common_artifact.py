@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common.common_artifact import (_combine_channel_stats, _compute_channel_stats_chunk,
+                                                  _detect_artifact_chunk, _get_artifact_chunk_size,
+                                                  _get_artifact_params, _get_artifact_window_mask)
+
+from tests.reference_implementations import reference_window_mask
+
+
+class _Recording:
+    """Stands in for a single segment si.Recording of the given traces."""
+
+    def __init__(self, traces):
+        self.traces = traces
+
+    def get_traces(self, segment_index=0, start_frame=None, end_frame=None):
+        return self.traces[start_frame:end_frame]
+
+    def get_num_channels(self):
+        return self.traces.shape[1]
+
+    def get_dtype(self):
+        return self.traces.dtype
+
+
+def _make_traces():
+    traces = np.random.default_rng(0).normal(0, 100, (10000, 8)).astype(np.int16)
+    # bursts of large values on most channels
+    traces[2000:2050, :6] = 2000
+    traces[7000:7003] = -3000
+    return traces
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_get_artifact_window_mask(shuffle):
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(30000) / 30000.
+    # crossings in bursts of consecutive samples, at the edges of the recording and between samples
+    crossing_indices = np.concatenate([np.arange(100, 130), np.arange(5000, 5003), [0, 29999], [20000, 20010]])
+    artifact_times = np.concatenate([timestamps[crossing_indices], [0.5 + 1e-6]])
+    if shuffle:
+        timestamps = rng.permutation(timestamps)
+    for half_window in [0., 0.5e-3, 1e-3 / 3]:
+        np.testing.assert_array_equal(_get_artifact_window_mask(timestamps, artifact_times, half_window),
+                                      reference_window_mask(timestamps, artifact_times, half_window))
+
+
+def test_combine_channel_stats():
+    traces = _make_traces()
+    recording = _Recording(traces)
+    chunk_stats = [_compute_channel_stats_chunk(0, start_frame, min(start_frame + 3000, len(traces)),
+                                                {'recording': recording})
+                   for start_frame in range(0, len(traces), 3000)]
+    channel_mean, channel_std = _combine_channel_stats(chunk_stats)
+    np.testing.assert_allclose(channel_mean, np.mean(traces, axis=0))
+    np.testing.assert_allclose(channel_std, np.std(traces, axis=0))
+
+
+@pytest.mark.parametrize('amplitude_thresh,zscore_thresh', [(1500, None), (None, 10), (1500, 10)])
+def test_detect_artifact_chunk(amplitude_thresh, zscore_thresh):
+    traces = _make_traces()
+    nelect_above = 6
+    # the original detection over the whole recording at once
+    above = np.zeros(traces.shape, dtype=bool)
+    if amplitude_thresh is not None:
+        above |= np.abs(traces) > amplitude_thresh
+    if zscore_thresh is not None:
+        above |= np.abs(stats.zscore(traces, axis=0)) > zscore_thresh
+    expected = np.ravel(np.argwhere(np.sum(above, axis=1) >= nelect_above))
+
+    recording = _Recording(traces)
+    worker_ctx = {'recording': recording, 'amplitude_thresh': amplitude_thresh, 'zscore_thresh': zscore_thresh,
+                  'nelect_above': nelect_above, 'channel_mean': None, 'channel_std': None}
+    chunks = [(start_frame, min(start_frame + 3000, len(traces))) for start_frame in range(0, len(traces), 3000)]
+    if zscore_thresh is not None:
+        worker_ctx['channel_mean'], worker_ctx['channel_std'] = _combine_channel_stats(
+            [_compute_channel_stats_chunk(0, start_frame, end_frame, worker_ctx) for start_frame, end_frame in chunks])
+    above_thresh = np.concatenate([_detect_artifact_chunk(0, start_frame, end_frame, worker_ctx)
+                                   for start_frame, end_frame in chunks])
+    assert len(above_thresh) > 0
+    np.testing.assert_array_equal(above_thresh, expected)
+
+
+def test_get_artifact_chunk_size():
+    recording = _Recording(np.zeros((10, 8), dtype=np.int16))
+    assert _get_artifact_chunk_size(recording, None) is None
+    # 8 channels x (2 + 8 + 2) bytes per frame, shared by 2 jobs
+    assert _get_artifact_chunk_size(recording, '96k', n_jobs=2) == 500
+    assert _get_artifact_chunk_size(recording, 10) == 1
+
+
+def test_get_artifact_params(monkeypatch):
+    artifact_params = {'zscore_thresh': None, 'n_jobs': 1}
+    monkeypatch.delenv('NWB_DATAJOINT_ARTIFACT_N_JOBS', raising=False)
+    assert _get_artifact_params(artifact_params) == artifact_params
+    monkeypatch.setenv('NWB_DATAJOINT_ARTIFACT_N_JOBS', '4')
+    assert _get_artifact_params(artifact_params) == {'zscore_thresh': None, 'n_jobs': 4}
+    # the stored params are left unchanged
+    assert artifact_params['n_jobs'] == 1
@@ -0,0 +1,83 @@
+import datetime
+
+import numpy as np
+import pynwb
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common import common_behav
+from nwb_datajoint.common.common_behav import PositionSource, RawPosition
+
+
+class _Table:
+    """Stands in for a DataJoint table, keeping the inserted entries in memory."""
+
+    def __init__(self):
+        self.entries = []
+
+    def insert1(self, entry, **kwargs):
+        self.entries.append(dict(entry))
+
+    def __and__(self, key):
+        query = _Table()
+        query.entries = [entry for entry in self.entries
+                         if all(entry[name] == value for name, value in key.items() if name in entry)]
+        return query
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fetch1(self, attr):
+        assert len(self.entries) == 1
+        return self.entries[0][attr]
+
+
+def _make_file(path):
+    nwbfile = pynwb.NWBFile(
+        session_description='session_description',
+        identifier='identifier',
+        session_start_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    position = pynwb.behavior.Position(name='position')
+    # the spatial series are not stored in the order of their epochs; the second epoch has a gap
+    for name, start, sampling_rate in [('series_b', 100., 50.), ('series_a', 0., 30.)]:
+        timestamps = start + np.arange(1000) / sampling_rate
+        timestamps[500:] += 5 if start else 0
+        position.create_spatial_series(name=name, data=np.zeros((1000, 2)), timestamps=timestamps,
+                                       reference_frame='reference_frame')
+    nwbfile.create_processing_module('behavior', 'behavior').add(position)
+    with pynwb.NWBHDF5IO(path=path, mode='w') as io:
+        io.write(nwbfile)
+    with pynwb.NWBHDF5IO(path=path, mode='r') as io:
+        return {name: series.object_id
+                for name, series in io.read().processing['behavior']['position'].spatial_series.items()}
+
+
+def test_raw_position_from_position_source(tmp_path, monkeypatch):
+    path = str(tmp_path / 'session_.nwb')
+    object_ids = _make_file(path)
+    interval_list, position_source, spatial_series, raw_position = _Table(), _Table(), _Table(), _Table()
+    monkeypatch.setattr(common_behav.Nwbfile, 'get_abs_path', staticmethod(lambda nwb_file_name: path),
+                        raising=False)
+    monkeypatch.setattr(common_behav, 'IntervalList', lambda: interval_list)
+    monkeypatch.setattr(PositionSource, 'insert1', position_source.insert1, raising=False)
+    monkeypatch.setattr(PositionSource, 'SpatialSeries', spatial_series)
+    monkeypatch.setattr(RawPosition, 'insert1', raw_position.insert1, raising=False)
+
+    PositionSource.insert_from_nwbfile('session_.nwb')
+    assert [entry['interval_list_name'] for entry in position_source.entries] == ['pos 0 valid times',
+                                                                                  'pos 1 valid times']
+    assert [(entry['raw_position_object_id'], entry['sampling_rate']) for entry in spatial_series.entries] == \
+        [(object_ids['series_a'], 30.), (object_ids['series_b'], 50.)]
+    np.testing.assert_allclose(interval_list.entries[1]['valid_times'],
+                               [[100., 100 + 499 / 50], [105 + 500 / 50, 105 + 999 / 50]])
+
+    # like a populate worker in another process, RawPosition.make only reads the stored entries
+    def get_nwb_file(nwb_file_abspath):
+        raise AssertionError('the NWB file was read again')
+
+    monkeypatch.setattr(common_behav, 'get_nwb_file', get_nwb_file)
+    for entry in position_source.entries:
+        RawPosition().make({'nwb_file_name': 'session_.nwb', 'interval_list_name': entry['interval_list_name']})
+    assert [entry['raw_position_object_id'] for entry in raw_position.entries] == [object_ids['series_a'],
+                                                                                  object_ids['series_b']]
@@ -0,0 +1,123 @@
+import contextlib
+import types
+
+import numpy as np
+import pytest
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common import common_ephys
+from nwb_datajoint.common.common_ephys import LFP, LFPBand
+from nwb_datajoint.common.common_interval import IntervalSet
+
+
+def test_get_intervals_to_update():
+    valid_times = IntervalSet([[0, 10], [20, 30], [40, 50], [60, 60.5]])
+    # [0, 10] was extended, [20, 30] had a gap that was repaired and [40, 50] is unchanged
+    lfp_valid_times = IntervalSet([[0, 5], [20, 24], [26, 30], [40, 50]])
+    new_valid_times, filter_times = LFP._get_intervals_to_update(valid_times, lfp_valid_times, 1.0)
+    assert np.all(new_valid_times == np.array([[5, 10], [24, 26]]))
+    assert np.all(filter_times == np.array([[0, 10], [20, 30]]))
+
+    new_valid_times, filter_times = LFP._get_intervals_to_update(valid_times, valid_times, 1.0)
+    assert len(new_valid_times) == 0 and len(filter_times) == 0
+
+
+class _KeySource:
+    """Stands in for the pending keys of LFPBand.key_source."""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __and__(self, restriction):
+        return self
+
+    def __sub__(self, table):
+        return self
+
+    def fetch(self, attr):
+        return [dict(key) for key in self.keys]
+
+
+class _Jobs:
+    """Stands in for the jobs table of the schema, with some keys reserved by another process."""
+
+    def __init__(self, reserved_elsewhere):
+        self.reserved = [key['filter_name'] for key in reserved_elsewhere]
+        self.completed = []
+        self.errors = []
+
+    def reserve(self, table_name, key):
+        if key['filter_name'] in self.reserved:
+            return False
+        self.reserved.append(key['filter_name'])
+        return True
+
+    def complete(self, table_name, key):
+        self.completed.append(key['filter_name'])
+
+    def error(self, table_name, key, error_message):
+        self.errors.append(key['filter_name'])
+
+
+@pytest.fixture
+def lfp_band(monkeypatch):
+    # theta, gamma and ripple share their electrodes and references; beta uses another reference
+    keys = [{'nwb_file_name': 'test_.nwb', 'target_interval_list_name': 'interval', 'filter_name': filter_name}
+            for filter_name in ['theta', 'gamma', 'beta', 'ripple']]
+    electrodes = {'theta': ([1, 2], [-1, -1]), 'gamma': ([1, 2], [-1, -1]), 'beta': ([1, 2], [3, 3]),
+                  'ripple': ([1, 2], [-1, -1])}
+    valid_times = {'theta': [[0, 10]], 'gamma': [[2, 5]], 'beta': [[0, 10]], 'ripple': [[20, 30]]}
+    calls = types.SimpleNamespace(reads=[], filtered=[])
+
+    def read_referenced_lfp(lfp_object, lfp_band_elect_id, lfp_band_ref_id, valid_times_list):
+        calls.reads.append((tuple(lfp_band_ref_id), [valid_times.tolist() for valid_times in valid_times_list]))
+        return np.arange(10.), np.zeros((10, 2)), np.arange(2)
+
+    def filter_band(self, key, timestamps, lfp_data, lfp_band_elect_id, lfp_band_elect_index, lfp_band_valid_times,
+                    **insert_kwargs):
+        if key['filter_name'] == calls.fail:
+            raise RuntimeError('failed')
+        assert insert_kwargs == {'allow_direct_insert': True}
+        calls.filtered.append(key['filter_name'])
+
+    calls.fail = None
+    lfp_query = types.SimpleNamespace(fetch_nwb=lambda: [{'lfp': None}])
+    monkeypatch.setattr(LFPBand, 'key_source', _KeySource(keys), raising=False)
+    monkeypatch.setattr(LFPBand, 'connection', types.SimpleNamespace(transaction=contextlib.nullcontext()))
+    monkeypatch.setattr(LFPBand, 'table_name', '__l_f_p_band', raising=False)
+    monkeypatch.setattr(common_ephys.dj, 'AndList', list, raising=False)
+    monkeypatch.setattr(common_ephys, 'LFP', type('LFP', (), {'__and__': lambda self, key: lfp_query}))
+    monkeypatch.setattr(LFPBand, '_get_band_electrodes',
+                        staticmethod(lambda key: tuple(np.array(ids) for ids in electrodes[key['filter_name']])))
+    monkeypatch.setattr(LFPBand, '_get_band_valid_times',
+                        staticmethod(lambda key: np.array(valid_times[key['filter_name']])))
+    monkeypatch.setattr(LFPBand, '_read_referenced_lfp', staticmethod(read_referenced_lfp))
+    monkeypatch.setattr(LFPBand, '_filter_band', filter_band)
+    return calls
+
+
+def test_populate_multiband(lfp_band):
+    LFPBand().populate_multiband()
+    # the LFP is read once for each group of bands, over the valid times of all of them
+    assert lfp_band.reads == [((-1, -1), [[[0, 10]], [[2, 5]], [[20, 30]]]), ((3, 3), [[[0, 10]]])]
+    assert lfp_band.filtered == ['theta', 'gamma', 'ripple', 'beta']
+
+
+def test_populate_multiband_reserve_jobs(lfp_band, monkeypatch):
+    jobs = _Jobs(reserved_elsewhere=[{'filter_name': 'theta'}])
+    monkeypatch.setattr(common_ephys.schema, 'jobs', jobs, raising=False)
+    lfp_band.fail = 'gamma'
+    with pytest.raises(RuntimeError):
+        LFPBand().populate_multiband(reserve_jobs=True)
+    # theta was skipped, and ripple was released when gamma failed
+    assert lfp_band.reads == [((-1, -1), [[[2, 5]], [[20, 30]]])]
+    assert lfp_band.filtered == []
+    assert (jobs.errors, jobs.completed) == (['gamma'], ['ripple'])
+
+    lfp_band.fail = None
+    lfp_band.reads.clear()
+    jobs.reserved = []
+    LFPBand().populate_multiband(reserve_jobs=True)
+    assert lfp_band.filtered == ['theta', 'gamma', 'ripple', 'beta']
+    assert jobs.completed == ['ripple', 'theta', 'gamma', 'ripple', 'beta']
@@ -0,0 +1,216 @@
+import datetime
+import os
+
+import h5py
+import numpy as np
+import pynwb
+import pytest
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common.common_filter import (FILTER_BACKENDS, FirFilter, _overlap_save_convolve,
+                                                _polyphase_convolve, memory_to_bytes, plan_filter_blocks)
+
+from tests.reference_implementations import reference_convolve
+
+ELECTRODE_IDS = [101, 102, 103, 105, 106, 108, 109, 110]
+DECIMATION = 30
+
+
+def _make_file(path, with_data):
+    nwbfile = pynwb.NWBFile(
+        session_description='session_description',
+        identifier='identifier',
+        session_start_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    device = nwbfile.create_device('device')
+    group = nwbfile.create_electrode_group('group', 'description', 'location', device)
+    for electrode_id in range(100, 112):
+        nwbfile.add_electrode(id=electrode_id, x=0., y=0., z=0., imp=0., location='location',
+                              filtering='filtering', group=group)
+    if with_data:
+        data = np.random.default_rng(0).normal(0, 200, (90000, 12)).astype('int16')
+        # 30 kHz with a 5 second gap in the middle
+        timestamps = np.arange(90000) / 30000. + 10
+        timestamps[45000:] += 5
+        region = nwbfile.create_electrode_table_region(list(range(12)), 'all electrodes')
+        nwbfile.add_acquisition(pynwb.ecephys.ElectricalSeries(name='raw', data=data, timestamps=timestamps,
+                                                               electrodes=region))
+    with pynwb.NWBHDF5IO(path=path, mode='w') as io:
+        io.write(nwbfile)
+
+
+@pytest.fixture
+def raw_file(tmp_path):
+    path = str(tmp_path / 'raw.nwb')
+    _make_file(path, True)
+    return path
+
+
+@pytest.fixture
+def filter_coeff():
+    filter_coeff = np.hanning(101)
+    return filter_coeff / filter_coeff.sum()
+
+
+def _filter(raw_file, path, filter_coeff, valid_times, previous_file=None, create=True, **kwargs):
+    if create:
+        _make_file(path, False)
+    with pynwb.NWBHDF5IO(path=raw_file, mode='r') as io:
+        eseries = io.read().acquisition['raw']
+        if previous_file is None:
+            FirFilter().filter_data_nwb(path, eseries, filter_coeff, np.array(valid_times), ELECTRODE_IDS,
+                                        DECIMATION, **kwargs)
+        else:
+            with pynwb.NWBHDF5IO(path=previous_file, mode='r') as previous_io:
+                previous_eseries = previous_io.read().scratch['filtered data']
+                FirFilter().filter_data_nwb(path, eseries, filter_coeff, np.array(valid_times), ELECTRODE_IDS,
+                                            DECIMATION, previous_eseries=previous_eseries, **kwargs)
+    with h5py.File(path, 'r') as f:
+        return f['scratch/filtered data/data'][:], f['scratch/filtered data/timestamps'][:]
+
+
+def _assert_same_filtered(filtered, expected):
+    np.testing.assert_array_equal(filtered[1], expected[1])
+    # the blocks are split at other samples, and the FFTs of the blocks round differently
+    np.testing.assert_allclose(filtered[0], expected[0], atol=1)
+
+
+@pytest.mark.parametrize('previous_valid_times,valid_times,all_valid_times', [
+    # extended interval
+    ([[10, 10.7]], [[10, 11.4]], [[10, 11.4]]),
+    # repaired gap between two intervals
+    ([[10, 10.5], [10.8, 11.4]], [[10, 11.4]], [[10, 11.4]]),
+    # new interval between two intervals
+    ([[10, 11.4], [17, 18]], [[16.6, 16.9]], [[10, 11.4], [16.6, 16.9], [17, 18]]),
+])
+def test_previous_eseries(tmp_path, raw_file, filter_coeff, previous_valid_times, valid_times, all_valid_times):
+    # filtering with the previously filtered data gives the same result as filtering everything again
+    previous_file = str(tmp_path / 'previous.nwb')
+    _filter(raw_file, previous_file, filter_coeff, previous_valid_times)
+    filtered = _filter(raw_file, str(tmp_path / 'updated.nwb'), filter_coeff, valid_times,
+                       previous_file=previous_file, n_jobs=2)
+    expected = _filter(raw_file, str(tmp_path / 'full.nwb'), filter_coeff, all_valid_times)
+    _assert_same_filtered(filtered, expected)
+
+
+def test_merge_previous_segments():
+    timestamps = np.arange(100.)
+    previous_timestamps = np.array([0., 3., 6., 9., 50., 53.])
+    # the first interval continues the first 4 previous samples, the second replaces none of them
+    segments = [('eseries', 0, 30, 0, 10), ('eseries', 60, 90, 0, 10)]
+    merged = FirFilter._merge_previous_segments(segments, timestamps, previous_timestamps, 3, 4)
+    # the last continued sample (at 9) and the one before it depended on samples after the end of the previous
+    # interval, so they are filtered again
+    assert merged == [('previous', 0, 2, 0, 2), ('eseries', 0, 30, 2, 8), ('previous', 4, 6, 0, 2),
+                      ('eseries', 60, 90, 0, 10)]
+    # previous samples with other timestamps within the interval are replaced
+    merged = FirFilter._merge_previous_segments([('eseries', 1, 30, 0, 10)], timestamps, previous_timestamps, 3, 4)
+    assert merged == [('previous', 0, 1, 0, 1), ('eseries', 1, 30, 0, 10), ('previous', 4, 6, 0, 2)]
+    with pytest.raises(ValueError):
+        FirFilter._merge_previous_segments([('eseries', 50, 60, 0, 4), ('eseries', 0, 10, 0, 4)], timestamps,
+                                           previous_timestamps, 3, 4)
+
+
+def test_resume_from_checkpoint(tmp_path, raw_file, filter_coeff, monkeypatch):
+    valid_times = [[10, 11.4], [16.6, 18]]
+    expected = _filter(raw_file, str(tmp_path / 'full.nwb'), filter_coeff, valid_times)
+
+    path = str(tmp_path / 'resumed.nwb')
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    filter_block_nwb = FirFilter._filter_block_nwb
+
+    def crash_in_second_interval(self, data_on_disk, filtered_data, filter_coeff, time_axis, start, *args):
+        if start > 0:
+            raise RuntimeError('crash')
+        return filter_block_nwb(self, data_on_disk, filtered_data, filter_coeff, time_axis, start, *args)
+
+    monkeypatch.setattr(FirFilter, '_filter_block_nwb', crash_in_second_interval)
+    with pytest.raises(RuntimeError):
+        _filter(raw_file, path, filter_coeff, valid_times, checkpoint_file=checkpoint_file)
+    assert FirFilter.read_checkpoint(checkpoint_file)['completed_intervals'] == [0]
+    monkeypatch.setattr(FirFilter, '_filter_block_nwb', filter_block_nwb)
+    filtered = _filter(raw_file, path, filter_coeff, valid_times, create=False, checkpoint_file=checkpoint_file)
+    assert not os.path.exists(checkpoint_file)
+    _assert_same_filtered(filtered, expected)
+
+
+@pytest.mark.parametrize('convolve', [_polyphase_convolve, _overlap_save_convolve])
+@pytest.mark.parametrize('n_taps', [7, 101, 1000])
+def test_convolve(convolve, n_taps):
+    data = np.random.default_rng(0).normal(0, 200, (5000, 3))
+    filter_coeff = np.random.default_rng(1).normal(0, 1, n_taps)
+    # from the start of the convolution, where the history is zero padded, and from within the data
+    for first_ind, last_ind, decimation in [(0, 4999, 1), (0, 5000 + n_taps - 2, 30), (n_taps + 3, 4000, 7)]:
+        np.testing.assert_allclose(convolve(data, filter_coeff, first_ind, last_ind, decimation),
+                                   reference_convolve(data, filter_coeff, first_ind, last_ind, decimation),
+                                   atol=1e-8)
+
+
+@pytest.mark.parametrize('filter_backend', FILTER_BACKENDS)
+def test_filter_data(filter_coeff, filter_backend, monkeypatch):
+    n_samples = 200000
+    data = np.random.default_rng(0).normal(0, 200, (n_samples, 5))
+    timestamps = np.arange(n_samples) / 30000.
+    valid_times = np.array([[0.5, 3.], [3.2, 6.6]])
+    electrodes = [0, 2, 3, 4]
+    monkeypatch.setattr(FirFilter, 'filter_backend', filter_backend)
+    # a small budget splits each interval into blocks of time and single channels
+    with pytest.warns(UserWarning):
+        filtered, filtered_timestamps = FirFilter().filter_data(timestamps, data, filter_coeff, valid_times,
+                                                                electrodes, DECIMATION, memory_budget='1M')
+
+    # the samples around each interval are used as its history
+    filter_delay = (len(filter_coeff) - 1) // 2
+    expected = []
+    for start, stop in np.searchsorted(timestamps, valid_times):
+        assert stop - start > 65536
+        expected.append(reference_convolve(data[:, electrodes], filter_coeff, start + filter_delay,
+                                            stop - 1 + filter_delay, DECIMATION))
+    expected = np.concatenate(expected)
+    np.testing.assert_allclose(filtered, expected, atol=1e-8)
+    assert len(filtered_timestamps) == len(expected)
+
+
+def test_filter_data_nwb(tmp_path, raw_file, filter_coeff):
+    valid_times = [[10, 11.4], [16.6, 17.9]]
+    # blocks of time and channels, filtered in two threads
+    filtered, filtered_timestamps = _filter(raw_file, str(tmp_path / 'filtered.nwb'), filter_coeff, valid_times,
+                                            n_jobs=2, memory_budget='8M')
+
+    with h5py.File(raw_file, 'r') as f:
+        data = f['acquisition/raw/data'][:, [electrode_id - 100 for electrode_id in ELECTRODE_IDS]]
+        timestamps = f['acquisition/raw/timestamps'][:]
+    # the samples outside each interval are taken as zero
+    filter_delay = (len(filter_coeff) - 1) // 2
+    expected = []
+    for start, stop in np.searchsorted(timestamps, valid_times):
+        expected.append(reference_convolve(data[start:stop].astype(np.float64), filter_coeff, filter_delay,
+                                            stop - start - 1 + filter_delay, DECIMATION).astype(np.int16))
+    np.testing.assert_allclose(filtered, np.concatenate(expected), atol=1)
+    np.testing.assert_array_equal(filtered_timestamps,
+                                  np.concatenate([timestamps[start:stop:DECIMATION] for start, stop in
+                                                  np.searchsorted(timestamps, valid_times)]))
+
+
+def test_plan_filter_blocks():
+    time_block_samples, channel_block_size, peak_memory = plan_filter_blocks(
+        10 ** 7, 128, 2, 1001, DECIMATION, n_jobs=4, memory_budget='2G', allocated_memory=10 ** 8)
+    assert time_block_samples % DECIMATION == 0
+    assert channel_block_size == 32
+    assert peak_memory <= 2e9
+    # a block is about one FFT long at the least and never longer than the interval
+    time_block_samples, _, _ = plan_filter_blocks(10 ** 5, 128, 2, 1001, DECIMATION, memory_budget='1G')
+    assert time_block_samples == 10 ** 5 // DECIMATION * DECIMATION
+    with pytest.warns(UserWarning):
+        time_block_samples, channel_block_size, _ = plan_filter_blocks(10 ** 7, 128, 2, 1001, DECIMATION,
+                                                                       memory_budget='1M')
+    assert time_block_samples == 65536 // DECIMATION * DECIMATION and channel_block_size == 1
+
+
+def test_memory_to_bytes():
+    assert memory_to_bytes('500M') == 5 * 10 ** 8
+    assert memory_to_bytes('1.5G') == 15 * 10 ** 8
+    assert memory_to_bytes(1024) == 1024
+    with pytest.raises(ValueError):
+        memory_to_bytes('4GB')
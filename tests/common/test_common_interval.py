@@ -1,5 +1,13 @@
 import numpy as np
-from nwb_datajoint.common.common_interval import interval_list_intersect
+import pytest
+from nwb_datajoint.common import common_interval
+from nwb_datajoint.common.common_interval import (IntervalList, IntervalSet, interval_list_censor,
+                                                  interval_list_complement, interval_list_contains,
+                                                  interval_list_contains_ind, interval_list_difference,
+                                                  interval_list_excludes, interval_list_excludes_ind,
+                                                  interval_list_intersect, interval_list_union)
+
+from tests.reference_implementations import reference_contains_ind, reference_excludes_ind
 
 def test_interval_list_intersect():
     interval_list1 = np.array([
@@ -10,3 +18,113 @@ def test_interval_list_intersect():
     ])
     intersection_list = interval_list_intersect(interval_list1, interval_list2)
     assert np.all(intersection_list==np.array([[9,10],[14,16]]))
+
+def test_interval_list_union():
+    interval_list1 = np.array([
+        [0,5],[2,8],[10,12]
+    ])
+    interval_list2 = np.array([
+        [11,14],[20,21]
+    ])
+    union_list = interval_list_union(interval_list1, interval_list2)
+    assert np.all(union_list==np.array([[0,8],[10,14],[20,21]]))
+
+def test_interval_list_difference():
+    interval_list1 = np.array([
+        [0,10],[14,16]
+    ])
+    interval_list2 = np.array([
+        [2,3],[9,15]
+    ])
+    difference_list = interval_list_difference(interval_list1, interval_list2)
+    assert np.all(difference_list==np.array([[0,2],[3,9],[15,16]]))
+    complement_list = interval_list_complement(interval_list2, 0, 20)
+    assert np.all(complement_list==np.array([[0,2],[3,9],[15,20]]))
+
+def test_interval_list_contains():
+    timestamps = np.arange(10.)
+    valid_times = np.array([
+        [6,7.5],[1,3],[2,2.5]
+    ])
+    assert np.all(interval_list_contains_ind(valid_times, timestamps)==np.array([6,7,1,2,3,2]))
+    assert np.all(interval_list_contains(valid_times, timestamps)==np.array([6.,7.,1.,2.,3.,2.]))
+    assert len(interval_list_contains_ind(np.array([[20,30]]), timestamps))==0
+
+def test_interval_list_excludes():
+    timestamps = np.arange(10.)
+    valid_times = np.array([
+        [1,3],[6,7.5]
+    ])
+    assert np.all(interval_list_excludes_ind(valid_times, timestamps)==np.array([0,4,5,8,9]))
+    assert np.all(interval_list_excludes(valid_times, timestamps)==np.array([0.,4.,5.,8.,9.]))
+
+def test_interval_list_contains_excludes_ind():
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(100000) / 1000.
+    # sorted, non-overlapping intervals, some of them starting or stopping on a timestamp
+    edges = np.sort(np.concatenate([rng.uniform(timestamps[0], timestamps[-1], 40), timestamps[[1234, 5678]]]))
+    valid_times = edges.reshape(-1, 2)
+    assert np.array_equal(interval_list_contains_ind(valid_times, timestamps),
+                          reference_contains_ind(valid_times, timestamps))
+    assert np.array_equal(interval_list_excludes_ind(valid_times, timestamps),
+                          reference_excludes_ind(valid_times, timestamps))
+
+def test_interval_set():
+    interval_set = IntervalSet(np.array([
+        [5,6],[0,2],[1,3]
+    ]))
+    assert np.all(interval_set.intervals==np.array([[0,3],[5,6]]))
+    assert interval_set.duration==4
+    other = IntervalSet([2.5,5.5])
+    assert (interval_set & other)==IntervalSet([[2.5,3],[5,5.5]])
+    assert (interval_set | other)==IntervalSet([[0,6]])
+    assert (interval_set - other)==IntervalSet([[0,2.5],[5.5,6]])
+    assert interval_set.complement(-1,10)==IntervalSet([[-1,0],[3,5],[6,10]])
+    assert interval_set.contains_all([0,1,3,5.5])
+    assert not interval_set.contains_all([0,1,4])
+
+def test_interval_list_censor():
+    interval_list = np.array([
+        [0,3],[5,6]
+    ])
+    assert np.all(interval_list_censor(interval_list, np.array([1,2,5.5]))==np.array([[1,3],[5,5.5]]))
+
+def test_fetch_interval_set_cache(monkeypatch):
+    stored = {('test_.nwb', 'interval'): np.array([[0., 1.]])}
+    fetches = []
+
+    def fetch_valid_times(nwb_file_name, interval_list_name):
+        fetches.append(interval_list_name)
+        return stored[(nwb_file_name, interval_list_name)]
+
+    def insert(self, rows, **kwargs):
+        for row in rows:
+            stored[(row['nwb_file_name'], row['interval_list_name'])] = row['valid_times']
+
+    monkeypatch.setattr(IntervalList, '_fetch_valid_times', staticmethod(fetch_valid_times))
+    monkeypatch.setattr(common_interval.dj.Manual, 'insert', insert, raising=False)
+    monkeypatch.setattr(common_interval.dj.Manual, 'delete_quick', lambda self: stored.clear(), raising=False)
+    now = [0.]
+    monkeypatch.setattr(common_interval.time, 'monotonic', lambda: now[0])
+    IntervalList.clear_interval_set_cache()
+
+    # cached entries are returned without a query
+    interval_set = IntervalList.fetch_interval_set('test_.nwb', 'interval')
+    assert IntervalList.fetch_interval_set('test_.nwb', 'interval') is interval_set
+    assert len(fetches) == 1
+    # inserts through IntervalList drop the entries they replace
+    IntervalList().insert([{'nwb_file_name': 'test_.nwb', 'interval_list_name': 'interval',
+                            'valid_times': np.array([[0., 2.]])}], replace=True)
+    assert IntervalList.fetch_interval_set('test_.nwb', 'interval') == IntervalSet([0., 2.])
+    # changes made by other processes are seen after the time to live or with refresh=True
+    stored[('test_.nwb', 'interval')] = np.array([[0., 3.]])
+    assert IntervalList.fetch_interval_set('test_.nwb', 'interval') == IntervalSet([0., 2.])
+    assert IntervalList.fetch_interval_set('test_.nwb', 'interval', refresh=True) == IntervalSet([0., 3.])
+    stored[('test_.nwb', 'interval')] = np.array([[0., 4.]])
+    now[0] += common_interval.INTERVAL_SET_CACHE_TTL
+    assert IntervalList.fetch_interval_set('test_.nwb', 'interval') == IntervalSet([0., 4.])
+    assert len(fetches) == 4
+    # deletes clear the cache
+    IntervalList().delete_quick()
+    with pytest.raises(KeyError):
+        IntervalList.fetch_interval_set('test_.nwb', 'interval')
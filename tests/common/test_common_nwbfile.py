@@ -0,0 +1,136 @@
+import datetime
+import json
+import os
+import types
+
+import h5py
+import numpy as np
+import pynwb
+import pytest
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common.common_nwbfile import AnalysisNwbfile, AnalysisNwbfileWriter
+
+# the spike times of each unit, including one with no spikes
+SPIKE_TRAINS = {3: np.array([10, 25, 40]), 5: np.array([], dtype=int), 8: np.array([7, 9])}
+N_SAMPLES = 4
+CHANNEL_IDS = np.array([0, 2])
+
+
+def _make_file(path):
+    nwbfile = pynwb.NWBFile(
+        session_description='session_description',
+        identifier='identifier',
+        session_start_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    device = nwbfile.create_device('device')
+    group = nwbfile.create_electrode_group('group', 'description', 'location', device)
+    for electrode_id in range(3):
+        nwbfile.add_electrode(id=electrode_id, x=0., y=0., z=0., imp=0., location='location',
+                              filtering='filtering', group=group)
+    return nwbfile
+
+
+def _write(nwbfile, path):
+    with pynwb.NWBHDF5IO(path=path, mode='w') as io:
+        io.write(nwbfile)
+
+
+def _get_waveforms(unit_id):
+    # (spikes, samples, channels)
+    n_spikes = len(SPIKE_TRAINS[unit_id])
+    return np.arange(n_spikes * N_SAMPLES * len(CHANNEL_IDS), dtype=np.float32).reshape(
+        n_spikes, N_SAMPLES, len(CHANNEL_IDS)) + unit_id
+
+
+def _read_units(path):
+    """Return the data of each dataset of the units table."""
+    with h5py.File(path, 'r') as f:
+        units = f['units']
+        return {name: units[name][:] for name in units if isinstance(units[name], h5py.Dataset)}
+
+
+def _assert_same_units(path, expected_path):
+    units = _read_units(path)
+    expected_units = _read_units(expected_path)
+    assert sorted(units) == sorted(expected_units)
+    for name, data in expected_units.items():
+        np.testing.assert_array_equal(units[name], data, err_msg=name)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_add_units(tmp_path, compression):
+    units_valid_times = {unit_id: np.array([[0., 50.], [60., 70.]]) for unit_id in SPIKE_TRAINS}
+    units_sort_interval = {unit_id: [0., 70.] for unit_id in SPIKE_TRAINS}
+
+    expected_path = str(tmp_path / 'expected.nwb')
+    nwbfile = _make_file(expected_path)
+    for unit_id, spike_times in SPIKE_TRAINS.items():
+        nwbfile.add_unit(spike_times=spike_times, id=unit_id, obs_intervals=units_valid_times[unit_id])
+    nwbfile.add_unit_column(name='sort_interval', description='the interval used for spike sorting',
+                            data=list(units_sort_interval.values()))
+    _write(nwbfile, expected_path)
+
+    path = str(tmp_path / 'analysis.nwb')
+    _write(_make_file(path), path)
+    with AnalysisNwbfileWriter(path) as writer:
+        units_object_id, _ = writer.add_units(SPIKE_TRAINS, units_valid_times, units_sort_interval,
+                                              compression=compression)
+    _assert_same_units(path, expected_path)
+    with h5py.File(path, 'r') as f:
+        assert f['units/spike_times'].compression == compression
+        assert f['units'].attrs['object_id'] == units_object_id
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_add_units_waveforms(tmp_path, compression):
+    expected_path = str(tmp_path / 'expected.nwb')
+    nwbfile = _make_file(expected_path)
+    for unit_id, spike_times in SPIKE_TRAINS.items():
+        nwbfile.add_unit(spike_times=spike_times, id=unit_id, electrodes=CHANNEL_IDS,
+                         waveforms=np.moveaxis(_get_waveforms(unit_id), source=2, destination=0))
+    _write(nwbfile, expected_path)
+
+    waveform_extractor = types.SimpleNamespace(
+        sorting=types.SimpleNamespace(get_unit_ids=lambda: list(SPIKE_TRAINS),
+                                      get_unit_spike_train=lambda unit_id: SPIKE_TRAINS[unit_id]),
+        recording=types.SimpleNamespace(get_channel_ids=lambda: CHANNEL_IDS),
+        get_waveforms=_get_waveforms)
+    path = str(tmp_path / 'analysis.nwb')
+    _write(_make_file(path), path)
+    with AnalysisNwbfileWriter(path) as writer:
+        writer.add_units_waveforms(waveform_extractor, compression=compression)
+    _assert_same_units(path, expected_path)
+    with h5py.File(path, 'r') as f:
+        assert f['units/waveforms'].compression == compression
+
+
+def test_cleanup_checkpoints(tmp_path, monkeypatch):
+    monkeypatch.delenv('NWB_DATAJOINT_TEMP_DIR', raising=False)
+    monkeypatch.setenv('NWB_DATAJOINT_BASE_DIR', str(tmp_path))
+    (tmp_path / 'analysis').mkdir()
+    (tmp_path / 'analysis' / 'a.nwb').touch()
+    # checkpoints are kept out of the analysis directory
+    assert os.path.dirname(AnalysisNwbfile.get_checkpoint_abs_path('a.json')) == str(tmp_path / 'tmp' / 'checkpoints')
+    for checkpoint_name, analysis_file_name in [('a.json', 'a.nwb'), ('old.json', 'a.nwb'), ('b.json', 'b.nwb')]:
+        with open(AnalysisNwbfile.get_checkpoint_abs_path(checkpoint_name), 'w') as f:
+            json.dump({'analysis_file_name': analysis_file_name}, f)
+    old_time = datetime.datetime.now().timestamp() - 8 * 24 * 3600
+    os.utime(AnalysisNwbfile.get_checkpoint_abs_path('old.json'), (old_time, old_time))
+
+    AnalysisNwbfile.cleanup_checkpoints()
+    # the checkpoint that is too old and the one whose analysis file is gone are deleted
+    assert os.listdir(tmp_path / 'tmp' / 'checkpoints') == ['a.json']
+
+    monkeypatch.setenv('NWB_DATAJOINT_TEMP_DIR', str(tmp_path / 'temp'))
+    assert AnalysisNwbfile.get_checkpoint_abs_path('a.json') == str(tmp_path / 'temp' / 'checkpoints' / 'a.json')
+
+
+def test_get_template_abs_path(tmp_path, monkeypatch):
+    monkeypatch.delenv('NWB_DATAJOINT_BASE_DIR', raising=False)
+    with pytest.raises(AssertionError, match='NWB_DATAJOINT_BASE_DIR'):
+        AnalysisNwbfile.get_template_abs_path('session_.nwb')
+    monkeypatch.setenv('NWB_DATAJOINT_BASE_DIR', str(tmp_path))
+    assert AnalysisNwbfile.get_template_abs_path('session_.nwb') == \
+        str(tmp_path / 'analysis_templates' / 'session__template.nwb')
@@ -0,0 +1,99 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common import common_spikesorting
+from nwb_datajoint.common.common_spikesorting import SpikeSortingRecording
+
+
+class _Query:
+    """Stands in for a restricted DataJoint table with one entry."""
+
+    def __init__(self, **entry):
+        self.entry = entry
+
+    def __and__(self, restriction):
+        return self
+
+    def fetch(self, attr):
+        return np.asarray(self.entry[attr])
+
+    def fetch1(self, attr):
+        return self.entry[attr]
+
+
+@pytest.fixture
+def recording_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('NWB_DATAJOINT_RECORDING_DIR', str(tmp_path))
+    return tmp_path
+
+
+def _set_mtime(path, age):
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_recording_hash(monkeypatch):
+    sort_group = _Query(sort_reference_electrode_id=[-1])
+    sort_group.SortGroupElectrode = _Query(electrode_id=[0, 1, 2, 3])
+    preproc_params = {'frequency_min': 300, 'frequency_max': 6000, 'margin_ms': 5, 'seed': 0}
+    monkeypatch.setattr(common_spikesorting, 'SortGroup', sort_group)
+    monkeypatch.setattr(common_spikesorting, 'SpikeSortingPreprocessingParameters',
+                        _Query(preproc_params=preproc_params))
+    monkeypatch.setattr(SpikeSortingRecording, '_get_sort_interval_valid_times',
+                        lambda self, key: np.array([[0., 10.], [20., 30.]]))
+    key = {'nwb_file_name': 'test_.nwb', 'sort_group_id': 0, 'sort_interval_name': 'interval',
+           'preproc_params_name': 'default', 'team_name': 'team1'}
+    recording_hash = SpikeSortingRecording()._get_recording_hash(key)
+    # the team and the recording id do not change the recording
+    assert SpikeSortingRecording()._get_recording_hash({**key, 'team_name': 'team2', 'recording_id': 'R_1'}) == \
+        recording_hash
+    preproc_params['frequency_min'] = 600
+    assert SpikeSortingRecording()._get_recording_hash(key) != recording_hash
+
+
+def test_link_cached_recording(recording_dir):
+    cache_path = recording_dir / 'cache' / 'recording_hash'
+    cache_path.mkdir(parents=True)
+    (cache_path / 'traces.raw').write_bytes(b'traces')
+    recording_path = str(recording_dir / 'recording_R_1')
+    # an existing folder is replaced by the link
+    os.mkdir(recording_path)
+    SpikeSortingRecording()._link_cached_recording(cache_path, recording_path)
+    assert os.path.islink(recording_path)
+    with open(os.path.join(recording_path, 'traces.raw'), 'rb') as f:
+        assert f.read() == b'traces'
+    assert (recording_dir / 'cache' / 'recording_hash.refs' / 'recording_R_1').read_text() == recording_path
+
+
+def test_nightly_cleanup(recording_dir, monkeypatch):
+    cache_folder = recording_dir / 'cache'
+    recording = SpikeSortingRecording()
+    for name in ['in_table', 'deleted', 'being_made']:
+        cache_path = cache_folder / f'hash_{name}'
+        cache_path.mkdir(parents=True)
+        recording._link_cached_recording(cache_path, str(recording_dir / name))
+    # left by makes that crashed before linking and while saving
+    (cache_folder / 'hash_unreferenced').mkdir()
+    (cache_folder / 'hash_deleted.1234.abcdef12.tmp').mkdir()
+    # saved by a running make
+    (cache_folder / 'hash_saving.1234.abcdef12.tmp').mkdir()
+    for path in cache_folder.glob('**/*'):
+        if 'saving' not in path.name and 'being_made' not in path.name:
+            _set_mtime(path, 2 * 24 * 60 * 60)
+    monkeypatch.setattr(SpikeSortingRecording, 'fetch', lambda self, attr: [str(recording_dir / 'in_table')],
+                        raising=False)
+
+    recording.nightly_cleanup()
+    assert sorted(os.listdir(cache_folder)) == ['hash_being_made', 'hash_being_made.refs', 'hash_in_table',
+                                                'hash_in_table.refs', 'hash_saving.1234.abcdef12.tmp']
+    assert os.path.islink(recording_dir / 'in_table') and os.path.islink(recording_dir / 'being_made')
+    assert not os.path.lexists(recording_dir / 'deleted')
+
+    # the entry of the running make was not inserted
+    recording.nightly_cleanup(grace_period=0)
+    assert sorted(os.listdir(cache_folder)) == ['hash_in_table', 'hash_in_table.refs']
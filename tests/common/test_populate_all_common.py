@@ -0,0 +1,76 @@
+import importlib
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common.common_dio import DIOEvents
+from nwb_datajoint.common.common_ephys import Raw
+
+# the module, which nwb_datajoint.common.populate_all_common (the function) hides
+populate_all_common = importlib.import_module('nwb_datajoint.common.populate_all_common')
+
+
+class _Dependencies:
+    """Stands in for the DataJoint dependency graph, given the parents of each table."""
+
+    def __init__(self, parents):
+        self.parents = parents
+
+    def load(self, force=True):
+        pass
+
+    def ancestors(self, full_table_name):
+        # like DataJoint, include the table itself
+        ancestors = [full_table_name]
+        for parent in self.parents.get(full_table_name, ()):
+            ancestors.extend(self.ancestors(parent))
+        return ancestors
+
+
+def _make_tables(parents):
+    connection = type('Connection', (), {'dependencies': _Dependencies(parents)})()
+    return {name: type(name, (), {'full_table_name': name, 'connection': connection})
+            for name in ['Nwbfile', 'Session', 'Raw', 'DIOEvents', 'TaskEpoch', 'DIOAnalysis']}
+
+
+def test_extra_dependencies():
+    # DIOEvents.make reads the Raw entry of the session
+    assert Raw in populate_all_common.EXTRA_DEPENDENCIES[DIOEvents]
+
+
+def test_get_populate_prerequisites(monkeypatch):
+    tables = _make_tables({'Session': ['Nwbfile'], 'Raw': ['Session'], 'DIOEvents': ['Session'],
+                           'TaskEpoch': ['Session'], 'DIOAnalysis': ['DIOEvents']})
+    monkeypatch.setattr(populate_all_common, 'EXTRA_DEPENDENCIES', {tables['DIOEvents']: (tables['Raw'],)})
+    # Nwbfile is not populated, so it is not a prerequisite
+    populated = [tables[name] for name in ['Session', 'Raw', 'DIOEvents', 'TaskEpoch', 'DIOAnalysis']]
+    prerequisites = {table.__name__: {prerequisite.__name__ for prerequisite in table_prerequisites}
+                     for table, table_prerequisites in
+                     populate_all_common.get_populate_prerequisites(populated).items()}
+    assert prerequisites == {'Session': set(),
+                             'Raw': {'Session'},
+                             'DIOEvents': {'Session', 'Raw'},
+                             'TaskEpoch': {'Session'},
+                             # through the extra dependency of DIOEvents
+                             'DIOAnalysis': {'Session', 'Raw', 'DIOEvents'}}
+
+
+def test_no_nested_workers(monkeypatch):
+    populated = []
+    tables = _make_tables({})
+    steps = {tables[name]: (lambda name=name: populated.append(name)) for name in ['Session', 'Raw']}
+    monkeypatch.setattr(populate_all_common, '_get_populate_steps', lambda nwb_file_name: steps)
+    monkeypatch.setattr(populate_all_common, 'get_populate_prerequisites',
+                        lambda tables: {table: set() for table in tables})
+    monkeypatch.setattr(populate_all_common.Nwbfile, 'get_abs_path', lambda nwb_file_name: nwb_file_name,
+                        raising=False)
+    monkeypatch.setattr(populate_all_common, 'get_nwb_file', lambda nwb_file_path: None)
+
+    def process_pool(*args, **kwargs):
+        raise AssertionError('started worker processes')
+
+    monkeypatch.setattr(populate_all_common, 'ProcessPoolExecutor', process_pool)
+    monkeypatch.setenv('NWB_DATAJOINT_POPULATE_N_WORKERS', '4')
+    # e.g. in a worker process of insert_sessions
+    monkeypatch.setattr(populate_all_common.multiprocessing, 'parent_process', lambda: object())
+    timings = populate_all_common.populate_all_common('test_.nwb')
+    assert populated == ['Session', 'Raw'] and sorted(timings) == ['Raw', 'Session']
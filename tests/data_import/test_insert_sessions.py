@@ -1,4 +1,5 @@
 import datetime
+import importlib
 import datajoint as dj
 from hdmf.backends.warnings import BrokenLinkWarning
 import pathlib
@@ -9,6 +10,9 @@ import os
 
 from nwb_datajoint.data_import.insert_sessions import copy_nwb_link_raw_ephys
 
+# the module, which nwb_datajoint.data_import.insert_sessions (the function) hides
+insert_sessions = importlib.import_module('nwb_datajoint.data_import.insert_sessions')
+
 
 @pytest.fixture()
 def new_nwbfile_raw_file_name(tmp_path):
@@ -84,3 +88,66 @@ def test_copy_nwb(new_nwbfile_raw_file_name, new_nwbfile_no_ephys_file_name, mov
         with pytest.warns(BrokenLinkWarning):
             nwbfile = io.read()  # should raise BrokenLinkWarning
         assert 'test_ts' not in nwbfile.acquisition
+
+
+def test_failed_session_is_deleted(monkeypatch):
+    inserted = set()
+    deleted = list()
+
+    class _Nwbfile:
+        def __and__(self, key):
+            return [key] if key['nwb_file_name'] in inserted else []
+
+        @staticmethod
+        def insert_from_relative_file_name(nwb_file_name):
+            if nwb_file_name in inserted:
+                raise ValueError('duplicate entry')
+            inserted.add(nwb_file_name)
+
+    def populate_all_common(nwb_file_name):
+        raise ValueError('bad session')
+
+    monkeypatch.setattr(insert_sessions, 'Nwbfile', _Nwbfile)
+    monkeypatch.setattr(insert_sessions, 'copy_nwb_link_raw_ephys', lambda *args: None)
+    monkeypatch.setattr(insert_sessions, 'populate_all_common', populate_all_common)
+    monkeypatch.setattr(insert_sessions, '_delete_failed_session',
+                        lambda nwb_file_name, result, created: deleted.append((nwb_file_name, created)))
+    result = insert_sessions._insert_session('session.nwb')
+    assert result['status'] == 'failed' and result['error'] == 'ValueError: bad session'
+    assert deleted == [('session.nwb', True)]
+
+    # a session that was inserted before is skipped and not deleted
+    inserted.add('other_.nwb')
+    result = insert_sessions._insert_session('other.nwb')
+    assert result['status'] == 'skipped'
+    assert deleted == [('session.nwb', True)]
+
+    # a session that another run inserts after the check is not deleted by this run
+    monkeypatch.setattr(insert_sessions, 'copy_nwb_link_raw_ephys', lambda *args: inserted.add('racing_.nwb'))
+    result = insert_sessions._insert_session('racing.nwb')
+    assert result['status'] == 'failed' and result['error'] == 'ValueError: duplicate entry'
+    assert deleted == [('session.nwb', True), ('racing.nwb', False)]
+
+
+def test_delete_failed_session_keeps_other_runs_entry(monkeypatch):
+    deleted = list()
+
+    class _Query(list):
+        def delete(self, safemode=True):
+            deleted.append('entry')
+
+        def delete_quick(self):
+            deleted.append('filepath')
+
+    class _Nwbfile:
+        external = {'raw': _Query()}
+
+        def __and__(self, key):
+            return _Query([key])
+
+    monkeypatch.setattr(insert_sessions, 'Nwbfile', _Nwbfile)
+    result = {'error': 'ValueError: duplicate entry'}
+    # the entry exists but was inserted by another run
+    insert_sessions._delete_failed_session('session.nwb', result, created=False)
+    assert deleted == []
+    assert result['error'] == 'ValueError: duplicate entry'
@@ -0,0 +1,49 @@
+"""Direct implementations of optimized nwb_datajoint functions, used as references by the tests and benchmarks.
+
+These are the original loop implementations, and for the filter backends the direct convolution, whose results the
+optimized functions must reproduce.
+"""
+from functools import reduce
+
+import numpy as np
+
+
+def reference_contains_ind(valid_times, timestamps):
+    """The original O(n_intervals x n_samples) implementation of interval_list_contains_ind"""
+    ind = []
+    for valid_time in valid_times:
+        ind += np.ravel(np.argwhere(np.logical_and(timestamps >= valid_time[0],
+                                                   timestamps <= valid_time[1]))).tolist()
+    return np.asarray(ind)
+
+
+def reference_excludes_ind(valid_times, timestamps):
+    """The original O(n_intervals x n_samples) implementation of interval_list_excludes_ind"""
+    valid_times_list = np.ndarray.ravel(valid_times).tolist()
+    valid_times_list.insert(0, timestamps[0] - 0.00001)
+    valid_times_list.append(timestamps[-1] + 0.001)
+    invalid_times = np.array(valid_times_list).reshape(-1, 2)
+    ind = []
+    for invalid_time in invalid_times:
+        ind += np.ravel(np.argwhere(np.logical_and(timestamps > invalid_time[0],
+                                                   timestamps < invalid_time[1]))).tolist()
+    return np.asarray(ind)
+
+
+def reference_window_mask(timestamps, artifact_times, half_window):
+    """The original O(n_crossings x n_samples) artifact window expansion, returned as a boolean mask"""
+    artifact_indices = []
+    for a in artifact_times:
+        a_indices = np.argwhere((timestamps > (a - half_window)) & (timestamps <= (a + half_window)))
+        artifact_indices.append(a_indices)
+    all_artifact_indices = reduce(np.union1d, artifact_indices)
+    is_artifact = np.zeros(len(timestamps), dtype=bool)
+    is_artifact[all_artifact_indices] = True
+    return is_artifact
+
+
+def reference_convolve(data, filter_coeff, first_ind, last_ind, decimation):
+    """Samples first_ind, first_ind + decimation, ... <= last_ind of the full convolution of each column of data
+    with the filter, computed directly with np.convolve"""
+    filtered = np.stack([np.convolve(channel, filter_coeff) for channel in data.T], axis=1)
+    return filtered[first_ind:last_ind + 1:decimation]
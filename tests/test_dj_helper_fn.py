@@ -0,0 +1,109 @@
+import datetime
+import os
+import tempfile
+import types
+import unittest
+
+import numpy as np
+import pandas as pd
+import pynwb
+
+# NOTE: importing this calls nwb_datajoint.__init__ and nwb_datajoint.common.__init__ which both require the
+# DataJoint MySQL server to be already set up and running
+from nwb_datajoint.common.dj_helper_fn import LazyNwbObject, fetch_nwb
+from nwb_datajoint.common.nwb_helper_fn import get_nwb_file_pool_stats
+
+
+class _Query:
+    """Stands in for a DataJoint query joined with the table of NWB file paths."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.heading = types.SimpleNamespace(names=[name for name in rows[0] if name != 'nwb2load_filepath'])
+
+    def __mul__(self, other):
+        return self
+
+    def proj(self, **kwargs):
+        return self
+
+    def fetch(self, *attrs, as_dict=False):
+        return [dict(row) for row in self.rows]
+
+
+class TestFetchNwb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        self.object_ids = []
+        for i in range(2):
+            nwbfile = pynwb.NWBFile(
+                session_description='session_description',
+                identifier=f'identifier{i}',
+                session_start_time=datetime.datetime.now(datetime.timezone.utc),
+            )
+            nwbfile.add_unit_column(name='quality', description='quality')
+            nwbfile.add_unit(spike_times=[1. + i, 2. + i], quality='good')
+            nwbfile.add_acquisition(pynwb.TimeSeries(name='ts', data=np.arange(5) + i, unit='unit',
+                                                     timestamps=np.arange(5.)))
+            path = os.path.join(self.tmpdir.name, f'file{i}.nwb')
+            with pynwb.NWBHDF5IO(path=path, mode='w') as io:
+                io.write(nwbfile)
+            self.paths.append(path)
+            self.object_ids.append((nwbfile.units.object_id, nwbfile.acquisition['ts'].object_id))
+        # the rows of the two files are interleaved
+        self.query = _Query([
+            {'entry': 0, 'units_object_id': self.object_ids[0][0], 'nwb2load_filepath': self.paths[0]},
+            {'entry': 1, 'units_object_id': self.object_ids[1][0], 'nwb2load_filepath': self.paths[1]},
+            {'entry': 2, 'units_object_id': self.object_ids[0][0], 'nwb2load_filepath': self.paths[0]},
+        ])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_grouped_fetch(self):
+        misses = get_nwb_file_pool_stats()['misses']
+        ret = fetch_nwb(self.query, (self.query, 'nwb_file_abs_path'))
+        # each file is opened once and the rows keep their order
+        assert get_nwb_file_pool_stats()['misses'] - misses == 2
+        assert [row['entry'] for row in ret] == [0, 1, 2]
+        assert all('nwb2load_filepath' not in row for row in ret)
+        assert isinstance(ret[1]['units'], pd.DataFrame)
+        np.testing.assert_array_equal(ret[1]['units']['spike_times'].iloc[0], [2., 3.])
+        assert list(ret[0]['units']['quality']) == ['good']
+
+    def test_columns(self):
+        ret = fetch_nwb(self.query, (self.query, 'nwb_file_abs_path'), columns=['spike_times'])
+        assert list(ret[0]['units'].columns) == ['spike_times']
+        np.testing.assert_array_equal(ret[2]['units']['spike_times'].iloc[0], [1., 2.])
+
+    def test_lazy(self):
+        misses = get_nwb_file_pool_stats()['misses']
+        ret = fetch_nwb(self.query, (self.query, 'nwb_file_abs_path'), lazy=True, columns=['spike_times'])
+        # no file is opened until an object is used
+        assert get_nwb_file_pool_stats()['misses'] == misses
+        assert isinstance(ret[1]['units'], LazyNwbObject)
+        assert ret[1]['units'].object_id == self.object_ids[1][0]
+        assert ret[1]['units'].nwb_file_path == self.paths[1]
+        assert len(ret[1]['units']) == 1
+        assert list(ret[1]['units'].columns) == ['spike_times']
+        np.testing.assert_array_equal(ret[1]['units'].materialize()['spike_times'].iloc[0], [2., 3.])
+
+    def test_lazy_consumers(self):
+        ret = fetch_nwb(self.query, (self.query, 'nwb_file_abs_path'), lazy=True)
+        # the proxies are accepted where the dataframes they resolve to are
+        assert isinstance(ret[0]['units'], pd.DataFrame)
+        units = pd.concat([ret[0]['units'], ret[1]['units']])
+        assert list(units['quality']) == ['good', 'good']
+        pd.testing.assert_frame_equal(pd.DataFrame(ret[1]['units']), ret[1]['units'].materialize())
+        assert repr(ret[1]['units']) == repr(ret[1]['units'].materialize())
+        values = np.asarray(ret[2]['units'])
+        assert values.shape == (1, 2)
+        assert list(values[:, list(ret[2]['units'].columns).index('quality')]) == ['good']
+
+    def test_non_table_object(self):
+        query = _Query([{'ts_object_id': self.object_ids[1][1], 'nwb2load_filepath': self.paths[1]}])
+        ret = fetch_nwb(query, (query, 'nwb_file_abs_path'))
+        assert isinstance(ret[0]['ts'], pynwb.TimeSeries)
+        np.testing.assert_array_equal(ret[0]['ts'].data[:], np.arange(5) + 1)
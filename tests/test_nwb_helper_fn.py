@@ -1,10 +1,17 @@
 import datetime
+import gc
+import os
+import h5py
+import numpy as np
 import pynwb
+import tempfile
 import unittest
+import weakref
 
 # NOTE: importing this calls nwb_datajoint.__init__ whichand nwb_datajoint.common.__init__ which both require the
 # DataJoint MySQL server to be already set up and running
 from nwb_datajoint.common import get_electrode_indices
+from nwb_datajoint.common.nwb_helper_fn import LazyArray, NwbFilePool, get_data_array, invalid_electrode_index
 
 
 class TestGetElectrodeIndices(unittest.TestCase):
@@ -58,3 +65,114 @@ class TestGetElectrodeIndices(unittest.TestCase):
         eseries = self.nwbfile.acquisition['eseries']
         ret = get_electrode_indices(eseries, [102, 105])
         assert ret == [0, 3]
+
+    def test_missing_ids(self):
+        eseries = self.nwbfile.acquisition['eseries']
+        ret = get_electrode_indices(eseries, [105, 101, 102, 110])
+        assert ret == [3, invalid_electrode_index, 0, invalid_electrode_index]
+
+    def test_added_electrodes(self):
+        # the cached IDs are updated when electrodes are added to the file
+        assert get_electrode_indices(self.nwbfile, [110]) == [invalid_electrode_index]
+        self.nwbfile.add_electrode(id=110, x=0.0, y=0.0, z=0.0, imp=-1.0, location='location',
+                                   filtering='filtering', group=self.nwbfile.electrode_groups['electrodes'])
+        assert get_electrode_indices(self.nwbfile, [110, 100]) == [10, 0]
+
+
+class TestNwbFilePool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(3):
+            nwbfile = pynwb.NWBFile(
+                session_description='session_description',
+                identifier=f'identifier{i}',
+                session_start_time=datetime.datetime.now(datetime.timezone.utc),
+            )
+            nwbfile.add_acquisition(pynwb.TimeSeries(name='ts', data=np.arange(10) + i, unit='unit',
+                                                     timestamps=np.arange(10.)))
+            path = os.path.join(self.tmpdir.name, f'file{i}.nwb')
+            with pynwb.NWBHDF5IO(path=path, mode='w') as io:
+                io.write(nwbfile)
+            self.paths.append(path)
+        self.pool = NwbFilePool(max_open=2)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.tmpdir.cleanup()
+
+    def test_lru_eviction(self):
+        nwbfile = self.pool.get(self.paths[0])
+        assert self.pool.get(self.paths[0]) is nwbfile
+        self.pool.get(self.paths[1])
+        self.pool.get(self.paths[0])
+        # file 1 is the least recently used, so it is released to make room for file 2
+        self.pool.get(self.paths[2])
+        stats = self.pool.stats()
+        assert stats['open_files'] == 2
+        assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 3, 1)
+        assert self.pool.get(self.paths[0]) is nwbfile
+
+    def test_invalidation(self):
+        nwbfile = self.pool.get(self.paths[0])
+        stat = os.stat(self.paths[0])
+        os.utime(self.paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        assert self.pool.get(self.paths[0]) is not nwbfile
+        assert self.pool.stats()['invalidations'] == 1
+
+    def test_evicted_file_stays_readable(self):
+        # objects read from a file keep it open after it is evicted from the pool
+        timeseries = self.pool.get(self.paths[0]).acquisition['ts']
+        self.pool.get(self.paths[1])
+        self.pool.get(self.paths[2])
+        # max_open is a soft bound: the evicted file stays open while its objects are referenced
+        assert (self.pool.stats()['evictions'], self.pool.stats()['released_files']) == (1, 1)
+        np.testing.assert_array_equal(timeseries.data[:], np.arange(10))
+        # the file is closed once its objects are deleted
+        file_ref = weakref.ref(timeseries.data.file)
+        del timeseries
+        gc.collect()
+        assert self.pool.stats()['released_files'] == 0
+        assert file_ref() is None or not file_ref().id.valid
+
+    def test_close_in_use(self):
+        timeseries = self.pool.get(self.paths[0]).acquisition['ts']
+        with self.assertWarns(UserWarning):
+            self.pool.close(self.paths[0])
+        np.testing.assert_array_equal(timeseries.data[:], np.arange(10))
+        assert self.pool.get(self.paths[0]).acquisition['ts'] is not timeseries
+
+
+class TestGetDataArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = np.arange(200, dtype=np.int16).reshape(100, 2)
+        path = os.path.join(self.tmpdir.name, 'data.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('contiguous', data=self.data)
+            f.create_dataset('compressed', data=self.data, compression='gzip')
+        self.file = h5py.File(path, 'r')
+
+    def tearDown(self):
+        self.file.close()
+        self.tmpdir.cleanup()
+
+    def test_memmap(self):
+        data = get_data_array(self.file['contiguous'])
+        assert isinstance(data, np.memmap)
+        assert not data.flags.writeable
+        np.testing.assert_array_equal(data, self.data)
+
+    def test_lazy(self):
+        data = get_data_array(self.file['compressed'], lazy=True)
+        assert isinstance(data, LazyArray)
+        assert data.shape == self.data.shape
+        np.testing.assert_array_equal(data[10:20, 1], self.data[10:20, 1])
+        np.testing.assert_array_equal(np.asarray(data), self.data)
+
+    def test_load(self):
+        data = get_data_array(self.file['compressed'])
+        assert type(data) is np.ndarray
+        np.testing.assert_array_equal(data, self.data)